@@ -1,8 +1,15 @@
 import os
-from typing import List, Optional, Any, Dict
+import sys
+import json
+import time
+import asyncio
+from contextlib import aclosing, asynccontextmanager
+from typing import List, Optional, Any, Dict, Tuple
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import FileResponse, JSONResponse, HTMLResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pathlib import Path
@@ -15,13 +22,78 @@ from src.document_ingestion.data_ingestion import (
 from src.document_analyzer.data_analysis import DocumentAnalyzer
 from src.document_compare.document_comparator import DocumentComparatorLLM
 from src.document_chat.retrieval import ConversationalRAG
-from utils.document_ops import FastAPIFileAdapter, read_pdf_via_handler
+from utils.document_ops import FastAPIFileAdapter, read_pdf_via_handler, pdf_text
+from utils.parse_pool import parse_as_completed, shutdown_parse_pool
+from utils.llm_scheduler import LLMBusy, allm_slot
+from utils.index_replication import MEDIA_TYPE as SNAPSHOT_MEDIA_TYPE, TOKEN_HEADER, SnapshotError, get_replicator
+from utils.config_loader import load_config
+from utils.model_loader import ModelLoader
+from utils.storage_manager import StorageJanitor
+from utils.metrics import REQUEST_LATENCY, render_latest
+from utils import profiling
+from utils.traffic_recorder import TrafficRecorder, get_recorder
 
 FAISS_BASE = os.getenv("FAISS_BASE", "faiss_index")
 UPLOAD_BASE = os.getenv("UPLOAD_BASE", "data")
 FAISS_INDEX_NAME = os.getenv("FAISS_INDEX_NAME", "index")  # <--- keep consistent with save_local()
 
-app = FastAPI(title="Document Portal API", version="0.1")
+# Modules request handlers import lazily; preload() pulls them in before workers fork
+PRELOAD_MODULES = (
+    "numpy",
+    "faiss",
+    "fitz",
+    "pandas",
+    "langchain_community.vectorstores",
+    "langchain_community.document_loaders",
+    "langchain_text_splitters",
+)
+PROVIDER_MODULES = {
+    "google": ("langchain_google_genai",),
+    "groq": ("langchain_groq",),
+    "local": ("utils.local_models",),
+}
+
+def preload() -> None:
+    """
+    Build shared read-only state in the master process before workers fork
+    (gunicorn --preload, see gunicorn.conf.py): config, prompts, heavy modules and the
+    configured provider SDKs. Only modules are imported - network clients are not
+    fork-safe and are still created per worker. Freezing the GC afterwards keeps these
+    objects out of collections so their pages stay shared copy-on-write.
+    """
+    import gc
+    import importlib
+
+    config = load_config()
+    providers = {
+        os.getenv("EMBEDDING_PROVIDER", config["embedding_model"].get("provider", "google")),
+        *ModelLoader.llm_providers(config, os.getenv("LLM_PROVIDER", "groq")),
+    }
+    modules = list(PRELOAD_MODULES) + [m for p in providers for m in PROVIDER_MODULES.get(p, ())]
+    for name in modules:
+        importlib.import_module(name)
+    gc.collect()
+    gc.freeze()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    config = load_config()
+    janitor = None
+    if (config.get("storage") or {}).get("enabled", False):
+        # background TTL + disk-budget cleanup of data/ and faiss_index/
+        janitor = StorageJanitor.from_config(config, upload_base=UPLOAD_BASE, faiss_base=FAISS_BASE)
+        janitor.start()
+    app.state.janitor = janitor
+    get_replicator()  # logs the replication setup (and a missing token) at startup
+    yield
+    shutdown_parse_pool()
+    sharded = sys.modules.get("src.document_chat.sharded")  # only loaded once sharded search was used
+    if sharded is not None:
+        sharded.shutdown_sharded_search()
+    if janitor is not None:
+        janitor.stop()
+
+app = FastAPI(title="Document Portal API", version="0.1", lifespan=lifespan)
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 app.mount("/static", StaticFiles(directory=str(BASE_DIR / "static")), name="static")
@@ -35,6 +107,103 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    t0 = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # label by route template (not raw path) to keep cardinality bounded
+        route = request.scope.get("route")
+        endpoint = getattr(route, "path", "unmatched")
+        REQUEST_LATENCY.labels(request.method, endpoint, str(status)).observe(time.perf_counter() - t0)
+
+
+def install_profiling(app: FastAPI, profiler: "profiling.Profiler") -> None:
+    """Profiling middleware + /debug/profile* routes; only called when profiling is enabled."""
+
+    @app.middleware("http")
+    async def profile_request(request: Request, call_next):
+        mode = profiler.requested(request.url.path, request.headers.get(profiling.HEADER),
+                                  request.headers.get(profiling.TOKEN_HEADER))
+        if mode is None:
+            return await call_next(request)
+        with profiler.profile(request.method, request.url.path, mode) as prof:
+            response = await call_next(request)
+            if prof is not None:
+                prof.status = response.status_code
+        response.headers["X-Profile-Id"] = prof.id if prof is not None else "busy"
+        return response
+
+    def authorize(request: Request) -> None:
+        if not profiler.authorized(request.headers.get(profiling.TOKEN_HEADER)):
+            raise HTTPException(status_code=403, detail="Invalid profiling token")
+
+    @app.post("/debug/profile")
+    def arm_profile(request: Request, path: str = Form(...), count: int = Form(1),
+                    mode: Optional[str] = Form(None)) -> Any:
+        """Profile the next `count` requests whose path starts with `path`."""
+        authorize(request)
+        if mode is not None and mode not in profiling.MODES:
+            raise HTTPException(status_code=400, detail=f"mode must be one of {list(profiling.MODES)}")
+        return profiler.arm(path, count, mode)
+
+    @app.get("/debug/profiles")
+    def list_profiles(request: Request) -> Any:
+        authorize(request)
+        return {"profiles": profiler.list()}
+
+    @app.get("/debug/profiles/{profile_id}")
+    def get_profile(profile_id: str, request: Request, format: str = "summary") -> Response:
+        """Summary JSON, or the raw artifact with format=pstats (cprofile) / collapsed (sampling)."""
+        authorize(request)
+        path = profiler.artifact(profile_id, format)
+        if path is None:
+            raise HTTPException(status_code=404, detail=f"No {format} artifact for profile {profile_id}")
+        if format == "summary":
+            return Response(path.read_bytes(), media_type="application/json")
+        return FileResponse(path, filename=f"{profile_id}.{format}",
+                            media_type="text/plain" if format == "collapsed" else "application/octet-stream")
+
+
+if profiling.get_profiler() is not None:
+    install_profiling(app, profiling.get_profiler())
+
+
+def install_recording(app: FastAPI, recorder: TrafficRecorder) -> None:
+    """Traffic-recording middleware (benchmarks/replay.py); only called when recording is enabled."""
+
+    @app.middleware("http")
+    async def record_traffic(request: Request, call_next):
+        if not recorder.wants(request.url.path):
+            return await call_next(request)
+        record = await recorder.capture(request)
+        t0 = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return await recorder.capture_response(response, record)
+        finally:
+            record["latency_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+            record["status"] = status
+            record["route"] = getattr(request.scope.get("route"), "path", None)
+            recorder.write(record)
+
+
+if get_recorder() is not None:
+    install_recording(app, get_recorder())
+
+
+@app.exception_handler(LLMBusy)
+async def llm_busy(request: Request, exc: LLMBusy) -> JSONResponse:
+    return JSONResponse(status_code=429, headers={"Retry-After": str(exc.retry_after)},
+                        content={"detail": f"LLM capacity saturated ({exc.reason}), retry later",
+                                 "workload": exc.workload, "retry_after": exc.retry_after})
+
 @app.get("/", response_class=HTMLResponse)
 async def serve_ui(request: Request):
     resp = templates.TemplateResponse("index.html", {"request": request})
@@ -45,6 +214,11 @@ async def serve_ui(request: Request):
 def health() -> Dict[str, str]:
     return {"status": "ok", "service": "document-portal"}
 
+@app.get("/metrics")
+def metrics() -> Response:
+    body, content_type = render_latest()
+    return Response(content=body, media_type=content_type)
+
 # ---------- ANALYZE ----------
 @app.post("/analyze")
 async def analyze_document(file: UploadFile = File(...)) -> Any:
@@ -53,13 +227,112 @@ async def analyze_document(file: UploadFile = File(...)) -> Any:
         saved_path = dh.save_pdf(FastAPIFileAdapter(file))
         text = read_pdf_via_handler(dh, saved_path)
         analyzer = DocumentAnalyzer()
-        result = analyzer.analyze_document(text)
+        # queue for the LLM on the event loop: a waiting request must not hold a worker thread
+        async with allm_slot("analyze", text):
+            result = await run_in_threadpool(analyzer.analyze_document, text)
         return JSONResponse(content=result)
-    except HTTPException:
+    except (HTTPException, LLMBusy):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Analysis failed: {e}")
 
+@app.post("/analyze/batch")
+async def analyze_batch(
+    files: List[UploadFile] = File(...),
+    max_concurrency: Optional[int] = Form(None),
+) -> StreamingResponse:
+    """
+    Analyze many PDFs in one request. Parsing runs on a process pool and the analysis
+    chain runs with at most `max_concurrency` calls in flight. One NDJSON line is
+    streamed per file as soon as it finishes (in completion order, tagged with its
+    upload `index`), followed by a summary line. A failing file only fails its own line.
+    """
+    cfg = load_config().get("analyze_batch") or {}
+    if not files:
+        raise HTTPException(status_code=400, detail="No files uploaded")
+    if len(files) > cfg.get("max_files", 500):
+        raise HTTPException(status_code=413, detail=f"At most {cfg.get('max_files', 500)} files per batch")
+    limit = cfg.get("max_concurrency", 8)
+    concurrency = max(1, min(max_concurrency or limit, limit))
+    try:
+        dh = DocHandler()
+        analyzer = DocumentAnalyzer()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Analysis failed: {e}")
+
+    # uploads are only readable while the request is open: save them before streaming
+    saved: List[Dict[str, Any]] = []
+    for i, f in enumerate(files):
+        item: Dict[str, Any] = {"index": i, "filename": f.filename}
+        try:
+            item["path"] = dh.save_pdf(FastAPIFileAdapter(f))
+        except Exception as e:
+            item["error"], item["stage"] = str(e), "upload"
+        saved.append(item)
+    return StreamingResponse(_analyze_batch_stream(analyzer, saved, dh.session_id, concurrency, cfg),
+                             media_type="application/x-ndjson")
+
+async def _analyze_batch_stream(analyzer: DocumentAnalyzer, saved: List[Dict[str, Any]], session_id: str,
+                                concurrency: int, cfg: Dict[str, Any]):
+    t0 = time.perf_counter()
+    counts = {"ok": 0, "error": 0}
+
+    def line(item: Dict[str, Any], **fields: Any) -> str:
+        status = "error" if "error" in fields else "ok"
+        counts[status] += 1
+        body = {"index": item["index"], "filename": item["filename"], "status": status, **fields,
+                "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1)}
+        return json.dumps(body, ensure_ascii=False, default=str) + "\n"
+
+    for item in saved:
+        if "error" in item:
+            yield line(item, stage=item["stage"], error=item["error"])
+
+    # parse -> analyze pipeline: each file goes to analysis as soon as its text is ready, with at
+    # most `concurrency` analyses in flight; parsing stalls (bounded window) while analysis is behind
+    pending = [item for item in saved if "path" in item]
+    lines: asyncio.Queue = asyncio.Queue()
+    slots = asyncio.Semaphore(concurrency)
+
+    async def analyze(item: Dict[str, Any], text: str) -> None:
+        try:
+            lines.put_nowait(line(item, result=await analyzer.aanalyze_batch_item(text)))
+        except Exception as e:
+            lines.put_nowait(line(item, stage="analysis", error=str(e) or type(e).__name__))
+        finally:
+            slots.release()
+
+    async def feed() -> None:
+        analyses = set()
+        try:
+            parsed = parse_as_completed(pdf_text, [item["path"] for item in pending],
+                                        workers=cfg.get("parse_workers", 4), context=cfg.get("mp_context", "spawn"))
+            async with aclosing(parsed):
+                async for j, text in parsed:
+                    if isinstance(text, BaseException):
+                        lines.put_nowait(line(pending[j], stage="parse", error=str(text) or type(text).__name__))
+                        continue
+                    await slots.acquire()
+                    task = asyncio.create_task(analyze(pending[j], text))
+                    analyses.add(task)
+                    task.add_done_callback(analyses.discard)
+            await asyncio.gather(*analyses)
+        finally:
+            for task in list(analyses):  # cancelled (client went away): stop the analyses too
+                task.cancel()
+            lines.put_nowait(None)
+
+    feeder = asyncio.create_task(feed())
+    try:
+        while (out := await lines.get()) is not None:
+            yield out
+        await feeder  # re-raise an unexpected pipeline error
+    finally:
+        feeder.cancel()
+
+    yield json.dumps({"summary": {"files": len(saved), **counts, "session_id": session_id,
+                                  "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1)}}) + "\n"
+
 # ---------- COMPARE ----------
 @app.post("/compare")
 async def compare_documents(reference: UploadFile = File(...), actual: UploadFile = File(...)) -> Any:
@@ -71,9 +344,10 @@ async def compare_documents(reference: UploadFile = File(...), actual: UploadFil
         _ = ref_path, act_path
         combined_text = dc.combine_documents()
         comp = DocumentComparatorLLM()
-        df = comp.compare_documents(combined_text)
+        async with allm_slot("compare", combined_text):
+            df = await run_in_threadpool(comp.compare_documents, combined_text)
         return {"rows": df.to_dict(orient="records"), "session_id": dc.session_id}
-    except HTTPException:
+    except (HTTPException, LLMBusy):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Comparison failed: {e}")
@@ -84,11 +358,17 @@ async def chat_build_index(
     files: List[UploadFile] = File(...),
     session_id: Optional[str] = Form(None),
     use_session_dirs: bool = Form(True),
-    chunk_size: int = Form(1000),
-    chunk_overlap: int = Form(200),
+    chunk_size: Optional[int] = Form(None),     # characters; default: the configured chunker's size
+    chunk_overlap: Optional[int] = Form(None),
     k: int = Form(5),
 ) -> Any:
     try:
+        if chunk_size is not None and chunk_size <= 0:
+            raise HTTPException(status_code=400, detail="chunk_size must be positive")
+        if chunk_overlap is not None and (chunk_overlap < 0 or (chunk_size is not None and chunk_overlap >= chunk_size)):
+            raise HTTPException(status_code=400, detail="chunk_overlap must be >= 0 and smaller than chunk_size")
+        if session_id and not _valid_session_id(session_id):
+            raise HTTPException(status_code=400, detail=f"Invalid session id: {session_id}")
         wrapped = [FastAPIFileAdapter(f) for f in files]
         # this is my main class fro storing a data into VDB
         # created an object of ChatIngestor class
@@ -98,12 +378,19 @@ async def chat_build_index(
             use_session_dirs=use_session_dirs,
             session_id=session_id or None,
         )
+        replicator = get_replicator() if use_session_dirs else None
+        if replicator is not None and session_id:
+            # adding to a session indexed elsewhere: start from its snapshot, not an empty index
+            await run_in_threadpool(_pull_on_miss, ci.session_id, str(ci.faiss_dir))
         # NOTE: ensure your ChatIngestor saves with index_name="index" or FAISS_INDEX_NAME
         # e.g., if it calls FAISS.save_local(dir, index_name=FAISS_INDEX_NAME)
         ci.built_retriever(  # if your method name is actually build_retriever, fix it there as well
             wrapped, chunk_size=chunk_size, chunk_overlap=chunk_overlap, k=k
         )
-        return {"session_id": ci.session_id, "k": k, "use_session_dirs": use_session_dirs}
+        if replicator is not None:  # writes and fsyncs a whole snapshot: keep it off the event loop
+            await run_in_threadpool(replicator.publish_shared, ci.session_id, ci.faiss_dir,
+                                    index_name=FAISS_INDEX_NAME)
+        return {"session_id": ci.session_id, "k": k, "use_session_dirs": use_session_dirs, "chunking": ci.chunking}
     except HTTPException:
         raise
     except Exception as e:
@@ -114,33 +401,165 @@ async def chat_build_index(
 async def chat_query(
     question: str = Form(...),
     session_id: Optional[str] = Form(None),
+    session_ids: Optional[List[str]] = Form(None),  # repeat the field or comma-separate to search several sessions
     use_session_dirs: bool = Form(True),
-    k: int = Form(5),
+    k: Optional[int] = Form(None),                   # default: retriever.top_k
+    search_type: Optional[str] = Form(None),         # similarity | mmr | similarity_score_threshold
+    score_threshold: Optional[float] = Form(None),   # minimum cosine similarity of a chunk to the question
+    lambda_mult: Optional[float] = Form(None),       # mmr: 1 = relevance only, 0 = diversity only
+    adaptive_k: Optional[bool] = Form(None),         # stop before k once marginal relevance drops
 ) -> Any:
     try:
+        from src.document_chat.selection import SEARCH_TYPES
+
+        if search_type is not None and search_type not in SEARCH_TYPES:
+            raise HTTPException(status_code=400, detail=f"search_type must be one of {list(SEARCH_TYPES)}")
+        if lambda_mult is not None and not 0.0 <= lambda_mult <= 1.0:
+            raise HTTPException(status_code=400, detail="lambda_mult must be between 0 and 1")
+        if score_threshold is not None and not -1.0 <= score_threshold <= 1.0:
+            raise HTTPException(status_code=400, detail="score_threshold must be a cosine similarity in [-1, 1]")
+        if k is not None and k <= 0:
+            raise HTTPException(status_code=400, detail="k must be positive")
+        # federated and sharded searches merge plain top-k results: they cannot select chunks
+        selecting = search_type not in (None, "similarity") or adaptive_k \
+            or score_threshold is not None or lambda_mult is not None
+        k = k or (load_config().get("retriever") or {}).get("top_k", 5)
+        if session_ids:
+            if selecting:
+                raise HTTPException(status_code=400, detail="search_type, score_threshold, lambda_mult and "
+                                                            "adaptive_k are not supported with session_ids")
+            rag, ids = await run_in_threadpool(_federated_rag, session_id, session_ids, k)
+            async with allm_slot("chat", question):
+                response = await run_in_threadpool(rag.invoke, question, [])
+            return {
+                "answer": response,
+                "session_ids": ids,
+                "k": k,
+                "engine": "LCEL-RAG-federated",
+                "search_type": "similarity",
+                "search_latency_ms": rag.retriever.timings,
+            }
         if use_session_dirs and not session_id:
             raise HTTPException(status_code=400, detail="session_id is required when use_session_dirs=True")
 
         index_dir = os.path.join(FAISS_BASE, session_id) if use_session_dirs else FAISS_BASE  # type: ignore
+        if use_session_dirs:
+            await run_in_threadpool(_pull_on_miss, session_id, index_dir)
         if not os.path.isdir(index_dir):
             raise HTTPException(status_code=404, detail=f"FAISS index not found at: {index_dir}")
 
         rag = ConversationalRAG(session_id=session_id)
-        rag.load_retriever_from_faiss(index_dir, k=k, index_name=FAISS_INDEX_NAME)  # build retriever + chain
-        response = rag.invoke(question, chat_history=[])
+        sharded = ((load_config().get("retriever") or {}).get("sharded") or {}).get("enabled", False)
+        if not use_session_dirs and sharded:
+            if selecting:
+                raise HTTPException(status_code=400, detail="search_type, score_threshold, lambda_mult and "
+                                                            "adaptive_k are not supported by the sharded index")
+            # first use starts the shard processes (and splits the index): keep it off the event loop
+            await run_in_threadpool(rag.load_sharded_retriever, index_dir, k=k, index_name=FAISS_INDEX_NAME)
+        else:
+            selection = {"score_threshold": score_threshold, "lambda_mult": lambda_mult, "adaptive_k": adaptive_k}
+            rag.load_retriever_from_faiss(index_dir, k=k, index_name=FAISS_INDEX_NAME, search_type=search_type,
+                                          search_kwargs={key: v for key, v in selection.items() if v is not None}
+                                          )  # build retriever + chain
+        async with allm_slot("chat", question):
+            response = await run_in_threadpool(rag.invoke, question, [])
 
-        return {
+        out = {
             "answer": response,
             "session_id": session_id,
             "k": k,
             "engine": "LCEL-RAG"
         }
-    except HTTPException:
+        if hasattr(rag.retriever, "last_selected"):  # chunk selection modes: how many chunks reached the prompt
+            out.update(search_type=rag.retriever.search_type, chunks=rag.retriever.last_selected)
+        else:
+            out.update(search_type="similarity")
+        return out
+    except (HTTPException, LLMBusy):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Query failed: {e}")
 
 
+def _federated_rag(session_id: Optional[str], session_ids: List[str], k: int) -> Tuple[ConversationalRAG, List[str]]:
+    """RAG chain over several sessions (pulled on a miss) and the session ids it covers."""
+    ids: List[str] = []
+    for sid in ([session_id] if session_id else []) + session_ids:
+        for part in sid.split(","):
+            part = part.strip()
+            if part and part not in ids:
+                ids.append(part)
+    bad = [sid for sid in ids if not _valid_session_id(sid)]
+    if bad:
+        raise HTTPException(status_code=400, detail=f"Invalid session id(s): {', '.join(bad)}")
+    index_dirs = {sid: os.path.join(FAISS_BASE, sid) for sid in ids}
+    for sid, index_dir in index_dirs.items():
+        _pull_on_miss(sid, index_dir)
+    missing = [d for d in index_dirs.values() if not os.path.isdir(d)]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"FAISS index not found at: {', '.join(missing)}")
+
+    rag = ConversationalRAG(session_id=",".join(ids))
+    rag.load_federated_retriever(index_dirs, k=k, index_name=FAISS_INDEX_NAME)
+    return rag, ids
+
+
+def _valid_session_id(session_id: str) -> bool:
+    return bool(session_id) and os.path.basename(session_id) == session_id and session_id not in (".", "..")
+
+
+def _pull_on_miss(session_id: str, index_dir: str) -> None:
+    """Fetch a session indexed on another replica (if replication is on and it is missing here)."""
+    replicator = get_replicator()
+    if replicator is not None and _valid_session_id(session_id):
+        replicator.ensure_local(session_id, index_dir, index_name=FAISS_INDEX_NAME)
+
+
+# ---------- CHAT: SNAPSHOTS (replication between nodes) ----------
+def _replication_request(request: Request, session_id: str):
+    replicator = get_replicator()
+    if replicator is None:
+        raise HTTPException(status_code=404, detail="Index replication is disabled")
+    if replicator.token is None:  # imported index.pkl files are unpickled: never serve these routes openly
+        raise HTTPException(status_code=403, detail="Snapshot routes are disabled: REPLICATION_TOKEN is not set")
+    if not replicator.authorized(request.headers.get(TOKEN_HEADER)):
+        raise HTTPException(status_code=403, detail="Invalid replication token")
+    if not _valid_session_id(session_id):
+        raise HTTPException(status_code=400, detail=f"Invalid session id: {session_id}")
+    return replicator, os.path.join(FAISS_BASE, session_id)
+
+@app.get("/chat/snapshot/{session_id}")
+async def chat_export_snapshot(session_id: str, request: Request) -> StreamingResponse:
+    """Stream this node's live snapshot of a session (local only: never pulls from peers)."""
+    replicator, index_dir = _replication_request(request, session_id)
+    try:
+        export = await run_in_threadpool(replicator.export, index_dir, FAISS_INDEX_NAME)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"FAISS index not found at: {index_dir}")
+    return StreamingResponse(export.chunks(), media_type=SNAPSHOT_MEDIA_TYPE,
+                             headers={"ETag": f'"{export.digest}"', "X-Snapshot-Version": export.version},
+                             background=BackgroundTask(export.close))
+
+@app.put("/chat/snapshot/{session_id}")
+async def chat_import_snapshot(session_id: str, request: Request, replace: bool = True) -> Any:
+    """Import a snapshot stream (as produced by GET) as the session's next local version."""
+    replicator, index_dir = _replication_request(request, session_id)
+    imp = replicator.open_import(index_dir, FAISS_INDEX_NAME)
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await run_in_threadpool(imp.feed, chunk)
+        published = await run_in_threadpool(imp.commit, replace)
+    except SnapshotError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid snapshot: {e.error_message}")
+    finally:
+        imp.abort()  # no-op once committed
+    if not published:
+        raise HTTPException(status_code=409, detail=f"Session {session_id} already exists (use replace=true)")
+    return {"session_id": session_id, "version": imp.manifest.get("version"),
+            "files": len(imp.manifest["files"]), "bytes": imp.received}
+
+
 # command for executing the fast api
 # uvicorn api.main:app --reload    
 #uvicorn api.main:app --host 0.0.0.0 --port 8080 --reload
\ No newline at end of file
@@ -0,0 +1,99 @@
+"""
+Generated PDF / DOCX / TXT fixtures for the offline benchmarks.
+
+Content is produced from a seeded RNG so every run sees identical documents.
+"""
+from __future__ import annotations
+import random
+import zipfile
+from pathlib import Path
+from typing import List
+from xml.sax.saxutils import escape
+
+import fitz  # PyMuPDF
+
+_VOCAB = (
+    "contract policy revenue quarter customer invoice payment delivery warranty liability "
+    "insurance compliance audit report analysis model data portal document section clause "
+    "agreement party term notice schedule budget forecast risk control security access "
+    "review approval update version change request release system service support"
+).split()
+
+TOPICS = ["revenue", "warranty", "security", "audit", "delivery", "budget"]
+
+
+def make_paragraphs(n_pages: int, paras_per_page: int = 4, seed: int = 7) -> List[List[str]]:
+    """Return pages -> paragraphs of pseudo-random but reproducible prose."""
+    rng = random.Random(seed)
+    pages = []
+    for p in range(n_pages):
+        topic = TOPICS[p % len(TOPICS)]
+        paras = []
+        for _ in range(paras_per_page):
+            words = [rng.choice(_VOCAB) for _ in range(rng.randint(40, 80))]
+            words.insert(rng.randint(0, len(words)), topic)
+            paras.append(" ".join(words).capitalize() + ".")
+        pages.append(paras)
+    return pages
+
+
+def write_txt(path: Path, pages: List[List[str]]) -> Path:
+    path.write_text("\n\n".join("\n\n".join(p) for p in pages), encoding="utf-8")
+    return path
+
+
+def write_pdf(path: Path, pages: List[List[str]]) -> Path:
+    doc = fitz.open()
+    for paras in pages:
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(50, 50, 550, 800), "\n\n".join(paras), fontsize=9)
+    doc.save(str(path))
+    doc.close()
+    return path
+
+
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    '</Relationships>'
+)
+
+
+def write_docx(path: Path, pages: List[List[str]]) -> Path:
+    """Minimal WordprocessingML package (enough for docx2txt); pages become page breaks."""
+    body = []
+    for i, paras in enumerate(pages):
+        if i:
+            body.append('<w:p><w:r><w:br w:type="page"/></w:r></w:p>')
+        body.extend(f"<w:p><w:r><w:t>{escape(t)}</w:t></w:r></w:p>" for t in paras)
+    document = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+        f"<w:body>{''.join(body)}</w:body></w:document>"
+    )
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("[Content_Types].xml", _CONTENT_TYPES)
+        z.writestr("_rels/.rels", _RELS)
+        z.writestr("word/document.xml", document)
+    return path
+
+
+WRITERS = {".pdf": write_pdf, ".docx": write_docx, ".txt": write_txt}
+
+
+def make_fixture(directory: Path, ext: str, n_pages: int, seed: int = 7) -> Path:
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"fixture_{n_pages}p{ext}"
+    return WRITERS[ext](path, make_paragraphs(n_pages, seed=seed))
@@ -0,0 +1,280 @@
+"""
+Replay recorded API traffic (utils/traffic_recorder.py) as a load test.
+
+By default a fresh local instance is started on offline stand-in models with empty
+data/ and faiss_index/ dirs, so runs are repeatable. --url targets a running instance
+instead. Requests keep their recorded order and spacing, compressed by --speedup
+(0 = fire as fast as --concurrency allows). Session ids created by replayed
+/chat/index (or /compare) calls are substituted into later requests that referred
+to the recorded ones, and those requests wait until their session exists.
+
+Uploads come from the recording's blob store when payloads were kept. Otherwise a
+fixture document of the same type and roughly the same size is generated.
+
+Usage:
+    python -m benchmarks.replay traffic/requests.jsonl
+    python -m benchmarks.replay traffic/requests.jsonl --speedup 10 --concurrency 16 --out bench_results/replay.json
+    python -m benchmarks.replay traffic/requests.jsonl --speedup 0 --url http://127.0.0.1:8080
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import httpx
+
+from benchmarks.fixtures import make_fixture
+from benchmarks.run_benchmarks import summarize
+from benchmarks.stand_ins import OFFLINE_ENV
+from benchmarks.startup import _free_port
+from utils.traffic_recorder import BlobStore, read_records
+
+SESSION_FIELDS = ("session_id", "session_ids")
+BYTES_PER_PAGE = {".pdf": 1250, ".txt": 1900, ".docx": 400}  # benchmarks.fixtures output, measured
+MAX_SYNTH_PAGES = 200
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+class Payloads:
+    """Upload/body bytes by sha256: recorded blobs first, synthesized stand-ins otherwise."""
+
+    def __init__(self, blob_dir: Optional[Path], scratch: Path):
+        self.blobs = BlobStore(blob_dir) if blob_dir and Path(blob_dir).is_dir() else None
+        self.scratch = scratch
+        self._cache: Dict[str, bytes] = {}
+        self.recorded = self.synthesized = 0
+
+    def get(self, meta: Dict[str, Any]) -> bytes:
+        sha = meta.get("sha256") or ""
+        if sha in self._cache:
+            return self._cache[sha]
+        data = self.blobs.get(sha) if self.blobs is not None and sha else None
+        if data is not None:
+            self.recorded += 1
+        else:
+            data = self._synthesize(meta)
+            self.synthesized += 1
+        self._cache[sha] = data
+        return data
+
+    def _synthesize(self, meta: Dict[str, Any]) -> bytes:
+        size = int(meta.get("size") or 0)
+        seed = int((meta.get("sha256") or "0")[:8], 16)
+        ext = os.path.splitext(meta.get("filename") or "")[1].lower()
+        if ext in BYTES_PER_PAGE:
+            pages = max(1, min(MAX_SYNTH_PAGES, round(size / BYTES_PER_PAGE[ext])))
+            return make_fixture(self.scratch / f"{seed:08x}", ext, pages, seed=seed).read_bytes()
+        return random.Random(seed).randbytes(size)
+
+
+def _endpoint(record: Dict[str, Any]) -> str:
+    return f"{record['method']} {record.get('route') or record['path']}"
+
+
+def _session_refs(form: Dict[str, Any]) -> List[str]:
+    refs = []
+    for field in SESSION_FIELDS:
+        values = form.get(field)
+        for value in values if isinstance(values, list) else [values] if values else []:
+            refs.extend(v.strip() for v in value.split(",") if v.strip())
+    return refs
+
+
+def _map_sessions(form: Dict[str, Any], sessions: Dict[str, str]) -> Dict[str, Any]:
+    def sub(value: str) -> str:
+        return ",".join(sessions.get(v.strip(), v.strip()) for v in value.split(","))
+
+    out = dict(form)
+    for field in SESSION_FIELDS:
+        if field in out:
+            out[field] = [sub(v) for v in out[field]] if isinstance(out[field], list) else sub(out[field])
+    return out
+
+
+async def replay(records: List[Dict[str, Any]], base_url: str, payloads: Payloads, speedup: float = 1.0,
+                 concurrency: int = 8, timeout_s: float = 300.0, transport=None) -> Dict[str, Any]:
+    """
+    Re-issue `records` against `base_url` (or an in-process `transport`, e.g.
+    httpx.ASGITransport); returns per-endpoint latency, throughput and errors.
+    """
+    loop = asyncio.get_running_loop()
+    skipped = sum(1 for r in records if r.get("oversized"))
+    records = [r for r in records if not r.get("oversized")]  # body was not captured
+    producers: Dict[str, int] = {}  # recorded session id -> first request that created it
+    for i, r in enumerate(records):
+        sid = (r.get("response") or {}).get("session_id")
+        if sid:
+            producers.setdefault(sid, i)
+    created = {sid: asyncio.Event() for sid in producers}
+    sessions: Dict[str, str] = {}
+    unmapped: set = set()
+    results: List[Tuple[str, Optional[int], float, float, Optional[float]]] = []
+    gate = asyncio.Semaphore(max(1, concurrency))
+    t0_recorded = records[0].get("ts", 0) if records else 0
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout_s, transport=transport) as client:
+        start = loop.time()
+
+        async def one(i: int, record: Dict[str, Any]) -> None:
+            produced = (record.get("response") or {}).get("session_id")
+            produces = bool(produced) and producers[produced] == i
+            try:
+                if speedup > 0:
+                    due = start + (record.get("ts", t0_recorded) - t0_recorded) / speedup
+                    await asyncio.sleep(max(0.0, due - loop.time()))
+                form = record.get("form") or {}
+                for ref in _session_refs(form):
+                    if producers.get(ref, i) < i:
+                        await created[ref].wait()
+                    elif ref not in producers:
+                        unmapped.add(ref)
+                kwargs: Dict[str, Any] = {}
+                if record.get("files"):
+                    kwargs["files"] = [(f["field"], (f.get("filename") or "upload", payloads.get(f),
+                                                     f.get("content_type") or "application/octet-stream"))
+                                       for f in record["files"]]
+                if form:
+                    kwargs["data"] = _map_sessions(form, sessions)
+                elif record.get("body"):
+                    kwargs["content"] = payloads.get(record["body"])
+                    kwargs["headers"] = {"content-type": record.get("content_type") or "application/octet-stream"}
+                url = record["path"] + (f"?{record['query']}" if record.get("query") else "")
+                status, body = None, b""
+                async with gate:
+                    t = time.perf_counter()
+                    try:
+                        resp = await client.request(record["method"], url, **kwargs)
+                        status, body = resp.status_code, resp.content  # streamed bodies are read to the end
+                    except httpx.HTTPError:
+                        pass
+                    latency = time.perf_counter() - t
+                recorded = record.get("latency_ms")
+                results.append((_endpoint(record), status, latency, loop.time() - start, recorded))
+                if produces:
+                    with contextlib.suppress(ValueError, AttributeError, KeyError):
+                        sessions[produced] = json.loads(body)["session_id"]
+            finally:
+                if produces:  # also on failure: dependents still run, against the recorded id
+                    created[produced].set()
+
+        await asyncio.gather(*(one(i, r) for i, r in enumerate(records)))
+        wall = loop.time() - start
+
+    return report(results, wall, speedup, concurrency, payloads, unmapped, skipped)
+
+
+def report(results, wall: float, speedup: float, concurrency: int, payloads: Payloads, unmapped,
+           skipped: int = 0) -> Dict[str, Any]:
+    by_endpoint: Dict[str, List] = {}
+    for row in results:
+        by_endpoint.setdefault(row[0], []).append(row)
+
+    def stats(rows: List) -> Dict[str, Any]:
+        errors = sum(1 for _, status, *_ in rows if status is None or status >= 400)
+        recorded = [r[4] / 1000 for r in rows if r[4] is not None]
+        return {**summarize([r[2] for r in rows]), "throughput_rps": round(len(rows) / wall, 3) if wall else None,
+                "errors": errors, "error_rate": round(errors / len(rows), 4),
+                "statuses": {str(s): sum(1 for r in rows if r[1] == s) for s in sorted({r[1] for r in rows}, key=str)},
+                "recorded_p50_ms": summarize(recorded)["p50_ms"] if recorded else None}
+
+    return {"requests": len(results), "skipped_oversized": skipped, "wall_s": round(wall, 3),
+            "speedup": speedup, "concurrency": concurrency,
+            "payloads": {"recorded": payloads.recorded, "synthesized": payloads.synthesized},
+            "unmapped_sessions": sorted(unmapped),
+            "overall": stats(results) if results else None,
+            "endpoints": {ep: stats(rows) for ep, rows in sorted(by_endpoint.items())}}
+
+
+@contextlib.contextmanager
+def serve_offline(work: Path, timeout_s: float = 60.0) -> Iterator[str]:
+    """uvicorn on offline stand-in models with empty data dirs under `work`; yields its base URL."""
+    port = _free_port()
+    env = {**os.environ, **OFFLINE_ENV, "FAISS_BASE": str(work / "faiss_index"), "UPLOAD_BASE": str(work / "data"),
+           "DATA_STORAGE_PATH": str(work / "document_analysis"), "TEXT_CACHE_DIR": str(work / "text_cache"),
+           "TRAFFIC_RECORDING": "0"}
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        env=env, cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.perf_counter() + timeout_s
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with code {proc.returncode} before becoming ready")
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"app not ready after {timeout_s}s")
+            try:
+                with urllib.request.urlopen(f"{base}/health", timeout=0.5) as r:
+                    if r.status == 200:
+                        break
+            except OSError:
+                time.sleep(0.05)
+        yield base
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def run(log_path, url: Optional[str] = None, blob_dir=None, speedup: float = 1.0, concurrency: int = 8,
+        limit: Optional[int] = None, timeout_s: float = 300.0) -> Dict[str, Any]:
+    records = read_records(log_path)[:limit]
+    if not records:
+        raise ValueError(f"No recorded requests in {log_path}")
+    blob_dir = Path(blob_dir) if blob_dir else Path(log_path).parent / "blobs"
+    with tempfile.TemporaryDirectory(prefix="docportal_replay_") as tmp:
+        work = Path(tmp)
+        payloads = Payloads(blob_dir, work / "synth")
+        with contextlib.ExitStack() as stack:
+            base = url or stack.enter_context(serve_offline(work))
+            result = asyncio.run(replay(records, base, payloads, speedup, concurrency, timeout_s))
+    result["source"] = {"log": str(log_path), "target": url or "local offline instance",
+                        "sha256": hashlib.sha256(Path(log_path).read_bytes()).hexdigest()[:16]}
+    return result
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Replay recorded API traffic and report latency per endpoint")
+    ap.add_argument("log", help="JSONL written by the traffic recorder")
+    ap.add_argument("--url", default=None, help="target instance (default: start a local offline one)")
+    ap.add_argument("--blob-dir", default=None, help="recorded payloads (default: <log dir>/blobs)")
+    ap.add_argument("--speedup", type=float, default=1.0, help="compress recorded spacing; 0 = no pacing")
+    ap.add_argument("--concurrency", type=int, default=8, help="max requests in flight")
+    ap.add_argument("--limit", type=int, default=None, help="replay only the first N requests")
+    ap.add_argument("--timeout", type=float, default=300.0, help="per-request timeout in seconds")
+    ap.add_argument("--out", default=None, help="optional JSON output path")
+    args = ap.parse_args(argv)
+
+    result = run(args.log, url=args.url, blob_dir=args.blob_dir, speedup=args.speedup,
+                 concurrency=args.concurrency, limit=args.limit, timeout_s=args.timeout)
+    print(f"{result['requests']} requests in {result['wall_s']:.2f}s "
+          f"(speedup {result['speedup']}, concurrency {result['concurrency']})")
+    print(f"{'endpoint':<28}{'n':>6}{'rps':>9}{'p50':>10}{'p95':>10}{'p99':>10}{'err%':>7}{'rec p50':>10}")
+    for ep, s in result["endpoints"].items():
+        rec = f"{s['recorded_p50_ms']:.1f}" if s["recorded_p50_ms"] is not None else "-"
+        print(f"{ep:<28}{s['n']:>6}{s['throughput_rps']:>9.2f}{s['p50_ms']:>10.1f}{s['p95_ms']:>10.1f}"
+              f"{s['p99_ms']:>10.1f}{s['error_rate'] * 100:>7.1f}{rec:>10}")
+    if result["skipped_oversized"]:
+        print(f"note: {result['skipped_oversized']} request(s) over max_body_bytes were recorded without payload and skipped")
+    if result["unmapped_sessions"]:
+        print(f"note: {len(result['unmapped_sessions'])} session id(s) were not created within the recording and were sent as recorded")
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.out).write_text(json.dumps(result, indent=2), encoding="utf-8")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
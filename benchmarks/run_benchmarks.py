@@ -0,0 +1,459 @@
+"""
+Offline performance benchmarks for ingestion, indexing, retrieval and the chat endpoints.
+
+Runs entirely without network: models are the local providers selected via
+benchmarks.stand_ins and documents come from benchmarks.fixtures. Results are written as JSON so releases can be compared.
+
+Usage:
+    python -m benchmarks.run_benchmarks --pages 5,20,80 --out bench_results/run.json
+    python -m benchmarks.run_benchmarks --baseline bench_results/previous.json
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from benchmarks.fixtures import make_fixture, TOPICS
+from benchmarks.stand_ins import offline_models
+
+FORMATS = (".pdf", ".docx", ".txt")
+SPLIT_STRATEGIES = ("recursive", "structured")
+QUERIES = [f"What does the document say about {t}?" for t in TOPICS]
+
+
+def summarize(samples: Sequence[float]) -> Dict[str, float]:
+    """Latency summary in milliseconds."""
+    a = np.asarray(samples, dtype=float) * 1000.0
+    return {
+        "n": int(a.size),
+        "mean_ms": round(float(a.mean()), 3),
+        "p50_ms": round(float(np.percentile(a, 50)), 3),
+        "p95_ms": round(float(np.percentile(a, 95)), 3),
+        "p99_ms": round(float(np.percentile(a, 99)), 3),
+        "max_ms": round(float(a.max()), 3),
+    }
+
+
+def _time(fn: Callable[[], Any]) -> tuple[float, Any]:
+    t0 = time.perf_counter()
+    out = fn()
+    return time.perf_counter() - t0, out
+
+
+# ---------- individual benchmarks ----------
+def bench_load_documents(fixtures: Dict[str, Dict[int, Path]], repeats: int,
+                         text_cache: Optional[Path] = None) -> List[Dict[str, Any]]:
+    """`seconds` is a cold parse; for PDFs `cached_seconds` is a hit in the extracted-text cache."""
+    from utils.document_ops import load_documents
+
+    def clear_cache() -> None:
+        if text_cache is not None:
+            shutil.rmtree(text_cache, ignore_errors=True)
+
+    rows = []
+    for ext, by_pages in fixtures.items():
+        for pages, path in by_pages.items():
+            load_documents([path])  # warm-up: first parse pays for lazy imports/font caches
+            samples = []
+            for _ in range(repeats):
+                clear_cache()
+                dt, docs = _time(lambda: load_documents([path]))
+                samples.append(dt)
+            best = min(samples)
+            row = {
+                "format": ext, "pages": pages, "docs": len(docs),
+                "bytes": path.stat().st_size,
+                "seconds": round(best, 5), "pages_per_s": round(pages / best, 1),
+            }
+            if ext == ".pdf" and text_cache is not None:
+                row["cached_seconds"] = round(min(_time(lambda: load_documents([path]))[0] for _ in range(repeats)), 5)
+            rows.append(row)
+    return rows
+
+
+def bench_split(docs_by_pages: Dict[int, list], work: Path, repeats: int,
+                chunk_size: int = 1000, chunk_overlap: int = 200) -> List[Dict[str, Any]]:
+    from src.document_ingestion.data_ingestion import ChatIngestor
+
+    ci = ChatIngestor(temp_base=str(work / "split_data"), faiss_base=str(work / "split_faiss"), use_session_dirs=False)
+    rows = []
+    for strategy in SPLIT_STRATEGIES:
+        for pages, docs in docs_by_pages.items():
+            chars = sum(len(d.page_content) for d in docs)
+            # character sizes only apply to the recursive splitter; structured uses its configured tokens
+            split_args = (chunk_size, chunk_overlap) if strategy == "recursive" else (None, None)
+            samples = []
+            for _ in range(repeats):
+                dt, chunks = _time(lambda: ci._split(docs, *split_args, strategy=strategy))
+                samples.append(dt)
+            best = min(samples)
+            sizes = [len(c.page_content) for c in chunks]
+            rows.append({
+                "strategy": strategy, "pages": pages, "chars": chars, "chunks": len(chunks),
+                "mean_chunk_chars": round(sum(sizes) / len(sizes), 1), "max_chunk_chars": max(sizes),
+                "seconds": round(best, 5), "chars_per_s": round(chars / best, 1),
+                "chunks_per_s": round(len(chunks) / best, 1),
+            })
+    return rows
+
+
+def bench_faiss(chunks: list, work: Path) -> Dict[str, Any]:
+    from src.document_ingestion.data_ingestion import FaissManager
+
+    half = len(chunks) // 2
+    first, second = chunks[:half], chunks[half:]
+    index_dir = work / "faiss_bench"
+
+    fm = FaissManager(index_dir)
+    build_s, _ = _time(lambda: fm.load_or_create([c.page_content for c in first], [c.metadata for c in first]))
+    fm.add_documents(first)  # records fingerprints of the seed batch, as ChatIngestor does
+    add_s, added = _time(lambda: fm.add_documents(second))
+
+    fm2 = FaissManager(index_dir)
+    load_s, vs = _time(fm2.load_or_create)
+    return {
+        "chunks": len(chunks),
+        "build_s": round(build_s, 5), "build_chunks": len(first),
+        "add_s": round(add_s, 5), "added": added,
+        "load_s": round(load_s, 5),
+        "vectors": int(vs.index.ntotal),
+    }
+
+
+def bench_retrieval(index_dir: Path, k: int, repeats: int) -> Dict[str, Any]:
+    from src.document_chat.retrieval import ConversationalRAG
+
+    rag = ConversationalRAG(session_id="bench")
+    retriever = rag.load_retriever_from_faiss(str(index_dir), k=k)
+    samples = []
+    for i in range(repeats):
+        q = QUERIES[i % len(QUERIES)]
+        dt, _ = _time(lambda: retriever.invoke(q))
+        samples.append(dt)
+    return {"k": k, **summarize(samples)}
+
+
+def bench_hierarchical(k: int, n_docs: int = 400, chunks_per_doc: int = 50, dim: int = 256,
+                       queries: int = 200, top_docs: Sequence[int] = (4, 8, 16), seed: int = 0) -> Dict[str, Any]:
+    """Recall@k and latency of coarse-to-fine search against exact flat search.
+
+    Synthetic corpus: documents are grouped under shared themes (so several documents
+    compete for a query), each has a few sub-topics, chunks are noisy sub-topic
+    samples and queries are perturbed chunks.
+    """
+    from langchain_community.vectorstores import FAISS
+    from src.document_chat.hierarchical import HierarchicalRetriever
+    from utils.coarse_index import CoarseIndex
+    from utils.local_models import HashingEmbeddings
+
+    rng = np.random.default_rng(seed)
+    themes = rng.normal(size=(max(1, n_docs // 10), dim))
+    topics = themes[rng.integers(0, themes.shape[0], n_docs)] + 0.7 * rng.normal(size=(n_docs, dim))
+    subtopics = topics[:, None, :] + 0.7 * rng.normal(size=(n_docs, 4, dim))
+    owner = np.repeat(np.arange(n_docs), chunks_per_doc)
+    vectors = (subtopics[owner, rng.integers(0, 4, owner.size)] + 1.2 * rng.normal(size=(owner.size, dim)))
+    vectors = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+    store = FAISS.from_embeddings(
+        [(f"chunk {i}", v.tolist()) for i, v in enumerate(vectors)], HashingEmbeddings(dimensions=dim),
+        metadatas=[{"source": f"doc_{d}.pdf", "row": i} for i, d in enumerate(owner)],
+    )
+    coarse = CoarseIndex.build(store)
+    picks = rng.integers(0, vectors.shape[0], queries)
+    qs = vectors[picks] + 0.1 * rng.normal(size=(queries, dim)).astype(np.float32)
+
+    flat_samples, truth = [], []
+    for q in qs:
+        dt, hits = _time(lambda: store.similarity_search_by_vector(q.tolist(), k=k))
+        flat_samples.append(dt)
+        truth.append({d.metadata["row"] for d in hits})
+
+    rows = []
+    for n in top_docs:
+        retriever = HierarchicalRetriever(store=store, coarse=coarse, k=k, top_docs=n)
+        samples, recall = [], []
+        for q, expected in zip(qs, truth):
+            dt, hits = _time(lambda: retriever.search_by_vector(q.tolist()))
+            samples.append(dt)
+            recall.append(len(expected & {d.metadata["row"] for d in hits}) / len(expected))
+        rows.append({"top_docs": n, "recall_at_k": round(float(np.mean(recall)), 4),
+                     "searched_fraction": round(n / n_docs, 4), **summarize(samples)})
+    return {"docs": n_docs, "chunks": int(vectors.shape[0]), "k": k,
+            "flat": summarize(flat_samples), "hierarchical": rows}
+
+
+def bench_sharded(work: Path, k: int, n_chunks: int = 100_000, dim: int = 256, shards: Sequence[int] = (1, 2, 4),
+                  queries: int = 200, concurrency: int = 8, seed: int = 0) -> Dict[str, Any]:
+    """Scatter-gather search over shard processes against in-process flat search.
+
+    Reports single-query latency, throughput with `concurrency` client threads, the
+    fraction of queries whose top-k equals the flat top-k, and how many chunks each
+    step's rebalancing moved (shards are added one step at a time).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from langchain_community.vectorstores import FAISS
+    from src.document_chat.sharded import ShardedSearch
+    from utils.index_snapshots import SnapshotStore
+    from utils.local_models import HashingEmbeddings
+
+    rng = np.random.default_rng(seed)
+    vectors = rng.normal(size=(n_chunks, dim)).astype(np.float32)
+    store = FAISS.from_embeddings([(f"chunk {i}", v) for i, v in enumerate(vectors)],
+                                  HashingEmbeddings(dimensions=dim), metadatas=[{"row": i} for i in range(n_chunks)])
+    snapshots = SnapshotStore(work / "sharded_index")
+    with snapshots.write_lock():
+        staged = snapshots.stage()
+        store.save_local(str(staged))
+        snapshots.publish(staged)
+    qs = rng.normal(size=(queries, dim)).astype(np.float32)
+
+    def measure(search_one: Callable[[np.ndarray], List[int]]) -> Dict[str, Any]:
+        samples, results = [], []
+        for q in qs:
+            dt, rows = _time(lambda: search_one(q))
+            samples.append(dt)
+            results.append(rows)
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            t0 = time.perf_counter()
+            list(pool.map(search_one, qs))
+            qps = len(qs) / (time.perf_counter() - t0)
+        return {"results": results, "qps": round(qps, 1), **summarize(samples)}
+
+    flat = measure(lambda q: [d.metadata["row"] for d, _ in store.similarity_search_with_score_by_vector(q, k=k)])
+    truth = flat.pop("results")
+    rows = []
+    search = ShardedSearch(work / "sharded_index", n_shards=shards[0], timeout_s=300).start()
+    try:
+        moved = 0
+        for n in shards:
+            if n > search.n_shards:
+                moved = search.add_shards(n - search.n_shards)["moved"]
+            stats = measure(lambda q: [h[3]["row"] for h in search.search_by_vector(q, k)])
+            exact = np.mean([a == b for a, b in zip(stats.pop("results"), truth)])
+            rows.append({"shards": n, "moved_on_rebalance": moved, "exact_match": round(float(exact), 4), **stats})
+    finally:
+        search.close()
+    return {"chunks": n_chunks, "dim": dim, "k": k, "concurrency": concurrency, "cpus": os.cpu_count(),
+            "flat": flat, "sharded": rows}
+
+
+def bench_selection(k: int = 10, n_docs: int = 100, chunks_per_doc: int = 20, copies: int = 4, dim: int = 256,
+                    queries: int = 200, fetch_k: int = 40, seed: int = 0) -> Dict[str, Any]:
+    """Chunk selection modes against plain top-k on a corpus with near-duplicate chunks.
+
+    Documents share themes, queries are about one or two chunks of a document, and every chunk
+    exists in `copies` near-identical variants (overlapping windows, repeated
+    boilerplate), so plain top-k spends most of its slots on copies. Per mode:
+    chunks returned, distinct chunks among them, recall of the chunks the query is about,
+    redundancy (mean max cosine between returned chunks), context characters handed to
+    the LLM and retrieval latency.
+    MMR picks are checked against LangChain's max_marginal_relevance_search.
+    """
+    from langchain_community.vectorstores import FAISS
+    from src.document_chat.selection import SelectiveRetriever
+    from utils.local_models import HashingEmbeddings
+
+    rng = np.random.default_rng(seed)
+    themes = rng.normal(size=(max(1, n_docs // 10), dim))
+    topics = themes[rng.integers(0, themes.shape[0], n_docs)] + 0.8 * rng.normal(size=(n_docs, dim))
+    originals = np.repeat(topics, chunks_per_doc, axis=0) + 1.2 * rng.normal(size=(n_docs * chunks_per_doc, dim))
+    owner = np.repeat(np.arange(originals.shape[0]), copies)
+    vectors = originals[owner] + 0.15 * rng.normal(size=(owner.size, dim))
+    vectors = (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+    embeddings = HashingEmbeddings(dimensions=dim)
+    store = FAISS.from_embeddings([(f"chunk {o} " + "x" * 800, v) for o, v in zip(owner, vectors)], embeddings,
+                                  metadatas=[{"row": i, "original": int(o)} for i, o in enumerate(owner)])
+    # each query is about one or two chunks of a document (their neighbours in it are related, but less so)
+    doc = rng.integers(0, n_docs, queries)
+    picks = doc[:, None] * chunks_per_doc + rng.integers(0, chunks_per_doc, (queries, 2))
+    two = rng.random(queries) < 0.5
+    qs = originals[picks[:, 0]] + two[:, None] * originals[picks[:, 1]] + 1.0 * rng.normal(size=(queries, dim))
+    targets = [{int(a), int(b)} if t else {int(a)} for (a, b), t in zip(picks, two)]
+    qs = qs.astype(np.float32)
+
+    def measure(search_one: Callable[[np.ndarray], list]) -> Dict[str, Any]:
+        samples, returned, distinct, recall, redundancy, chars, picks = [], [], [], [], [], [], []
+        for q, target in zip(qs, targets):
+            dt, docs = _time(lambda: search_one(q))
+            samples.append(dt)
+            rows = [d.metadata["row"] for d in docs]
+            picks.append(rows)
+            returned.append(len(rows))
+            originals_hit = {d.metadata["original"] for d in docs}
+            distinct.append(len(originals_hit))
+            recall.append(len(target & originals_hit) / len(target))
+            chars.append(sum(len(d.page_content) for d in docs))
+            if len(rows) > 1:
+                sims = vectors[rows] @ vectors[rows].T
+                np.fill_diagonal(sims, -1.0)
+                redundancy.append(float(sims.max(axis=1).mean()))
+        return {"picks": picks, "chunks": round(float(np.mean(returned)), 2),
+                "distinct": round(float(np.mean(distinct)), 2), "target_recall": round(float(np.mean(recall)), 4),
+                "redundancy": round(float(np.mean(redundancy)), 4) if redundancy else None,
+                "context_chars": round(float(np.mean(chars)), 1), **summarize(samples)}
+
+    modes = {
+        "similarity": {"search_type": "similarity"},
+        "similarity_adaptive": {"search_type": "similarity", "adaptive_k": True, "min_k": 2, "min_ratio": 0.6},
+        "score_threshold": {"search_type": "similarity_score_threshold", "score_threshold": 0.3},
+        "mmr": {"search_type": "mmr", "lambda_mult": 0.5},
+        "mmr_adaptive": {"search_type": "mmr", "lambda_mult": 0.5, "adaptive_k": True, "min_k": 2, "min_ratio": 0.6},
+    }
+    rows = {"similarity_top_k": measure(lambda q: store.similarity_search_by_vector(q.tolist(), k=k))}
+    for name, options in modes.items():
+        retriever = SelectiveRetriever(store=store, embeddings=embeddings, k=k, fetch_k=fetch_k, **options)
+        rows[name] = measure(lambda q: retriever.search_by_vector(q.tolist()))
+    rows["langchain_mmr"] = measure(lambda q: store.max_marginal_relevance_search_by_vector(
+        q.tolist(), k=k, fetch_k=fetch_k, lambda_mult=0.5))
+    same = np.mean([a == b for a, b in zip(rows["mmr"]["picks"], rows["langchain_mmr"]["picks"])])
+    for row in rows.values():
+        row.pop("picks")
+    return {"chunks": int(owner.size), "copies": copies, "k": k, "fetch_k": fetch_k,
+            "mmr_matches_langchain": round(float(same), 4), "modes": rows}
+
+
+def bench_endpoints(fixture: Path, work: Path, repeats: int, k: int) -> Dict[str, Any]:
+    from fastapi.testclient import TestClient
+    import api.main as api_main
+
+    saved_bases = api_main.UPLOAD_BASE, api_main.FAISS_BASE
+    api_main.UPLOAD_BASE = str(work / "api_data")
+    api_main.FAISS_BASE = str(work / "api_faiss")
+    try:
+        return _bench_endpoints(TestClient(api_main.app), fixture, repeats, k)
+    finally:
+        api_main.UPLOAD_BASE, api_main.FAISS_BASE = saved_bases
+
+
+def _bench_endpoints(client, fixture: Path, repeats: int, k: int) -> Dict[str, Any]:
+    index_samples, session_id = [], None
+    for _ in range(max(1, repeats // 5)):
+        with open(fixture, "rb") as fh:
+            dt, resp = _time(lambda: client.post(
+                "/chat/index",
+                files=[("files", (fixture.name, fh, "application/pdf"))],
+                data={"k": str(k)},
+            ))
+        resp.raise_for_status()
+        session_id = resp.json()["session_id"]
+        index_samples.append(dt)
+
+    query_samples = []
+    for i in range(repeats):
+        q = QUERIES[i % len(QUERIES)]
+        dt, resp = _time(lambda: client.post(
+            "/chat/query", data={"question": q, "session_id": session_id, "k": str(k)}
+        ))
+        resp.raise_for_status()
+        query_samples.append(dt)
+
+    return {
+        "fixture_pages": int(fixture.stem.split("_")[1].rstrip("p")),
+        "chat_index": summarize(index_samples),
+        "chat_query": summarize(query_samples),
+    }
+
+
+# ---------- orchestration ----------
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+
+def run(pages: Sequence[int], repeats: int = 20, k: int = 5, shard_chunks: int = 100_000) -> Dict[str, Any]:
+    from utils.document_ops import load_documents
+
+    with tempfile.TemporaryDirectory(prefix="docportal_bench_") as tmp, \
+            offline_models(TEXT_CACHE_DIR=str(Path(tmp) / "text_cache")):
+        work = Path(tmp)
+        fixtures = {ext: {n: make_fixture(work / "fixtures", ext, n) for n in pages} for ext in FORMATS}
+
+        results: Dict[str, Any] = {}
+        results["load_documents"] = bench_load_documents(fixtures, repeats=max(3, repeats // 5),
+                                                         text_cache=work / "text_cache")
+
+        pdf_docs = {n: load_documents([p]) for n, p in fixtures[".pdf"].items()}
+        results["split"] = bench_split(pdf_docs, work, repeats=max(3, repeats // 5))
+
+        largest = max(pages)
+        from src.document_ingestion.data_ingestion import ChatIngestor
+        ci = ChatIngestor(temp_base=str(work / "d"), faiss_base=str(work / "f"), use_session_dirs=False)
+        chunks = ci._split(pdf_docs[largest])
+        results["faiss"] = bench_faiss(chunks, work)
+        results["retrieval"] = bench_retrieval(work / "faiss_bench", k=k, repeats=repeats)
+        results["hierarchical"] = bench_hierarchical(k=k)
+        results["sharded"] = bench_sharded(work, k=k, n_chunks=shard_chunks)
+        results["selection"] = bench_selection()
+        results["endpoints"] = bench_endpoints(fixtures[".pdf"][largest], work, repeats=repeats, k=k)
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pages": list(pages),
+            "repeats": repeats,
+        },
+        "results": results,
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """Human-readable deltas for the headline latency numbers (positive = slower)."""
+    lines = []
+
+    def _delta(label: str, new: float, old: float) -> None:
+        if old:
+            lines.append(f"{label:<32} {old:>10.3f} -> {new:>10.3f}  ({(new - old) / old * 100:+.1f}%)")
+
+    cur, base = current["results"], baseline["results"]
+    for key in ("build_s", "add_s", "load_s"):
+        _delta(f"faiss.{key}", cur["faiss"][key], base["faiss"][key])
+    for key in ("p50_ms", "p99_ms"):
+        _delta(f"retrieval.{key}", cur["retrieval"][key], base["retrieval"][key])
+        for ep in ("chat_index", "chat_query"):
+            _delta(f"{ep}.{key}", cur["endpoints"][ep][key], base["endpoints"][ep][key])
+    return lines
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Offline Document Portal benchmarks")
+    ap.add_argument("--pages", default="5,20,80", help="comma separated fixture sizes (pages)")
+    ap.add_argument("--repeats", type=int, default=20)
+    ap.add_argument("--k", type=int, default=5)
+    ap.add_argument("--shard-chunks", type=int, default=100_000, help="synthetic corpus size for the sharded benchmark")
+    ap.add_argument("--out", default=None, help="JSON output path (default: bench_results/<timestamp>.json)")
+    ap.add_argument("--baseline", default=None, help="previous JSON result to compare against")
+    args = ap.parse_args(argv)
+
+    pages = sorted({int(p) for p in args.pages.split(",") if p.strip()})
+    report = run(pages, repeats=args.repeats, k=args.k, shard_chunks=args.shard_chunks)
+
+    out = Path(args.out or f"bench_results/{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"Benchmark results written to {out}")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        print("\n".join(compare(report, baseline)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
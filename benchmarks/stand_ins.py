@@ -0,0 +1,27 @@
+"""
+Deterministic, network-free model selection for benchmarks and tests.
+
+`offline_models()` points ModelLoader at the local providers (utils/local_models.py)
+for the duration of a run, so every component (ChatIngestor, FaissManager,
+ConversationalRAG, the FastAPI app) runs its real code path without API keys.
+"""
+from __future__ import annotations
+import os
+from contextlib import contextmanager
+
+OFFLINE_ENV = {"EMBEDDING_PROVIDER": "local", "LLM_PROVIDER": "local"}
+
+
+@contextmanager
+def offline_models(**overrides: str):
+    env = {**OFFLINE_ENV, **overrides}
+    saved = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
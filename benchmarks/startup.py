@@ -0,0 +1,122 @@
+"""
+Worker startup profiling: import-time report and cold-start-to-ready measurement.
+
+    python -m benchmarks.startup                          # report only
+    python -m benchmarks.startup --max-import-s 1.5 --max-ready-s 6 --out bench_results/startup.json
+
+With thresholds given the exit code is non-zero when they are exceeded, which is
+how CI guards against heavy modules creeping back into the import path.
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+from benchmarks.stand_ins import OFFLINE_ENV
+
+TARGET = "api.main"
+
+
+def import_profile(module: str = TARGET, top: int = 15) -> Dict[str, Any]:
+    """Run `python -X importtime -c 'import module'` in a fresh interpreter and summarize it."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env={**os.environ, **OFFLINE_ENV}, check=True,
+    )
+    rows: List[Dict[str, Any]] = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        try:
+            self_us, cum_us, name = line[len("import time:"):].split("|")
+            rows.append({"module": name.strip(), "self_ms": int(self_us) / 1000, "cumulative_ms": int(cum_us) / 1000,
+                         "depth": (len(name) - len(name.lstrip()) - 1) // 2})
+        except ValueError:
+            continue  # header line
+    total = next((r["cumulative_ms"] for r in rows if r["module"] == module), None)
+    top_level = sorted((r for r in rows if r["depth"] <= 1), key=lambda r: -r["cumulative_ms"])[:top]
+    heaviest = sorted(rows, key=lambda r: -r["self_ms"])[:top]
+    return {"module": module, "total_ms": total, "modules_imported": len(rows),
+            "top_cumulative": top_level, "top_self": heaviest}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def cold_start(repeats: int = 3, timeout_s: float = 60.0) -> Dict[str, Any]:
+    """Seconds from spawning uvicorn until /health answers, in a fresh process each time."""
+    samples = []
+    for _ in range(repeats):
+        port = _free_port()
+        t0 = time.perf_counter()
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", f"{TARGET}:app", "--host", "127.0.0.1", "--port", str(port),
+             "--log-level", "warning"],
+            env={**os.environ, **OFFLINE_ENV}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            while True:
+                if proc.poll() is not None:
+                    raise RuntimeError(f"uvicorn exited with code {proc.returncode} before becoming ready")
+                if time.perf_counter() - t0 > timeout_s:
+                    raise TimeoutError(f"app not ready after {timeout_s}s")
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=0.5) as r:
+                        if r.status == 200:
+                            break
+                except OSError:
+                    time.sleep(0.02)
+            samples.append(time.perf_counter() - t0)
+        finally:
+            proc.terminate()
+            proc.wait(timeout=10)
+    return {"repeats": repeats, "samples_s": [round(s, 3) for s in samples],
+            "best_s": round(min(samples), 3), "median_s": round(sorted(samples)[len(samples) // 2], 3)}
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Import-time and cold-start profiling")
+    ap.add_argument("--repeats", type=int, default=3)
+    ap.add_argument("--top", type=int, default=15)
+    ap.add_argument("--max-import-s", type=float, default=None, help="fail if importing api.main takes longer")
+    ap.add_argument("--max-ready-s", type=float, default=None, help="fail if cold start to /health takes longer")
+    ap.add_argument("--out", default=None, help="optional JSON output path")
+    args = ap.parse_args(argv)
+
+    # best of N: the first run also pays for .pyc compilation and a cold page cache
+    profiles = [import_profile(top=args.top) for _ in range(args.repeats)]
+    imports = min(profiles, key=lambda p: p["total_ms"] or float("inf"))
+    ready = cold_start(repeats=args.repeats)
+    report = {"import": imports, "cold_start": ready}
+
+    print(f"import {TARGET}: {imports['total_ms']:.0f} ms ({imports['modules_imported']} modules)")
+    for r in imports["top_cumulative"]:
+        print(f"  {r['cumulative_ms']:>9.1f} ms  {r['module']}")
+    print(f"cold start -> ready: best {ready['best_s']:.2f}s, median {ready['median_s']:.2f}s")
+
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.out).write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+    failed = False
+    if args.max_import_s is not None and imports["total_ms"] / 1000 > args.max_import_s:
+        print(f"FAIL: import time exceeds {args.max_import_s}s")
+        failed = True
+    if args.max_ready_s is not None and ready["median_s"] > args.max_ready_s:
+        print(f"FAIL: cold start exceeds {args.max_ready_s}s")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,19 @@
+# gunicorn.conf.py
+# Production entrypoint with preload/fork:
+#   gunicorn -c gunicorn.conf.py api.main:app
+# The app and its heavy modules are loaded once in the master (see api.main.preload)
+# and shared copy-on-write by every forked worker, so workers boot in milliseconds.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.getenv("WORKER_TIMEOUT", "300"))
+
+
+def when_ready(server):
+    # runs in the master after the app is imported and before any worker is forked
+    from api.main import preload
+
+    preload()
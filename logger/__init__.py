@@ -1,7 +1,7 @@
 # logger/__init__.py
-from .custom_logger import CustomLogger
+from .custom_logger import CustomLogger, LazyLogger
 
-# Create a single shared logger instance
-GLOBAL_LOGGER = CustomLogger().get_logger("doc_portal")
+# Create a single shared logger instance (configured on first use, not at import)
+GLOBAL_LOGGER = LazyLogger("doc_portal")
 
 __all__ = ['GLOBAL_LOGGER']
\ No newline at end of file
@@ -1,54 +1,210 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+import random
+import threading
 from datetime import datetime
 import structlog
 
+# Defaults, overridden by the `logging:` block of config/config.yaml
+DEFAULT_LOGGING_CONFIG = {
+    "level": "INFO",
+    "console": True,
+    "file": True,
+    "queue_size": 50000,
+    "rotation": {"mode": "size", "max_mb": 50, "backup_count": 5, "when": "midnight"},
+    "levels": {},
+    "sampling": {},
+}
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueue records without formatting them.
+
+    The stock QueueHandler renders the message on the caller's thread; here the
+    structlog event dict travels as-is and is rendered to JSON by the listener
+    thread. A full queue drops the record instead of blocking the request.
+    """
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class DrainingQueueListener(logging.handlers.QueueListener):
+    """
+    Wait for room for the stop sentinel so a full queue is drained (not lost) at
+    shutdown. The wait is bounded: if nothing frees a slot within `sentinel_timeout`
+    (e.g. no listener thread is running), the oldest record is dropped to make room.
+    """
+
+    sentinel_timeout = 5.0
+
+    def enqueue_sentinel(self) -> None:
+        try:
+            self.queue.put(self._sentinel, timeout=self.sentinel_timeout)
+            return
+        except queue.Full:
+            pass
+        try:
+            self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            self.queue.put_nowait(self._sentinel)
+        except queue.Full:
+            pass  # still refilled by other threads: give up on the sentinel rather than hang at exit
+
+
+def sample_events(rates: dict):
+    """structlog processor keeping only `rate` of the events named in `rates`."""
+    def processor(logger, method_name, event_dict):
+        rate = rates.get(event_dict.get("event"))
+        if rate is not None and random.random() >= rate:
+            raise structlog.DropEvent
+        return event_dict
+    return processor
+
 
 class CustomLogger:
+    _configured = False
+    _lock = threading.Lock()
+    _listener = None
+    _queue_handler = None
+    _fork_hook_registered = False
+
     def __init__(self, log_dir="logs"):
         self.logs_dir = os.path.join(os.getcwd(), log_dir)
-        os.makedirs(self.logs_dir, exist_ok=True)
+        self._file_suffix = ""
 
-        log_file = f"{datetime.now().strftime('%d_%m_%Y_%H-%M-%S')}.log"
-        self.log_file_path = os.path.join(self.logs_dir, log_file)
+    @staticmethod
+    def _load_settings() -> dict:
+        settings = {**DEFAULT_LOGGING_CONFIG}
+        try:
+            from utils.config_loader import load_config
+            settings.update(load_config().get("logging") or {})
+        except Exception:
+            pass  # config is optional for logging; fall back to defaults
+        return settings
 
-    
-    def get_logger(self, name=__file__):
-        logger_name = os.path.basename(name)
+    def _build_file_handler(self, settings: dict) -> logging.Handler:
+        os.makedirs(self.logs_dir, exist_ok=True)
+        log_file = f"{datetime.now().strftime('%d_%m_%Y_%H-%M-%S')}{self._file_suffix}.log"
+        self.log_file_path = os.path.join(self.logs_dir, log_file)
 
-        # Configure logging for console + file (both JSON)
-        file_handler = logging.FileHandler(self.log_file_path)
-        file_handler.setLevel(logging.INFO)
-        file_handler.setFormatter(logging.Formatter("%(message)s"))
+        rotation = {**DEFAULT_LOGGING_CONFIG["rotation"], **(settings.get("rotation") or {})}
+        if rotation["mode"] == "time":
+            return logging.handlers.TimedRotatingFileHandler(
+                self.log_file_path, when=rotation["when"], backupCount=rotation["backup_count"], encoding="utf-8"
+            )
+        return logging.handlers.RotatingFileHandler(
+            self.log_file_path,
+            maxBytes=int(float(rotation["max_mb"]) * 1024 * 1024),
+            backupCount=rotation["backup_count"],
+            encoding="utf-8",
+        )
 
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)
-        console_handler.setFormatter(logging.Formatter("%(message)s"))
+    def _configure(self) -> None:
+        settings = self._load_settings()
+        level = logging.getLevelName(str(settings["level"]).upper())
 
-        logging.basicConfig(
-            format="%(message)s", # Structlog will handle JSON rendering
-            handlers=[file_handler, console_handler],
-            level=logging.INFO,
+        # Rendering happens here, on the listener thread
+        formatter = structlog.stdlib.ProcessorFormatter(
+            processor=structlog.processors.JSONRenderer(),
+            foreign_pre_chain=[
+                structlog.processors.TimeStamper(fmt='iso', utc=True, key="timestamp"),
+                structlog.processors.add_log_level,
+            ],
         )
+        handlers = []
+        if settings["file"]:
+            handlers.append(self._build_file_handler(settings))
+        if settings["console"]:
+            handlers.append(logging.StreamHandler())
+        for h in handlers:
+            h.setFormatter(formatter)
 
-        # Structlog configuration
+        log_queue: queue.Queue = queue.Queue(maxsize=int(settings["queue_size"]))
+        queue_handler = DeferredQueueHandler(log_queue)
+        listener = DrainingQueueListener(log_queue, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+
+        root = logging.getLogger()
+        root.handlers = [queue_handler]
+        root.setLevel(level)
+        for name, lvl in (settings.get("levels") or {}).items():
+            logging.getLogger(name).setLevel(str(lvl).upper())
+
+        # Structlog configuration (cheap work only; JSON rendering is deferred)
         structlog.configure(
             processors=[
+                structlog.stdlib.filter_by_level,
+                sample_events(settings.get("sampling") or {}),
                 structlog.processors.TimeStamper(fmt='iso', utc=True, key="timestamp"),
                 structlog.processors.add_log_level,
-                structlog.processors.EventRenamer(to="event"),
-                structlog.processors.JSONRenderer()
+                structlog.stdlib.ProcessorFormatter.wrap_for_formatter,
             ],
             logger_factory=structlog.stdlib.LoggerFactory(),
+            wrapper_class=structlog.stdlib.BoundLogger,
             cache_logger_on_first_use=True,
         )
+        CustomLogger._listener = listener
+        CustomLogger._queue_handler = queue_handler
+        if not CustomLogger._fork_hook_registered and hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._restart_after_fork)
+            CustomLogger._fork_hook_registered = True
+
+    def _restart_after_fork(self) -> None:
+        """
+        The listener thread does not survive fork (e.g. gunicorn --preload), so each
+        worker starts its own queue/listener and writes to its own file.
+        """
+        CustomLogger._lock = threading.Lock()
+        if CustomLogger._listener is not None:
+            # the parent's listener thread is gone: its stop() would wait on a queue nobody drains
+            atexit.unregister(CustomLogger._listener.stop)
+        if CustomLogger._configured:
+            self._file_suffix = f"_{os.getpid()}"
+            self._configure()
+
+    def get_logger(self, name=__file__):
+        logger_name = os.path.basename(name)
+
+        # Configure the pipeline once per process, no matter how often this is called
+        with CustomLogger._lock:
+            if not CustomLogger._configured:
+                self._configure()
+                CustomLogger._configured = True
 
         return structlog.getLogger(logger_name)
 
+
+class LazyLogger:
+    """Defers get_logger() (and with it, pipeline setup) until the first log call."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._logger = None
+
+    def __getattr__(self, attr):
+        if self._logger is None:
+            self._logger = CustomLogger().get_logger(self._name)
+        return getattr(self._logger, attr)
+
 if __name__ == "__main__":
     logger = CustomLogger().get_logger(__file__)
     logger.info("User uploaded a file", user_id=123, file_name="report.pdf")
     logger.error("Failed to process PDF", error="File not found", user_id=123)
-        
-
-
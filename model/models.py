@@ -25,6 +25,7 @@ class PromptType(str, Enum):
     DOCUMENT_COMPARISON = "document_comparison"
     CONTEXTUALIZE_QUESTION = "contextualize_question"
     CONTEXT_QA = "context_qa"
+    JSON_REPAIR = "json_repair"
     
 
 
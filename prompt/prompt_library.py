@@ -51,9 +51,24 @@ context_qa_prompt = ChatPromptTemplate.from_messages([
 ])
 
 # Central dictionary to register prompts
+# Last-resort re-ask when structured output could not be repaired locally
+json_repair_prompt = ChatPromptTemplate.from_template("""
+Your previous answer could not be parsed. Return ONLY valid JSON that follows these instructions, with no other text.
+
+Instructions:
+{instructions}
+
+Previous answer:
+{completion}
+
+Error:
+{error}
+""")
+
 PROMPT_REGISTRY = {
     "document_analysis": document_analysis_prompt,
     "document_comparison": document_comparison_prompt,
     "contextualize_question": contextualize_question_prompt,
     "context_qa": context_qa_prompt,
+    "json_repair": json_repair_prompt,
 }
@@ -1,6 +1,5 @@
 import sys
-from langchain_core.output_parsers import JsonOutputParser
-from langchain.output_parsers import OutputFixingParser
+import asyncio
 
 
 from utils.model_loader import ModelLoader
@@ -8,6 +7,9 @@ from logger import GLOBAL_LOGGER as log
 from exception.custom_exception import DocumentPortalException
 from model.models import *
 from prompt.prompt_library import PROMPT_REGISTRY
+from utils.metrics import timed
+from utils.llm_scheduler import LLMBusy, llm_slot, allm_slot
+from utils.structured_output import StructuredOutputParser
 
 
 class DocumentAnalyzer:
@@ -19,11 +21,13 @@ class DocumentAnalyzer:
     def __init__(self):
         try:
             self.loader = ModelLoader()
-            self.llm = self.loader.load_llm()
+            self.llm = self.loader.load_llm(json_mode=True)
 
-            # Prepare parsers
-            self.parser = JsonOutputParser(pydantic_object=Metadata)
-            self.fixing_parser = OutputFixingParser.from_llm(parser=self.parser, llm=self.llm)
+            # Prepare parser: local JSON repair + Metadata validation, re-ask only as a last resort
+            self.parser = StructuredOutputParser(
+                pydantic_object=Metadata, label="document_analysis", reask_llm=self.llm,
+                max_reasks=(self.loader.config.get("structured_output") or {}).get("max_reasks", 1),
+            )
 
             self.prompt = PROMPT_REGISTRY["document_analysis"]
 
@@ -33,22 +37,45 @@ class DocumentAnalyzer:
             log.error("Failed to initialize DocumentAnalyzer: {e}")
             raise DocumentPortalException("Failed to initialize DocumentAnalyzer", sys)
 
+    def _chain(self):
+        return self.prompt | self.llm | self.parser
+
+    def _inputs(self, document_text: str) -> dict:
+        return {"format_instructions": self.parser.get_format_instructions(), "document_text": document_text}
+
     def analyze_document(self, document_text: str) -> dict:
         try:
-            chain = self.prompt | self.llm | self.fixing_parser
+            chain = self._chain()
             
             log.info("Meta-data analysis chain intialized")
 
-            response = chain.invoke({
-                "format_instructions": self.parser.get_format_instructions(),
-                "document_text": document_text
-            })
+            with llm_slot("analyze", document_text), timed("document_analysis"):
+                response = chain.invoke(self._inputs(document_text))
 
             log.info("Metadata extraction successful", keys=list(response.keys()))
 
             return response
 
+        except LLMBusy:
+            raise
         except Exception as e:
             log.error("Failed to analyze document", error=str(e))
             raise DocumentPortalException("Failed to analyze document", sys)
-        
\ No newline at end of file
+        
+    async def aanalyze_batch_item(self, document_text: str) -> dict:
+        """
+        Analyze one document of a batch on the event loop. Batch items queue behind
+        interactive work in the LLM scheduler; when it is saturated (LLMBusy) the item
+        waits `retry_after` and tries again rather than failing.
+        """
+        inputs = self._inputs(document_text)
+        while True:
+            try:
+                async with allm_slot("analyze_batch", document_text):
+                    return await self._chain().ainvoke(inputs)
+            except LLMBusy as e:
+                log.info("LLM busy, batch item waiting", reason=e.reason, retry_after=e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                log.error("Failed to analyze document", error=str(e))
+                raise
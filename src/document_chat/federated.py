@@ -0,0 +1,67 @@
+"""
+Federated retrieval across several FAISS indexes (e.g. multiple chat sessions).
+
+The query is embedded once, every index is searched in parallel on a shared thread
+pool (FAISS releases the GIL while searching), and the per-index hits are merged
+into one global top-k by score. Per-index search latency is kept on the retriever
+(`timings`) so the API can report it.
+"""
+from __future__ import annotations
+import heapq
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+from utils.metrics import observe_stage
+
+_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="index-search")
+
+# distance strategies where a larger score means a closer match
+_HIGHER_IS_BETTER = {"max_inner_product", "jaccard"}
+
+
+def _higher_is_better(store: Any) -> bool:
+    strategy = getattr(store, "distance_strategy", "euclidean_distance")
+    return str(getattr(strategy, "value", strategy)).lower() in _HIGHER_IS_BETTER
+
+
+class FederatedRetriever(BaseRetriever):
+    """Search `stores` ((label, FAISS) pairs sharing one embedding model) and merge the top `k`."""
+
+    stores: List[Tuple[str, Any]]
+    embeddings: Embeddings
+    k: int = 5
+    timings: Dict[str, float] = {}  # label -> ms for the last query
+
+    def _search(self, label: str, store: Any, vector: List[float]) -> Tuple[str, List[Tuple[Document, float]], float]:
+        t0 = time.perf_counter()
+        hits = store.similarity_search_with_score_by_vector(vector, k=self.k)
+        elapsed = time.perf_counter() - t0
+        observe_stage("index_search", elapsed)
+        return label, hits, elapsed
+
+    def _get_relevant_documents(self, query: str, *, run_manager: Optional[CallbackManagerForRetrieverRun] = None
+                                ) -> List[Document]:
+        vector = self.embeddings.embed_query(query)  # once, not once per index
+        results = list(_POOL.map(lambda s: self._search(s[0], s[1], vector), self.stores))
+
+        candidates = []
+        timings: Dict[str, float] = {}
+        for (label, hits, elapsed), (_, store) in zip(results, self.stores):
+            timings[label] = round(elapsed * 1000, 3)
+            sign = -1.0 if _higher_is_better(store) else 1.0
+            for rank, (doc, score) in enumerate(hits):
+                candidates.append((sign * float(score), label, rank, doc, float(score)))
+        self.timings = timings
+
+        merged = []
+        for _, label, _, doc, score in heapq.nsmallest(self.k, candidates, key=lambda c: (c[0], c[1], c[2])):
+            # copy: the Document objects live in the index docstore
+            merged.append(Document(page_content=doc.page_content,
+                                   metadata={**doc.metadata, "index": label, "score": score}))
+        return merged
@@ -0,0 +1,57 @@
+"""
+Two-level retrieval: pick the closest documents by centroid, then search only their chunks.
+
+The chunk search runs on the same FAISS index as the flat retriever, restricted to
+the selected documents' ids (faiss.IDSelectorBatch). Distance computations therefore
+scale with the chunks of `top_docs` documents, not with the whole corpus. It also
+keeps one large, noisy document from crowding out the rest of the top-k candidates.
+"""
+from __future__ import annotations
+import time
+from typing import Any, List, Optional
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from utils.metrics import observe_stage
+
+
+class HierarchicalRetriever(BaseRetriever):
+    """Coarse (document centroid) then fine (chunk) search over one FAISS store."""
+
+    store: Any           # langchain FAISS vectorstore
+    coarse: Any          # utils.coarse_index.CoarseIndex built from `store`
+    k: int = 5
+    top_docs: int = 5
+
+    def search(self, query: str) -> List[Document]:
+        return self.search_by_vector(self.store.embedding_function.embed_query(query))
+
+    def candidate_ids(self, vector: np.ndarray, n: int) -> np.ndarray:
+        """FAISS ids of the `n` closest chunks of the top documents to `vector` (1, dim), best first."""
+        import faiss
+
+        t0 = time.perf_counter()
+        docs = self.coarse.top_documents(vector[0], self.top_docs)
+        ids = self.coarse.chunk_ids(docs)
+        observe_stage("coarse_search", time.perf_counter() - t0)
+        if getattr(self.store, "_normalize_L2", False):
+            vector = vector.copy()
+            faiss.normalize_L2(vector)
+        params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(ids))
+        _, indices = self.store.index.search(vector, min(n, len(ids)) or 1, params=params)
+        return indices[0][indices[0] != -1]
+
+    def search_by_vector(self, embedding: List[float]) -> List[Document]:
+        out = []
+        for i in self.candidate_ids(np.asarray([embedding], dtype=np.float32), self.k):
+            doc = self.store.docstore.search(self.store.index_to_docstore_id[i])
+            if isinstance(doc, Document):
+                out.append(doc)
+        return out
+
+    def _get_relevant_documents(self, query: str, *, run_manager: Optional[CallbackManagerForRetrieverRun] = None
+                                ) -> List[Document]:
+        return self.search(query)
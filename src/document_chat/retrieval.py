@@ -6,9 +6,13 @@ from typing import List, Optional, Dict, Any
 from langchain_core.messages import BaseMessage
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_community.vectorstores import FAISS
 
 from utils.model_loader import ModelLoader
+from utils.config_loader import load_config
+from utils.storage_manager import pin_while_alive, share_while_alive, touch_access
+from utils.index_snapshots import resolve_index_dir
+from utils.metrics import timed, METRICS_CALLBACK
+from utils.llm_scheduler import LLMBusy, llm_slot
 from exception.custom_exception import DocumentPortalException
 from logger import GLOBAL_LOGGER as log
 from prompt.prompt_library import PROMPT_REGISTRY
@@ -36,6 +40,7 @@ class ConversationalRAG:
 
             # lazy pieces
             self.retriever = retriever
+            self.snapshot = None  # index snapshot the retriever was loaded from
             self.chain = None
             if self.retriever is not None:
                 self._build_lcel_chain()
@@ -51,31 +56,45 @@ class ConversationalRAG:
         index_path: str,
         k: int = 5,
         index_name: str = "index",
-        search_type: str = "similarity",
+        search_type: Optional[str] = None,
         search_kwargs: Optional[dict[str, Any]] = None,
     ):
+        """
+        search_type: similarity | mmr | similarity_score_threshold (default: retriever.search_type).
+        search_kwargs override the config's selection settings (k, fetch_k, lambda_mult,
+        score_threshold, adaptive_k, min_k, min_ratio); see src/document_chat/selection.py.
+        """
         try:
             if not os.path.isdir(index_path):
                 raise FileNotFoundError(f"FAISS index not found: {index_path}")
 
+            from src.document_chat.selection import SelectiveRetriever, needs_selection, selection_settings
+
+            overrides = dict(search_kwargs or {})
+            k = overrides.pop("k", k)
+            mode, options = selection_settings(search_type, **overrides)
+
             embeddings = ModelLoader().load_embeddings()
-            vectorstore = FAISS.load_local(
-                index_path, 
-                embeddings,
-                index_name=index_name,
-                allow_dangerous_deserialization=True # only if you trust the index
-                )
-            
-            if search_kwargs is None:
-                search_kwargs = {"k": k}
-            
-            self.retriever = vectorstore.as_retriever(search_type=search_type, search_kwargs=search_kwargs)
+            vectorstore, snapshot = self._load_vectorstore(index_path, index_name, embeddings)
+
+            hierarchical = self._hierarchical_retriever(vectorstore, snapshot, k)
+            if needs_selection(mode, options):
+                self.retriever = SelectiveRetriever(store=vectorstore, embeddings=embeddings, k=k, search_type=mode,
+                                                    hierarchical=hierarchical, **options)
+            else:
+                self.retriever = hierarchical or vectorstore.as_retriever(search_type="similarity",
+                                                                          search_kwargs={"k": k})
+            self.snapshot = snapshot
+            self._index_args = dict(index_path=index_path, k=k, index_name=index_name,
+                                    search_type=search_type, search_kwargs=search_kwargs)
             self._build_lcel_chain()
 
             log.info("FAISS retriever load surccesfully",
                 index_path=index_path,
                 index_name=index_name,
+                snapshot=snapshot.name,
                 k = k,
+                search_type=mode,
                 session_id=self.session_id,
                 )
             return self.retriever
@@ -84,6 +103,64 @@ class ConversationalRAG:
             log.error("Error loading retriever from FAISS", error=str(e))
             raise DocumentPortalException("Error loading retriever from FAISS", sys)
 
+    def load_federated_retriever(self, index_paths: Dict[str, str], k: int = 5, index_name: str = "index"):
+        """
+        One retriever over several indexes ({label: index_path}, e.g. session_id -> dir):
+        the question is embedded once, indexes are searched in parallel and merged by score.
+        """
+        try:
+            missing = [p for p in index_paths.values() if not os.path.isdir(p)]
+            if missing:
+                raise FileNotFoundError(f"FAISS index not found: {', '.join(missing)}")
+            from src.document_chat.federated import FederatedRetriever
+
+            embeddings = ModelLoader().load_embeddings()
+            stores = [(label, self._load_vectorstore(path, index_name, embeddings)[0])
+                      for label, path in index_paths.items()]
+            self.retriever = FederatedRetriever(stores=stores, embeddings=embeddings, k=k)
+            self.snapshot = None
+            self._index_args = None
+            self._build_lcel_chain()
+            log.info("Federated retriever loaded", indexes=list(index_paths), k=k, session_id=self.session_id)
+            return self.retriever
+        except Exception as e:
+            log.error("Error loading federated retriever", error=str(e))
+            raise DocumentPortalException("Error loading federated retriever", e) from e
+
+    def load_sharded_retriever(self, index_path: str, k: int = 5, index_name: str = "index"):
+        """
+        Retriever over the shard processes of one (large, shared) index; see
+        src/document_chat/sharded.py. Shards are started on first use and follow
+        newly published snapshots.
+        """
+        try:
+            if not os.path.isdir(index_path):
+                raise FileNotFoundError(f"FAISS index not found: {index_path}")
+            from src.document_chat.sharded import ShardedRetriever, get_sharded_search
+
+            search = get_sharded_search(index_path, index_name=index_name)
+            self.retriever = ShardedRetriever(search=search, embeddings=ModelLoader().load_embeddings(), k=k)
+            self.snapshot = None
+            self._index_args = None
+            self._build_lcel_chain()
+            log.info("Sharded retriever loaded", index_path=index_path, shards=len(search.layout.get("shards", [])),
+                     chunks=search.layout.get("total"), k=k, session_id=self.session_id)
+            return self.retriever
+        except Exception as e:
+            log.error("Error loading sharded retriever", error=str(e))
+            raise DocumentPortalException("Error loading sharded retriever", e) from e
+
+    def refresh(self) -> bool:
+        """Switch to the latest published snapshot if it changed; returns True when reloaded."""
+        args = getattr(self, "_index_args", None)
+        if args is None:
+            return False
+        latest = resolve_index_dir(args["index_path"], index_name=args["index_name"])
+        if latest is None or latest == self.snapshot:
+            return False
+        self.load_retriever_from_faiss(**args)
+        return True
+
     def invoke(self, user_input: str, chat_history: Optional[List[BaseMessage]] = None) -> str:
         try:
             if self.chain is None:
@@ -91,9 +168,11 @@ class ConversationalRAG:
             
             chat_history = chat_history or []
             payload = {"input": user_input, "chat_history": chat_history}
-            answer = self.chain.invoke(
-                payload,
-            )
+            with llm_slot("chat", user_input):
+                answer = self.chain.invoke(
+                    payload,
+                    config={"callbacks": [METRICS_CALLBACK]},  # per-stage latency (rewrite/retrieval/answer)
+                )
 
             if not answer:
                 log.warning("No answer received", session_id=self.session_id)
@@ -105,6 +184,8 @@ class ConversationalRAG:
                 answer_preview=answer[:50]
                 )
             return answer
+        except LLMBusy:
+            raise
         except Exception as e:
             log.error("Error invoking ConversationalRAG", error=str(e), session_id=self.session_id)
             raise DocumentPortalException("Error invoking ConversationalRAG", sys)
@@ -122,6 +203,52 @@ class ConversationalRAG:
             log.error("Error loading LLM via ModelLoader", error=str(e))
             raise DocumentPortalException("Error loading LLM", sys)
 
+    @staticmethod
+    def _load_vectorstore(index_path: str, index_name: str, embeddings):
+        from langchain_community.vectorstores import FAISS
+
+        for attempt in range(2):
+            # readers never lock: load whichever snapshot CURRENT names right now
+            snapshot = resolve_index_dir(index_path, index_name=index_name)
+            if snapshot is None:
+                raise FileNotFoundError(f"FAISS index not found: {index_path}")
+            try:
+                with timed("faiss_load"):
+                    vectorstore = FAISS.load_local(
+                        str(snapshot),
+                        embeddings,
+                        index_name=index_name,
+                        allow_dangerous_deserialization=True # only if you trust the index
+                        )
+                break
+            except (FileNotFoundError, RuntimeError):
+                if attempt:  # snapshot was garbage-collected between resolve and load; retry once
+                    raise
+        # keep the janitor and snapshot GC away from this index while it is loaded
+        pin_while_alive(vectorstore, snapshot)
+        share_while_alive(vectorstore, index_path)  # ...and the janitors of the other worker processes
+        touch_access(index_path)
+        return vectorstore, snapshot
+
+    @staticmethod
+    def _hierarchical_retriever(vectorstore, snapshot, k: int):
+        """
+        Coarse-to-fine retriever when enabled and the corpus is large enough, else None.
+        The selection modes use it as their candidate source.
+        """
+        cfg = (load_config().get("retriever") or {}).get("hierarchical") or {}
+        if not cfg.get("enabled", False):
+            return None
+        from utils.coarse_index import CoarseIndex
+
+        coarse = CoarseIndex.load(snapshot)
+        if coarse is None or coarse.n_docs < cfg.get("min_documents", 20) \
+                or coarse.n_chunks != vectorstore.index.ntotal:
+            return None
+        from src.document_chat.hierarchical import HierarchicalRetriever
+
+        return HierarchicalRetriever(store=vectorstore, coarse=coarse, k=k, top_docs=cfg.get("top_docs", 8))
+
     @staticmethod
     def _format_docs(docs) -> str:
         return "\n\n".join(getattr(doc, "page_content", str(doc)) for doc in docs)
@@ -137,21 +264,20 @@ class ConversationalRAG:
                 | self.contextualize_prompt
                 | self.llm
                 | StrOutputParser()
-            )
+            ).with_config(run_name="question_rewrite")
             
             # 2) Retrieve relevant documents
             retrieve_docs = question_rewriter | self.retriever | self._format_docs
             
             # 3) Answer the question
+            answer = (self.qa_prompt | self.llm | StrOutputParser()).with_config(run_name="answer_generation")
             self.chain = (
                 {
                     "context": retrieve_docs,
                     "input": itemgetter("input"),
                     "chat_history": itemgetter("chat_history")
                 }
-                | self.qa_prompt
-                | self.llm
-                | StrOutputParser()
+                | answer
             )
             log.info("LCEL chain built successfully", session_id=self.session_id)
         except Exception as e:
@@ -0,0 +1,158 @@
+"""
+Post-retrieval chunk selection: MMR, similarity cutoff and adaptive k.
+
+The retriever fetches `fetch_k` candidates from FAISS (the flat index, or the
+hierarchical search's restricted one) and reconstructs their vectors. Selection then
+runs as NumPy operations on that (fetch_k, dim) block:
+
+- relevance: cosine similarity of every candidate to the query (one matvec)
+- cutoff: candidates below `score_threshold` are dropped
+- MMR: each pick maximizes lambda * relevance - (1 - lambda) * max similarity to
+  the chunks already picked. That max is kept as a running vector, so each pick
+  costs one matvec rather than rebuilding the pairwise matrix.
+- adaptive k: stop before `k` once the next pick's relevance falls below `min_ratio`
+  of the best candidate's, or (MMR) once its marginal score is no longer positive,
+  i.e. it is closer to the chunks already picked than to the query. Never below
+  `min_k` chunks.
+
+Near-duplicate and off-topic chunks are left out of the prompt, so the answer step
+reads fewer tokens.
+"""
+from __future__ import annotations
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+from logger import GLOBAL_LOGGER as log
+from utils.config_loader import load_config
+from utils.metrics import count_chunks, observe_stage
+
+SEARCH_TYPES = ("similarity", "mmr", "similarity_score_threshold")
+_KWARGS = ("fetch_k", "lambda_mult", "score_threshold", "adaptive_k", "min_k", "min_ratio")
+
+
+def select(query: np.ndarray, candidates: np.ndarray, k: int, *, mmr: bool = False, lambda_mult: float = 0.5,
+           score_threshold: Optional[float] = None, adaptive_k: bool = False, min_k: int = 1,
+           min_ratio: float = 0.5) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pick up to `k` rows of `candidates` (n, dim) for `query` (dim,).
+    Returns (row positions in pick order, their cosine relevance).
+    """
+    if candidates.shape[0] == 0 or k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    c = candidates / np.maximum(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12)
+    q = query / max(float(np.linalg.norm(query)), 1e-12)
+    relevance = c @ q
+    pool = np.arange(c.shape[0]) if score_threshold is None else np.flatnonzero(relevance >= score_threshold)
+    if not mmr and not adaptive_k:
+        order = pool[np.argsort(-relevance[pool], kind="stable")][:k]
+        return order, relevance[order]
+
+    c, rel = c[pool], relevance[pool]
+    lam = lambda_mult if mmr else 1.0
+    redundancy = np.zeros(len(pool), dtype=c.dtype)   # max similarity to the picks so far (none yet: 0)
+    taken = np.zeros(len(pool), dtype=bool)
+    picks: List[int] = []
+    floor = min_ratio * float(rel.max()) if len(rel) else 0.0
+    for _ in range(min(k, len(pool))):
+        score = lam * rel - (1.0 - lam) * redundancy
+        score[taken] = -np.inf
+        j = int(np.argmax(score))
+        # adaptive: the best remaining chunk is off-topic, or (mmr) closer to what was picked than to the query
+        if adaptive_k and len(picks) >= min_k and (rel[j] < floor or (mmr and score[j] <= 0)):
+            break
+        picks.append(j)
+        taken[j] = True
+        if mmr:
+            sims = c @ c[j]
+            redundancy = sims if len(picks) == 1 else np.maximum(redundancy, sims, out=redundancy)
+    order = pool[np.asarray(picks, dtype=np.int64)]
+    return order, relevance[order]
+
+
+def selection_settings(search_type: Optional[str] = None, **overrides: Any) -> Tuple[str, Dict[str, Any]]:
+    """Config `retriever` defaults merged with per-request overrides (None = use the default)."""
+    cfg = load_config().get("retriever") or {}
+    search_type = search_type or cfg.get("search_type", "similarity")
+    if search_type not in SEARCH_TYPES:
+        raise ValueError(f"search_type must be one of {list(SEARCH_TYPES)}, got {search_type!r}")
+    unknown = set(overrides) - set(_KWARGS)
+    if unknown:
+        raise ValueError(f"Unknown search_kwargs: {sorted(unknown)}")
+    kwargs = {key: cfg[key] for key in _KWARGS if key != "score_threshold" and cfg.get(key) is not None}
+    kwargs.update({key: value for key, value in overrides.items() if value is not None})
+    # the configured cutoff belongs to its mode; a cutoff passed with the request applies to any mode
+    if kwargs.get("score_threshold") is None and search_type == "similarity_score_threshold":
+        kwargs["score_threshold"] = cfg.get("score_threshold")
+    if kwargs.get("score_threshold") is None:
+        kwargs.pop("score_threshold", None)
+    return search_type, kwargs
+
+
+def needs_selection(search_type: str, search_kwargs: Dict[str, Any]) -> bool:
+    return search_type != "similarity" or bool(search_kwargs.get("adaptive_k")) \
+        or search_kwargs.get("score_threshold") is not None
+
+
+class SelectiveRetriever(BaseRetriever):
+    """Fetch `fetch_k` candidates from a FAISS store, then select with select()."""
+
+    store: Any                     # langchain FAISS vectorstore (vectors must be reconstructible: flat indexes)
+    embeddings: Embeddings
+    k: int = 5
+    search_type: str = "mmr"
+    fetch_k: int = 20
+    lambda_mult: float = 0.5
+    score_threshold: Optional[float] = None
+    adaptive_k: bool = False
+    min_k: int = 1
+    min_ratio: float = 0.5
+    hierarchical: Any = None       # HierarchicalRetriever used as the candidate source, if enabled
+    last_selected: int = 0         # chunks returned for the last query
+
+    def _candidates(self, embedding: List[float]) -> np.ndarray:
+        import faiss
+
+        vector = np.asarray([embedding], dtype=np.float32)
+        fetch = max(self.fetch_k, self.k)
+        if self.hierarchical is not None:
+            return self.hierarchical.candidate_ids(vector, fetch)
+        if getattr(self.store, "_normalize_L2", False):
+            faiss.normalize_L2(vector)
+        _, ids = self.store.index.search(vector, min(fetch, self.store.index.ntotal) or 1)
+        return ids[0][ids[0] != -1]
+
+    def search_by_vector(self, embedding: List[float]) -> List[Document]:
+        ids = self._candidates(embedding)
+        t0 = time.perf_counter()
+        try:
+            vectors = self.store.index.reconstruct_batch(ids) if len(ids) else np.empty((0, self.store.index.d))
+        except RuntimeError as e:  # index type without stored vectors: plain top-k
+            log.warning("Chunk selection unavailable for this index, using similarity", error=str(e))
+            order, relevance = np.arange(min(self.k, len(ids))), np.full(min(self.k, len(ids)), np.nan)
+        else:
+            order, relevance = select(
+                np.asarray(embedding, dtype=np.float32), vectors, self.k, mmr=self.search_type == "mmr",
+                lambda_mult=self.lambda_mult, score_threshold=self.score_threshold, adaptive_k=self.adaptive_k,
+                min_k=self.min_k, min_ratio=self.min_ratio,
+            )
+        observe_stage("chunk_selection", time.perf_counter() - t0)
+        count_chunks("selection_dropped", max(0, min(self.k, len(ids)) - len(order)))
+
+        out = []
+        for pos, score in zip(order, relevance):
+            doc = self.store.docstore.search(self.store.index_to_docstore_id[int(ids[pos])])
+            if isinstance(doc, Document):
+                # copy: the Document objects live in the index docstore
+                out.append(Document(page_content=doc.page_content, metadata={**doc.metadata, "score": float(score)}))
+        self.last_selected = len(out)
+        return out
+
+    def _get_relevant_documents(self, query: str, *, run_manager: Optional[CallbackManagerForRetrieverRun] = None
+                                ) -> List[Document]:
+        return self.search_by_vector(self.embeddings.embed_query(query))
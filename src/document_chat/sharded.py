@@ -0,0 +1,494 @@
+"""
+Sharded scatter-gather search over one large shared index (use_session_dirs=False).
+
+The published snapshot is split into N flat FAISS shards under <index_dir>/shards/.
+layout.json records which chunk lives in which shard. Each shard is held by its own
+search process. A query is sent to every shard over a multiprocessing pipe, each
+shard returns its exact top-k, and the merge yields the same top-k a flat search of
+the whole index would. A shard drains its pipe and answers every queued query with
+one batched FAISS call.
+
+Splitting runs in a short-lived helper process, so the API worker never loads the
+full index. Chunks added by a new snapshot go to the smallest shards. When shards are
+added, each existing shard hands its surplus over the new average to the new ones.
+Only shards whose contents changed are rewritten, and those get fresh processes that
+are swapped in once loaded; queries never see a half-applied layout. Queries look for
+a newer snapshot on disk at most every `check_interval_s`. A query that times out
+cancels its shard requests, and their late replies are read off the pipe and dropped.
+"""
+from __future__ import annotations
+import os
+import json
+import time
+import heapq
+import pickle
+import shutil
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import Future, InvalidStateError, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+from logger import GLOBAL_LOGGER as log
+from exception.custom_exception import DocumentPortalException
+from utils.config_loader import load_config
+from utils.index_snapshots import SnapshotStore
+from utils.metrics import observe_stage
+
+SHARDS_DIR = "shards"
+LAYOUT_FILE = "layout.json"
+
+Hit = Tuple[float, str, str, Dict[str, Any]]  # score, docstore id, page_content, metadata
+
+
+# ---------- layout (runs in the builder process) ----------
+def _read_layout(shard_root: Path) -> Optional[Dict[str, Any]]:
+    try:
+        return json.loads((shard_root / LAYOUT_FILE).read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def assign_shards(ids: Sequence[str], previous: Dict[str, int], n_shards: int) -> Dict[str, int]:
+    """
+    Place `ids` on `n_shards` shards, moving as few as possible from `previous`:
+    chunks stay put unless their shard is over ceil(total / n_shards) or gone;
+    everything else goes to the currently smallest shard.
+    """
+    members: List[List[str]] = [[] for _ in range(n_shards)]
+    unplaced: List[str] = []
+    for doc_id in ids:
+        s = previous.get(doc_id)
+        (members[s] if s is not None and s < n_shards else unplaced).append(doc_id)
+    target = -(-len(ids) // n_shards)
+    for m in members:
+        while len(m) > target:
+            unplaced.append(m.pop())
+    heap = [(len(m), s) for s, m in enumerate(members)]
+    heapq.heapify(heap)
+    for doc_id in unplaced:
+        size, s = heapq.heappop(heap)
+        members[s].append(doc_id)
+        heapq.heappush(heap, (size + 1, s))
+    return {doc_id: s for s, m in enumerate(members) for doc_id in m}
+
+
+def _write_shard(path: Path, index: Any, docstore: Any, positions: List[int], ids: List[str]) -> None:
+    import faiss
+
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    sub = faiss.IndexFlat(index.d, index.metric_type)
+    if positions:
+        sub.add(index.reconstruct_batch(np.asarray(positions, dtype=np.int64)))
+    faiss.write_index(sub, str(tmp / "index.faiss"))
+    docs = []
+    for doc_id in ids:
+        doc = docstore.search(doc_id)
+        docs.append((doc_id, doc.page_content, doc.metadata) if isinstance(doc, Document) else (doc_id, "", {}))
+    with open(tmp / "docs.pkl", "wb") as fh:
+        pickle.dump(docs, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
+
+
+def build_shards(index_dir: str, index_name: str, n_shards: int, grace_seconds: float = 60.0) -> Dict[str, Any]:
+    """Split the live snapshot of `index_dir` into `n_shards`, rewriting only changed shards; returns the layout."""
+    import faiss
+
+    root = Path(index_dir)
+    shard_root = root / SHARDS_DIR
+    shard_root.mkdir(parents=True, exist_ok=True)
+    store = SnapshotStore(root, index_name=index_name)
+    # the snapshot writer lock, on the shards directory: one builder at a time across API workers
+    with SnapshotStore(shard_root, index_name=index_name).write_lock():
+        snapshot = store.current()
+        if snapshot is None:
+            raise FileNotFoundError(f"FAISS index not found: {index_dir}")
+        version = store.current_version() or "legacy"
+        old = _read_layout(shard_root) or {}
+        if old.get("snapshot") == version and len(old.get("shards", [])) == n_shards:
+            return old  # another process got here first
+
+        index = faiss.read_index(str(snapshot / f"{index_name}.faiss"))
+        with open(snapshot / f"{index_name}.pkl", "rb") as fh:
+            docstore, index_to_docstore_id = pickle.load(fh)
+        ids = [index_to_docstore_id[i] for i in range(index.ntotal)]
+        position = {doc_id: i for i, doc_id in enumerate(ids)}
+        previous = old.get("assignment", {})
+        assignment = assign_shards(ids, previous, n_shards)
+
+        members: List[List[str]] = [[] for _ in range(n_shards)]
+        for doc_id in ids:
+            members[assignment[doc_id]].append(doc_id)
+        old_members: Dict[int, set] = {}
+        for doc_id, s in previous.items():
+            old_members.setdefault(s, set()).add(doc_id)
+
+        generation = old.get("generation", 0) + 1
+        shards, rewritten = [], 0
+        for s, m in enumerate(members):
+            prev = old["shards"][s] if s < len(old.get("shards", [])) else None
+            if prev and (shard_root / prev["dir"]).is_dir() and set(m) == old_members.get(s, set()):
+                shards.append(prev)
+                continue
+            name = f"shard_{s:02d}.g{generation:06d}"
+            _write_shard(shard_root / name, index, docstore, [position[d] for d in m], m)
+            shards.append({"dir": name, "count": len(m)})
+            rewritten += 1
+
+        layout = {"snapshot": version, "generation": generation, "dim": index.d, "metric": int(index.metric_type),
+                  "total": len(ids), "shards": shards, "assignment": assignment}
+        tmp = shard_root / f".{LAYOUT_FILE}.{os.getpid()}.tmp"
+        tmp.write_text(json.dumps(layout), encoding="utf-8")
+        os.replace(tmp, shard_root / LAYOUT_FILE)
+
+        live = {s["dir"] for s in shards}
+        now = time.time()
+        for d in shard_root.glob("shard_*"):
+            try:
+                if d.name not in live and now - d.stat().st_mtime >= grace_seconds:
+                    shutil.rmtree(d, ignore_errors=True)  # shard processes hold their data in memory
+            except FileNotFoundError:
+                pass
+    moved = sum(1 for doc_id, s in assignment.items() if doc_id in previous and previous[doc_id] != s)
+    log.info("Index shards built", index_dir=index_dir, snapshot=version, shards=n_shards, chunks=len(ids),
+             rewritten=rewritten, moved=moved)
+    return {**layout, "moved": moved, "rewritten": rewritten}
+
+
+# ---------- shard process ----------
+def _shard_main(conn, shard_dir: str, omp_threads: int, max_batch: int) -> None:
+    import faiss
+
+    if omp_threads:
+        faiss.omp_set_num_threads(omp_threads)
+    try:
+        index = faiss.read_index(str(Path(shard_dir) / "index.faiss"))
+        with open(Path(shard_dir) / "docs.pkl", "rb") as fh:
+            docs = pickle.load(fh)
+    except Exception as e:
+        conn.send((None, e))
+        return
+    conn.send((None, index.ntotal))
+    higher_is_better = index.metric_type == faiss.METRIC_INNER_PRODUCT
+
+    while True:
+        try:
+            msgs = [conn.recv()]
+            while len(msgs) < max_batch and conn.poll():
+                msgs.append(conn.recv())
+        except (EOFError, OSError):
+            return
+        searches = [m for m in msgs if m[0] == "search"]
+        if searches:
+            try:
+                queries = np.vstack([m[2] for m in searches]).astype(np.float32, copy=False)
+                k = min(max(m[3] for m in searches), index.ntotal)
+                scores, indices = index.search(queries, k) if k else (None, None)
+            except Exception as e:
+                for m in searches:
+                    conn.send((m[1], e))
+                searches = []
+            row = 0
+            for _, req_id, matrix, want in searches:
+                out = []
+                for q in range(len(matrix)):
+                    hits = []
+                    if k:
+                        for score, i in zip(scores[row + q][:want], indices[row + q][:want]):
+                            if i != -1:
+                                doc_id, text, md = docs[i]
+                                hits.append((float(score), doc_id, text, md))
+                    out.append(hits)
+                row += len(matrix)
+                conn.send((req_id, (higher_is_better, out)))
+        if any(m[0] == "stop" for m in msgs):
+            return
+
+
+class _Shard:
+    """Client side of one shard process: multiplexes requests over a pipe by request id."""
+
+    def __init__(self, shard_dir: Path, ctx: Any, omp_threads: int, max_batch: int):
+        self.dir = shard_dir
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_shard_main, args=(child, str(shard_dir), omp_threads, max_batch),
+                                   name=f"shard-search:{shard_dir.name}", daemon=True)
+        self.process.start()
+        child.close()
+        self.ntotal = 0
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, Future] = {}
+        self._send_lock = threading.Lock()
+        self._reader: Optional[threading.Thread] = None
+
+    def wait_ready(self, timeout_s: float) -> None:
+        if not self.conn.poll(timeout_s):
+            self.process.kill()
+            raise DocumentPortalException(f"Shard {self.dir.name} did not load within {timeout_s}s", None)
+        _, result = self.conn.recv()
+        if isinstance(result, BaseException):
+            raise result
+        self.ntotal = result
+        self._reader = threading.Thread(target=self._read, name=f"shard-reader:{self.dir.name}", daemon=True)
+        self._reader.start()
+
+    def _read(self) -> None:
+        while True:
+            try:
+                req_id, payload = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            fut = self._pending.pop(req_id, None)
+            if fut is None:
+                continue  # reply to a cancelled request: drained and dropped
+            try:
+                if isinstance(payload, BaseException):
+                    fut.set_exception(payload)
+                else:
+                    fut.set_result(payload)
+            except InvalidStateError:  # cancelled while the reply was in flight
+                pass
+        for fut in list(self._pending.values()):  # the process is gone
+            fut.set_exception(DocumentPortalException(f"Shard {self.dir.name} exited", None))
+        self._pending.clear()
+
+    @property
+    def alive(self) -> bool:
+        return self.process.is_alive() and self._reader is not None and self._reader.is_alive()
+
+    def search(self, matrix: np.ndarray, k: int) -> Future:
+        fut: Future = Future()
+        with self._send_lock:
+            req_id = next(self._ids)
+            self._pending[req_id] = fut
+            try:
+                self.conn.send(("search", req_id, matrix, k))
+            except (OSError, ValueError) as e:
+                self._pending.pop(req_id, None)
+                fut.set_exception(e)
+        return fut
+
+    def cancel(self, fut: Future) -> None:
+        """Give up on a request; its reply, if it still comes, is read and dropped."""
+        with self._send_lock:
+            for req_id, pending in list(self._pending.items()):
+                if pending is fut:
+                    del self._pending[req_id]
+        fut.cancel()
+
+    def stop(self, timeout_s: float = 5.0) -> None:
+        """Ask the process to exit once it has answered everything queued before this call."""
+        try:
+            with self._send_lock:
+                self.conn.send(("stop",))
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout_s)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+
+
+# ---------- coordinator ----------
+class ShardedSearch:
+    """Scatter-gather exact search over shard processes of one index directory."""
+
+    def __init__(self, index_dir, n_shards: int = 4, index_name: str = "index", context: str = "spawn",
+                 timeout_s: float = 30.0, omp_threads: int = 1, max_batch: int = 64, grace_seconds: float = 60.0,
+                 check_interval_s: float = 1.0):
+        self.index_dir = Path(index_dir)
+        self.shard_root = self.index_dir / SHARDS_DIR
+        self.n_shards = max(1, int(n_shards))
+        self.index_name = index_name
+        self.ctx = multiprocessing.get_context(context)
+        self.timeout_s = float(timeout_s)
+        self.omp_threads = int(omp_threads)
+        self.max_batch = max(1, int(max_batch))
+        self.grace_seconds = float(grace_seconds)
+        self.check_interval_s = float(check_interval_s)
+        # (shards, layout): replaced as one tuple under _lock, read without it by queries
+        self._live: Tuple[Tuple[_Shard, ...], Dict[str, Any]] = ((), {})
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, index_dir, index_name: str, cfg: Dict[str, Any]) -> "ShardedSearch":
+        grace = (load_config().get("index_snapshots") or {}).get("grace_seconds", 60)
+        return cls(index_dir, n_shards=cfg.get("shards", 4), index_name=index_name,
+                   context=cfg.get("mp_context", "spawn"), timeout_s=cfg.get("timeout_s", 30),
+                   omp_threads=cfg.get("omp_threads", 1), max_batch=cfg.get("max_batch", 64),
+                   grace_seconds=grace, check_interval_s=cfg.get("check_interval_s", 1.0))
+
+    @property
+    def layout(self) -> Dict[str, Any]:
+        return self._live[1]
+
+    # ---------- lifecycle ----------
+    def _build(self) -> Dict[str, Any]:
+        # separate process: splitting loads the whole index, which this process should never hold
+        with ProcessPoolExecutor(max_workers=1, mp_context=self.ctx) as pool:
+            return pool.submit(build_shards, str(self.index_dir), self.index_name, self.n_shards,
+                               self.grace_seconds).result()
+
+    def _stale(self) -> bool:
+        """Under _lock: the disk has a newer snapshot or layout, or a shard process died."""
+        shards, live = self._live
+        self._checked_at = time.monotonic()
+        layout = _read_layout(self.shard_root)
+        version = SnapshotStore(self.index_dir, index_name=self.index_name).current_version() or "legacy"
+        return (layout is None or layout.get("snapshot") != version or len(layout.get("shards", [])) != self.n_shards
+                or layout.get("generation") != live.get("generation")
+                or any(not s.alive for s in shards))
+
+    def _update(self) -> None:
+        layout = _read_layout(self.shard_root)
+        version = SnapshotStore(self.index_dir, index_name=self.index_name).current_version() or "legacy"
+        if layout is None or layout.get("snapshot") != version or len(layout["shards"]) != self.n_shards:
+            layout = self._build()
+        self._apply(layout)
+
+    def _apply(self, layout: Dict[str, Any]) -> None:
+        old = self._live[0]
+        current = {s.dir: s for s in old if s.alive}
+        started = []
+        shards = []
+        for entry in layout["shards"]:
+            path = self.shard_root / entry["dir"]
+            shard = current.pop(path, None)
+            if shard is None:
+                shard = _Shard(path, self.ctx, self.omp_threads, self.max_batch)
+                started.append(shard)
+            shards.append(shard)
+        try:
+            for shard in started:
+                shard.wait_ready(self.timeout_s)
+        except Exception:
+            for shard in started:
+                shard.stop(0)
+            raise
+        self._live = (tuple(shards), {k: v for k, v in layout.items() if k != "assignment"})
+        for shard in old:
+            if shard not in shards:
+                shard.stop()
+        log.info("Shard processes ready", index_dir=str(self.index_dir), shards=len(shards), started=len(started),
+                 chunks=self.layout.get("total"), generation=self.layout.get("generation"))
+
+    def start(self) -> "ShardedSearch":
+        with self._lock:
+            if self._stale():
+                self._update()
+        return self
+
+    def refresh(self) -> bool:
+        """
+        Pick up a newer snapshot or layout. The disk is checked at most every
+        `check_interval_s`; while another thread applies an update, keep serving the current shards.
+        """
+        shards = self._live[0]
+        if shards and all(s.alive for s in shards) and time.monotonic() - self._checked_at < self.check_interval_s:
+            return False
+        if not self._lock.acquire(blocking=not shards):
+            return False
+        try:
+            if not self._stale():
+                return False
+            self._update()
+            return True
+        finally:
+            self._lock.release()
+
+    def add_shards(self, n: int = 1) -> Dict[str, Any]:
+        """Grow to n_shards + n, moving surplus chunks onto the new shards; returns the new layout."""
+        with self._lock:
+            self.n_shards += int(n)
+            layout = self._build()
+            self._apply(layout)
+        return layout
+
+    def close(self) -> None:
+        with self._lock:
+            shards, layout = self._live
+            self._live = ((), layout)
+        for shard in shards:
+            shard.stop()
+
+    # ---------- search ----------
+    def search(self, vectors: np.ndarray, k: int) -> List[List[Hit]]:
+        """Exact top-k for each row of `vectors` (one scatter to every shard, one merge per query)."""
+        shards = self._live[0]
+        if not shards:
+            raise DocumentPortalException("Sharded search is not started", None)
+        matrix = np.ascontiguousarray(np.atleast_2d(vectors), dtype=np.float32)
+        t0 = time.perf_counter()
+        futures = [shard.search(matrix, k) for shard in shards]
+        deadline = time.monotonic() + self.timeout_s
+        try:
+            parts = [f.result(timeout=max(0.0, deadline - time.monotonic())) for f in futures]
+        except BaseException:
+            for shard, fut in zip(shards, futures):
+                shard.cancel(fut)
+            raise
+        observe_stage("shard_search", time.perf_counter() - t0)
+
+        merged = []
+        for q in range(matrix.shape[0]):
+            candidates = []
+            for s, (higher_is_better, per_query) in enumerate(parts):
+                sign = -1.0 if higher_is_better else 1.0
+                for rank, hit in enumerate(per_query[q]):
+                    candidates.append((sign * hit[0], s, rank, hit))
+            merged.append([c[3] for c in heapq.nsmallest(k, candidates, key=lambda c: c[:3])])
+        return merged
+
+    def search_by_vector(self, embedding: Sequence[float], k: int) -> List[Hit]:
+        return self.search(np.asarray([embedding], dtype=np.float32), k)[0]
+
+
+class ShardedRetriever(BaseRetriever):
+    """Embeds the query once and searches every shard of a ShardedSearch."""
+
+    search: Any          # ShardedSearch
+    embeddings: Embeddings
+    k: int = 5
+
+    def _get_relevant_documents(self, query: str, *, run_manager: Optional[CallbackManagerForRetrieverRun] = None
+                                ) -> List[Document]:
+        hits = self.search.search_by_vector(self.embeddings.embed_query(query), self.k)
+        return [Document(page_content=text, metadata={**md, "score": score}) for score, _, text, md in hits]
+
+
+# ---------- per-process registry ----------
+_SEARCHES: Dict[str, ShardedSearch] = {}
+_SEARCHES_LOCK = threading.Lock()
+
+
+def sharding_config() -> Dict[str, Any]:
+    return (load_config().get("retriever") or {}).get("sharded") or {}
+
+
+def get_sharded_search(index_dir, index_name: str = "index") -> ShardedSearch:
+    """The started ShardedSearch for `index_dir` in this process, refreshed to the live snapshot."""
+    key = str(Path(index_dir).resolve())
+    with _SEARCHES_LOCK:
+        search = _SEARCHES.get(key)
+        if search is None:
+            search = _SEARCHES[key] = ShardedSearch.from_config(index_dir, index_name, sharding_config())
+    search.refresh()
+    return search
+
+
+def shutdown_sharded_search() -> None:
+    with _SEARCHES_LOCK:
+        searches = list(_SEARCHES.values())
+        _SEARCHES.clear()
+    for search in searches:
+        search.close()
@@ -1,24 +1,25 @@
 import sys
 from dotenv import load_dotenv
-import pandas as pd
 from logger import GLOBAL_LOGGER as log
 from exception.custom_exception import DocumentPortalException
 from model.models import SummaryResponse, PromptType
 from prompt.prompt_library import PROMPT_REGISTRY #type: ignore
 from utils.model_loader import ModelLoader
-from langchain_core.output_parsers import JsonOutputParser
-from langchain.output_parsers import OutputFixingParser
-import reprlib
+from utils.metrics import timed
+from utils.llm_scheduler import LLMBusy, llm_slot
+from utils.structured_output import StructuredOutputParser
 
 class DocumentComparatorLLM:
     def __init__(self):
         load_dotenv()
         self.loader = ModelLoader()
-        self.llm = self.loader.load_llm()
+        self.llm = self.loader.load_llm(json_mode=True)
 
-        # Prepare parsers
-        self.parser = JsonOutputParser(pydantic_object=SummaryResponse)
-        self.fixing_parser = OutputFixingParser.from_llm(parser=self.parser, llm=self.llm)
+        # Prepare parser: local JSON repair + SummaryResponse validation, re-ask only as a last resort
+        self.parser = StructuredOutputParser(
+            pydantic_object=SummaryResponse, label="document_comparison", reask_llm=self.llm,
+            max_reasks=(self.loader.config.get("structured_output") or {}).get("max_reasks", 1),
+        )
         self.prompt = PROMPT_REGISTRY[PromptType.DOCUMENT_COMPARISON.value]
         self.chain = self.prompt | self.llm | self.parser
         log.info("DocumentComparatorLLM initialized with model and parser.")
@@ -31,21 +32,27 @@ class DocumentComparatorLLM:
                 "combined_docs": combined_docs,
                 "format_instruction": self.parser.get_format_instructions()
             }
-            log.info("Starting document comparison", inputs=reprlib.repr(inputs))
-            response = self.chain.invoke(inputs)
-            log.info("Document comparison completed", response=reprlib.repr(response))
+            # log sizes only: full inputs/outputs are large and would be serialized on every call
+            log.info("Starting document comparison", input_chars=len(combined_docs))
+            with llm_slot("compare", combined_docs), timed("document_comparison"):
+                response = self.chain.invoke(inputs)
+            log.info("Document comparison completed", rows=len(response) if response else 0)
             return self._format_response(response)
+        except LLMBusy:
+            raise
         except Exception as e:
             log.error("Failed to compare documents", error=str(e))
             raise DocumentPortalException("Failed to compare documents", sys)
 
-    def _format_response(self, response_parsed: list[dict]) -> pd.DataFrame: #type: ignore
+    def _format_response(self, response_parsed: list[dict]) -> "pd.DataFrame": #type: ignore
         """
         Format the response from the LLM into a structured format
         """
+        import pandas as pd  # heavy; only needed once a comparison actually runs
+
         try:
             df = pd.DataFrame(response_parsed)
-            log.info("Response formatted into DataFrame", dataframe=reprlib.repr(str(df)))
+            log.debug("Response formatted into DataFrame", shape=df.shape)
             return df
 
         except Exception as e:
@@ -7,45 +7,62 @@ import hashlib
 import shutil
 from pathlib import Path
 from datetime import datetime, timezone
-from typing import Iterable, List, Optional, Dict, Any
+from typing import Iterable, List, Optional, Dict, Any, TYPE_CHECKING
 
-import fitz  # PyMuPDF
-from langchain.schema import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader
-from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
 
 from utils.model_loader import ModelLoader
 from logger import GLOBAL_LOGGER as log
 from exception.custom_exception import DocumentPortalException
 
 from utils.file_io import generate_session_id, save_uploaded_files
-from utils.document_ops import load_documents, concat_for_analysis, concat_for_comparison
+from utils.storage_manager import pinned, touch_access, is_pinned, ACCESS_MARKER
+from utils.metrics import timed, count_chunks, count_cache
+from utils.document_ops import load_documents, concat_for_analysis, concat_for_comparison, pdf_text
+from utils.text_cache import extract_pdf
+from utils.chunker import StructuredChunker
+from utils.dedup import NearDuplicateFilter, strip_page_furniture
+from utils.config_loader import load_config
+from utils.index_snapshots import SnapshotStore
+from utils.coarse_index import CoarseIndex
+
+if TYPE_CHECKING:  # heavy modules are imported lazily where they are used
+    from langchain_community.vectorstores import FAISS
 
 SUPPORTED_EXTENSIONS = {".pdf", ".docx", ".txt"}
+META_FILE = "ingested_meta.json"
 
 # FAISS Manager (load-or-create)
 class FaissManager:
+    """
+    Load-or-create plus idempotent adds over a versioned index directory.
+
+    Every write builds a complete snapshot under the writer lock and publishes it
+    atomically (utils/index_snapshots.py), so concurrent queries keep reading the
+    snapshot they loaded and never see a half-written index.
+    """
     def __init__(self, index_dir: Path, model_loader: Optional[ModelLoader] = None):
         self.index_dir = Path(index_dir)
         self.index_dir.mkdir(parents=True, exist_ok=True)
-        
-        self.meta_path = self.index_dir / "ingested_meta.json"
+
+        snap_cfg = load_config().get("index_snapshots") or {}
+        self.store = SnapshotStore(self.index_dir, keep=snap_cfg.get("keep", 2),
+                                   grace_seconds=snap_cfg.get("grace_seconds", 60))
+        self.snapshot: Optional[Path] = None  # snapshot dir self.vs / self._meta were loaded from
+        self.coarse: Optional[CoarseIndex] = None  # document centroids for hierarchical retrieval
         self._meta: Dict[str, Any] = {"rows": {}}
-        
-        if self.meta_path.exists():
-            try:
-                self._meta = json.loads(self.meta_path.read_text(encoding="utf-8")) or {"rows": {}}
-            except Exception:
-                self._meta = {"rows": {}} # init the empty one if doesn't exist
-        
+        self._meta = self._read_meta(self.store.current())
 
         self.model_loader = model_loader or ModelLoader()
         self.emb = self.model_loader.load_embeddings()
         self.vs: Optional[FAISS] = None
-        
+
+    @property
+    def meta_path(self) -> Path:
+        return (self.snapshot or self.index_dir) / META_FILE
+
     def _exists(self)-> bool:
-        return (self.index_dir / "index.faiss").exists() and (self.index_dir / "index.pkl").exists()
+        return self.store.current() is not None
     
     # @staticmethod
     # def _fingerprint(text: str, md: Dict[str, Any]) -> str:
@@ -62,47 +79,103 @@ class FaissManager:
         # Include text content in the fingerprint to make each chunk unique
         content_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]  # First 16 chars of hash
         return f"{src}::{rid}::{content_hash}" if (src or rid) else content_hash
-    
-    def _save_meta(self):
-        self.meta_path.write_text(json.dumps(self._meta, ensure_ascii=False, indent=2), encoding="utf-8")
-        
-        
+
+    @staticmethod
+    def _read_meta(snapshot: Optional[Path]) -> Dict[str, Any]:
+        if snapshot is not None and (snapshot / META_FILE).exists():
+            try:
+                return json.loads((snapshot / META_FILE).read_text(encoding="utf-8")) or {"rows": {}}
+            except Exception:
+                pass
+        return {"rows": {}} # init the empty one if doesn't exist
+
+    def _load(self, snapshot: Path):
+        from langchain_community.vectorstores import FAISS
+
+        with timed("faiss_load"):
+            self.vs = FAISS.load_local(
+                str(snapshot),
+                embeddings=self.emb,
+                allow_dangerous_deserialization=True,
+            )
+        self.snapshot = snapshot
+        self._meta = self._read_meta(snapshot)
+        self.coarse = CoarseIndex.load(snapshot)
+        touch_access(self.index_dir)
+        return self.vs
+
+    def _update_coarse(self, start: int) -> None:
+        if self.coarse is not None and self.coarse.n_chunks == start:
+            self.coarse.update(self.vs, start)
+        else:  # snapshot predates the coarse index
+            self.coarse = CoarseIndex.build(self.vs)
+
+    def _publish(self) -> None:
+        """Write vs + meta as a new snapshot and swap CURRENT to it (caller holds the write lock)."""
+        staged = self.store.stage()
+        try:
+            with timed("faiss_save"):
+                self.vs.save_local(str(staged))
+                if self.coarse is not None:
+                    self.coarse.save(staged)
+                (staged / META_FILE).write_text(json.dumps(self._meta, ensure_ascii=False, indent=2), encoding="utf-8")
+            self.snapshot = self.store.publish(staged)
+        except Exception:
+            self.store.discard(staged)
+            raise
+
     def add_documents(self,docs: List[Document]):
         if self.vs is None:
             raise RuntimeError("Call load_or_create() before add_documents_idempotent().")
-        
-        new_docs: List[Document] = []
-        
-        for d in docs:
-            key = self._fingerprint(d.page_content, d.metadata or {})
-            if key in self._meta["rows"]:
-                continue
-            self._meta["rows"][key] = True
-            new_docs.append(d)
-            
-        if new_docs:
-            self.vs.add_documents(new_docs)
-            self.vs.save_local(str(self.index_dir))
-            self._save_meta()
+
+        with pinned(self.index_dir), self.store.write_lock():
+            latest = self.store.current()
+            if latest is not None and latest != self.snapshot:
+                self._load(latest)  # another writer published since we loaded; build on top of it
+
+            new_docs: List[Document] = []
+            for d in docs:
+                key = self._fingerprint(d.page_content, d.metadata or {})
+                if key in self._meta["rows"]:
+                    continue
+                self._meta["rows"][key] = True
+                new_docs.append(d)
+            count_cache("ingest_fingerprint", hits=len(docs) - len(new_docs), misses=len(new_docs))
+
+            if new_docs:
+                start = self.vs.index.ntotal
+                with timed("faiss_add"):
+                    self.vs.add_documents(new_docs)
+                self._update_coarse(start)
+                self._publish()
+                count_chunks("indexed", len(new_docs))
         return len(new_docs)
     
     def load_or_create(self, texts: Optional[List[str]] = None, 
         metadatas: Optional[List[Dict[str, Any]]] = None
     ):
+        from langchain_community.vectorstores import FAISS
+
         # if we running first time, it will not go in this block
-        if self._exists():
-            self.vs = FAISS.load_local(
-                str(self.index_dir),
-                embeddings=self.emb,
-                allow_dangerous_deserialization=True,
-            )
-            return self.vs
+        current = self.store.current()
+        if current is not None:
+            return self._load(current)
         
         if not texts:
             raise DocumentPortalException("No existing FAISS index and no data to create one", sys)
         
-        self.vs = FAISS.from_texts(texts=texts, embedding=self.emb, metadatas=metadatas or [])
-        self.vs.save_local(str(self.index_dir))
+        with pinned(self.index_dir), self.store.write_lock():
+            current = self.store.current()
+            if current is not None:  # created by a concurrent writer while we waited
+                return self._load(current)
+            with timed("faiss_build"):
+                self.vs = FAISS.from_texts(texts=texts, embedding=self.emb, metadatas=metadatas or [])
+            # seed the fingerprints so a following add_documents() of the same chunks is a no-op
+            metadatas = metadatas or [{} for _ in texts]
+            self._meta = {"rows": {self._fingerprint(t, m or {}): True for t, m in zip(texts, metadatas)}}
+            self._update_coarse(0)
+            self._publish()
+        count_chunks("indexed", len(texts))
         return self.vs
 
 
@@ -119,6 +192,7 @@ class ChatIngestor:
 
             self.use_session = use_session_dirs
             self.session_id = session_id or generate_session_id()
+            self.chunking: dict = {}  # splitter settings of the last build (see _split)
 
             self.temp_base = Path(temp_base); self.temp_base.mkdir(parents=True, exist_ok=True)
             self.faiss_base = Path(faiss_base); self.faiss_base.mkdir(parents=True, exist_ok=True)
@@ -138,24 +212,80 @@ class ChatIngestor:
             return d
         return base # fallback: "faiss_index/"
 
-    def _split(self, docs: List[Document], chunk_size: int, chunk_overlap: int):
-        splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        chunks = splitter.split_documents(docs)
+    def _split(self, docs: List[Document], chunk_size: Optional[int] = None, chunk_overlap: Optional[int] = None,
+               strategy: Optional[str] = None):
+        """
+        `chunker.strategy` from config unless given: "structured" packs page/heading/paragraph
+        units to a token target (see utils/chunker.py); "recursive" is the character splitter.
+        chunk_size/chunk_overlap are characters; the structured chunker takes them as
+        target_tokens/overlap_tokens at ~4 characters per token. The settings used end up in
+        self.chunking.
+        """
+        cfg = dict(load_config().get("chunker") or {})
+        strategy = strategy or cfg.get("strategy", "recursive")
+        with timed("split"):
+            if strategy == "structured":
+                if chunk_size is not None:
+                    max_tokens = cfg.get("max_tokens") or 512
+                    cfg["target_tokens"] = min(max(1, chunk_size // 4), max_tokens)
+                    cfg["min_tokens"] = min(cfg.get("min_tokens") or 64, cfg["target_tokens"])
+                if chunk_overlap is not None:
+                    cfg["overlap_tokens"] = chunk_overlap // 4
+                splitter = StructuredChunker.from_config(cfg)
+                self.chunking = {"strategy": strategy, "target_tokens": splitter.target_tokens,
+                                 "max_tokens": splitter.max_tokens, "overlap_tokens": splitter.overlap_tokens}
+            else:
+                from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+                chunk_size = 1000 if chunk_size is None else chunk_size
+                chunk_overlap = 200 if chunk_overlap is None else chunk_overlap
+                splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+                self.chunking = {"strategy": strategy, "chunk_size": chunk_size, "chunk_overlap": chunk_overlap}
+            chunks = splitter.split_documents(docs)
+        count_chunks("split", len(chunks))
+        return chunks
+
+    @staticmethod
+    def _strip_furniture(docs: List[Document]) -> List[Document]:
+        cfg = load_config().get("dedup") or {}
+        furniture = cfg.get("furniture") or {}
+        if not cfg.get("enabled", False) or not furniture.get("enabled", False):
+            return docs
+        with timed("strip_furniture"):
+            docs, removed = strip_page_furniture(
+                docs, edge_lines=furniture.get("edge_lines", 3), min_pages=furniture.get("min_pages", 3),
+                min_page_fraction=furniture.get("min_page_fraction", 0.5))
+        if removed:
+            log.info("Page furniture stripped", lines=removed, pages=len(docs))
+        return docs
+
+    @staticmethod
+    def _deduplicate(chunks: List[Document]) -> List[Document]:
+        """Drop near-duplicate chunks (MinHash/LSH); kept chunks record what they absorbed."""
+        cfg = load_config().get("dedup") or {}
+        if not cfg.get("enabled", False):
+            return chunks
+        with timed("dedup"):
+            chunks, dropped = NearDuplicateFilter.from_config(cfg).filter(chunks)
+        count_chunks("near_duplicate", dropped)
         return chunks
 
     def built_retriever(self,
         uploaded_files: Iterable,
         *,
-        chunk_size: int = 1000,
-        chunk_overlap: int = 200,
+        chunk_size: Optional[int] = None,     # characters; None = the chunker's configured size
+        chunk_overlap: Optional[int] = None,
         k: int = 5,
     ):
         try:
-            paths = save_uploaded_files(uploaded_files, self.temp_dir)
-            docs = load_documents(paths)
+            with pinned(self.temp_dir):
+                paths = save_uploaded_files(uploaded_files, self.temp_dir)
+                docs = load_documents(paths)
             if not docs:
                 raise ValueError("No documents loaded")
+            docs = self._strip_furniture(docs)
             chunks = self._split(docs, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+            chunks = self._deduplicate(chunks)
 
 
             # FAISS manager, the core of RAG of document chat
@@ -172,7 +302,8 @@ class ChatIngestor:
             
             added = fm.add_documents(chunks)
             log.info("FAISS index is updated", added=added, session_id=self.session_id)
-            return vs.as_retriever(search_type="similarity", search_kwargs={"k": k})
+            # fm.vs is the published snapshot (it may have been reloaded on top of a concurrent write)
+            return fm.vs.as_retriever(search_type="similarity", search_kwargs={"k": k})
         except Exception as e:
             log.error("Failed to build retriever", error=str(e))
             raise DocumentPortalException("Failed to build retriever", e) from e
@@ -210,13 +341,8 @@ class DocHandler:
 
     def read_pdf(self, pdf_path: str) -> str:
         try:
-            text_chunks = []
-            with fitz.open(pdf_path) as doc:
-                for page_num in range(doc.page_count):
-                    page = doc.load_page(page_num)
-                    text_chunks.append(f"\n--- Page {page_num + 1} ---\n{page.get_text()}")  # type: ignore
-            text = "\n".join(text_chunks)
-            log.info("PDF read successfully", pdf_path=pdf_path, session_id=self.session_id, pages=len(text_chunks))
+            text = pdf_text(pdf_path)  # cached per content hash
+            log.info("PDF read successfully", pdf_path=pdf_path, session_id=self.session_id, chars=len(text))
             return text
         except Exception as e:
             log.error("Failed to read PDF", error=str(e), pdf_path=pdf_path, session_id=self.session_id)
@@ -252,15 +378,8 @@ class DocumentComparator:
 
     def read_pdf(self, pdf_path: Path) -> str:
         try:
-            with fitz.open(pdf_path) as doc:
-                if doc.is_encrypted:
-                    raise ValueError(f"PDF is encrypted: {pdf_path.name}")
-                parts = []
-                for page_num in range(doc.page_count):
-                    page = doc.load_page(page_num)
-                    text = page.get_text()  # type: ignore
-                    if text.strip():
-                        parts.append(f"\n --- Page {page_num + 1} --- \n{text}")
+            pages = extract_pdf(pdf_path).pages  # cached per content hash; raises on encrypted PDFs
+            parts = [f"\n --- Page {p.number} --- \n{p.text}" for p in pages if p.text.strip()]
             log.info("PDF read successfully", file=str(pdf_path), pages=len(parts))
             return "\n".join(parts)
         except Exception as e:
@@ -282,9 +401,19 @@ class DocumentComparator:
             raise DocumentPortalException("Error combining documents", e) from e
 
     def clean_old_sessions(self, keep_latest: int = 3):
+        """
+        Keep only the most recently used sessions. Prefer the background StorageJanitor;
+        this remains for callers that want an explicit, synchronous trim.
+        """
         try:
-            sessions = sorted([f for f in self.base_dir.iterdir() if f.is_dir()], reverse=True)
+            def _last_access(d: Path) -> float:
+                marker = d / ACCESS_MARKER
+                return (marker if marker.exists() else d).stat().st_mtime
+
+            sessions = sorted([f for f in self.base_dir.iterdir() if f.is_dir()], key=_last_access, reverse=True)
             for folder in sessions[keep_latest:]:
+                if folder == self.session_path or is_pinned(folder):
+                    continue
                 shutil.rmtree(folder, ignore_errors=True)
                 log.info("Old session folder deleted", path=str(folder))
         except Exception as e:
@@ -0,0 +1,329 @@
+# tests/test_routes.py
+
+import pytest
+from fastapi.testclient import TestClient
+
+import api.main as api_main
+from benchmarks.fixtures import make_fixture
+from benchmarks.stand_ins import offline_models
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_main, "UPLOAD_BASE", str(tmp_path / "data"))
+    monkeypatch.setattr(api_main, "FAISS_BASE", str(tmp_path / "faiss_index"))
+    monkeypatch.setenv("TEXT_CACHE_DIR", str(tmp_path / "text_cache"))
+    with offline_models():
+        yield tmp_path
+
+
+@pytest.fixture
+def client(workspace):
+    return TestClient(api_main.app)
+
+
+def _index(client, tmp_path, pages=3, **form):
+    pdf = make_fixture(tmp_path / "fixtures", ".pdf", pages)
+    with open(pdf, "rb") as fh:
+        resp = client.post("/chat/index", files=[("files", (pdf.name, fh, "application/pdf"))], data=form)
+    assert resp.status_code == 200, resp.text
+    return resp.json()["session_id"]
+
+
+def test_metrics_exposes_stage_and_endpoint_latency(client, tmp_path):
+    session_id = _index(client, tmp_path)
+    resp = client.post("/chat/query", data={"question": "What about revenue?", "session_id": session_id})
+    assert resp.status_code == 200, resp.text
+
+    body = client.get("/metrics").text
+    for stage in ("save_uploaded_files", "load_documents", "split", "embedding", "faiss_build",
+                  "retrieval", "question_rewrite", "answer_generation"):
+        assert f'docportal_stage_duration_seconds_count{{stage="{stage}"}}' in body, stage
+    assert 'endpoint="/chat/query"' in body
+    assert 'docportal_llm_tokens_total{kind="output"}' in body
+
+
+def test_extracted_text_cache_shared_across_endpoints(client, tmp_path, monkeypatch):
+    from prometheus_client import REGISTRY
+
+    monkeypatch.chdir(tmp_path)  # /analyze and /compare save uploads under ./data
+
+    def lookups(result):
+        return REGISTRY.get_sample_value("docportal_cache_lookups_total",
+                                         {"cache": "extracted_text", "result": result}) or 0.0
+
+    hits, misses = lookups("hit"), lookups("miss")
+    pdf = make_fixture(tmp_path / "fixtures", ".pdf", 2)
+    with open(pdf, "rb") as fh:
+        assert client.post("/analyze", files={"file": (pdf.name, fh, "application/pdf")}).status_code == 200
+    with open(pdf, "rb") as ref, open(pdf, "rb") as act:
+        resp = client.post("/compare", files={"reference": ("ref.pdf", ref, "application/pdf"),
+                                              "actual": ("act.pdf", act, "application/pdf")})
+        assert resp.status_code == 200, resp.text
+    with open(pdf, "rb") as fh:
+        assert client.post("/chat/index", files=[("files", (pdf.name, fh, "application/pdf"))]).status_code == 200
+
+    # one extraction; compare (x2) and chat indexing read the cached pages
+    assert lookups("miss") - misses == 1
+    assert lookups("hit") - hits == 3
+    assert len(list((tmp_path / "text_cache").glob("*/*.bin"))) == 1
+
+
+def test_federated_query_merges_sessions_and_reports_latency(client, tmp_path):
+    first = _index(client, tmp_path, pages=2)
+    second = _index(client, tmp_path, pages=3)
+
+    resp = client.post("/chat/query", data={"question": "What about revenue?", "session_ids": [first, second], "k": 4})
+    assert resp.status_code == 200, resp.text
+    body = resp.json()
+    assert body["session_ids"] == [first, second] and body["answer"]
+    assert set(body["search_latency_ms"]) == {first, second}
+    assert body["search_type"] == "similarity"
+    resp = client.post("/chat/query", data={"question": "q", "session_ids": [first, second], "search_type": "mmr"})
+    assert resp.status_code == 400, resp.text
+
+    assert client.post("/chat/query", data={"question": "q", "session_ids": f"{first},../etc"}).status_code == 400
+    assert client.post("/chat/query", data={"question": "q", "session_ids": f"{first},missing"}).status_code == 404
+
+
+def test_analyze_batch_streams_ndjson_and_isolates_failures(client, tmp_path, monkeypatch):
+    import json
+    import src.document_analyzer.data_analysis as data_analysis
+    from utils.llm_scheduler import LLMBusy
+
+    monkeypatch.setenv("DATA_STORAGE_PATH", str(tmp_path / "document_analysis"))
+    slot, busy = data_analysis.allm_slot, [True]
+
+    def saturated_once(workload, text):  # the scheduler turns the first batch item away
+        if busy:
+            busy.pop()
+            raise LLMBusy(workload, "queue full", 1)
+        return slot(workload, text)
+
+    monkeypatch.setattr(data_analysis, "allm_slot", saturated_once)
+    pdfs = [make_fixture(tmp_path / "fixtures", ".pdf", n) for n in (1, 2, 3)]
+    broken = tmp_path / "broken.pdf"
+    broken.write_bytes(b"%PDF-1.4 not really a pdf")
+    files = [("files", (p.name, p.read_bytes(), "application/pdf")) for p in pdfs]
+    files += [("files", ("notes.txt", b"plain text", "text/plain")),
+              ("files", (broken.name, broken.read_bytes(), "application/pdf"))]
+
+    resp = client.post("/analyze/batch", files=files, data={"max_concurrency": "2"})
+    assert resp.status_code == 200, resp.text
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    summary = lines.pop()["summary"]
+    assert summary["files"] == 5 and summary["ok"] == 3 and summary["error"] == 2
+
+    by_index = {line["index"]: line for line in lines}
+    assert sorted(by_index) == [0, 1, 2, 3, 4]
+    assert by_index[3]["stage"] == "upload" and by_index[4]["stage"] == "parse"
+    for i in range(3):
+        assert by_index[i]["status"] == "ok" and by_index[i]["filename"] == pdfs[i].name
+        assert isinstance(by_index[i]["result"], dict) and by_index[i]["result"]
+    assert not busy  # the item turned away waited retry_after and was analyzed
+
+
+def test_chat_index_maps_chunk_size_onto_structured_chunker(client, tmp_path):
+    pdf = make_fixture(tmp_path / "fixtures", ".pdf", 3)
+
+    def index(**form):
+        return client.post("/chat/index", files=[("files", (pdf.name, pdf.read_bytes(), "application/pdf"))],
+                           data=form)
+
+    resp = index()
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["chunking"] == {"strategy": "structured", "target_tokens": 350, "max_tokens": 512,
+                                       "overlap_tokens": 40}
+    resp = index(chunk_size="800", chunk_overlap="120")
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["chunking"]["target_tokens"] == 200 and resp.json()["chunking"]["overlap_tokens"] == 30
+    assert index(chunk_size="9000").json()["chunking"]["target_tokens"] == 512  # capped at max_tokens
+    assert index(chunk_size="500", chunk_overlap="500").status_code == 400
+    assert index(chunk_size="0").status_code == 400
+
+
+def test_chat_query_selects_chunks_per_request(client, tmp_path):
+    session_id = _index(client, tmp_path)
+    form = {"question": "What about revenue?", "session_id": session_id}
+    resp = client.post("/chat/query", data={**form, "search_type": "mmr", "k": "4", "adaptive_k": "false"})
+    assert resp.status_code == 200, resp.text
+    assert resp.json()["search_type"] == "mmr" and resp.json()["chunks"] == 4
+    resp = client.post("/chat/query", data={**form, "search_type": "similarity_score_threshold",
+                                            "score_threshold": "0.99", "k": "4"})
+    assert resp.status_code == 200 and resp.json()["chunks"] < 4, resp.text
+    assert client.post("/chat/query", data={**form, "search_type": "nearest"}).status_code == 400
+    assert client.post("/chat/query", data={**form, "search_type": "mmr", "lambda_mult": "1.5"}).status_code == 400
+    assert client.post("/chat/query", data={**form, "score_threshold": "2"}).status_code == 400
+
+
+def test_chat_query_rejected_with_429_when_llm_capacity_saturated(client, tmp_path, monkeypatch):
+    import threading
+    from utils import llm_scheduler
+    from utils.llm_scheduler import LLMScheduler, Workload
+
+    session_id = _index(client, tmp_path)
+    sched = LLMScheduler({"chat": Workload("chat", priority=0, max_concurrency=1, max_queue=0)})
+    monkeypatch.setattr(llm_scheduler, "get_scheduler", lambda: sched)
+
+    held, done = threading.Event(), threading.Event()
+
+    def other_request():  # the client shares this thread's context, so hold the slot elsewhere
+        with sched.slot("chat"):
+            held.set()
+            done.wait(10)
+
+    holder = threading.Thread(target=other_request)
+    holder.start()
+    held.wait(5)
+    resp = client.post("/chat/query", data={"question": "What about revenue?", "session_id": session_id})
+    done.set()
+    holder.join(5)
+    assert resp.status_code == 429, resp.text
+    assert int(resp.headers["Retry-After"]) >= 1 and resp.json()["workload"] == "chat"
+
+    resp = client.post("/chat/query", data={"question": "What about revenue?", "session_id": session_id})
+    assert resp.status_code == 200, resp.text
+    assert 'docportal_llm_rejected_total{reason="queue_full",workload="chat"}' in client.get("/metrics").text
+
+
+def test_session_readable_on_another_node_via_shared_snapshots(client, tmp_path, monkeypatch):
+    from utils.index_replication import Replicator
+
+    replicator = Replicator(shared_dir=tmp_path / "shared", token="s3cret")
+    monkeypatch.setattr(api_main, "get_replicator", lambda: replicator)
+    auth = {"X-Replication-Token": "s3cret"}
+    session_id = _index(client, tmp_path)  # "node A" publishes to the shared dir
+    assert (tmp_path / "shared" / f"{session_id}.dpsnap").is_file()
+
+    monkeypatch.setattr(api_main, "FAISS_BASE", str(tmp_path / "node_b"))  # "node B": empty local index dir
+    resp = client.post("/chat/query", data={"question": "What about revenue?", "session_id": session_id})
+    assert resp.status_code == 200, resp.text
+    assert (tmp_path / "node_b" / session_id / "CURRENT").is_file()  # cached locally
+
+    monkeypatch.setattr(api_main, "FAISS_BASE", str(tmp_path / "node_c"))  # "node C" adds to the session
+    published = (tmp_path / "shared" / f"{session_id}.dpsnap").stat().st_mtime_ns
+    assert _index(client, tmp_path, session_id=session_id) == session_id
+    assert (tmp_path / "shared" / f"{session_id}.dpsnap").stat().st_mtime_ns > published
+    pdf = make_fixture(tmp_path / "fixtures", ".pdf", 1)
+    resp = client.post("/chat/index", files=[("files", (pdf.name, pdf.read_bytes(), "application/pdf"))],
+                       data={"session_id": "../escape"})
+    assert resp.status_code == 400 and not (tmp_path / "escape").exists()
+
+    blob = client.get(f"/chat/snapshot/{session_id}", headers=auth)
+    assert blob.status_code == 200 and blob.headers["X-Snapshot-Version"]
+    resp = client.put("/chat/snapshot/copy?replace=false", content=blob.content, headers=auth)
+    assert resp.status_code == 200 and resp.json()["session_id"] == "copy", resp.text
+    assert client.put("/chat/snapshot/copy?replace=false", content=blob.content, headers=auth).status_code == 409
+    assert client.put("/chat/snapshot/broken", content=blob.content[:-7], headers=auth).status_code == 400
+    assert client.get("/chat/snapshot/missing", headers=auth).status_code == 404
+    assert client.get(f"/chat/snapshot/{session_id}").status_code == 403
+
+    replicator.token = None  # no token configured: the routes fail closed
+    assert client.get(f"/chat/snapshot/{session_id}", headers=auth).status_code == 403
+    assert client.put("/chat/snapshot/evil", content=blob.content).status_code == 403
+    assert not (tmp_path / "node_b" / "evil").exists()
+
+
+def test_profiled_request_stores_stage_timings_memory_and_artifacts(tmp_path, monkeypatch):
+    import pstats
+    from fastapi import FastAPI
+    from starlette.concurrency import run_in_threadpool
+    from utils import metrics, profiling
+    from utils.metrics import timed
+    from utils.profiling import Profiler
+
+    monkeypatch.setattr(metrics, "_profiler", None)  # restored after the test
+    profiler = Profiler(tmp_path / "profiles", sample_interval_ms=1, keep=2, token="s3cret").install()
+    app = FastAPI()
+    api_main.install_profiling(app, profiler)
+
+    def crunch(n):
+        return sum(i * i for i in range(n))
+
+    def split():
+        with timed("split"):
+            blob = [bytes(1024) for _ in range(4096)]  # ~4 MiB held while the stage runs
+            crunch(300_000)
+            return len(blob)
+
+    @app.get("/work")
+    async def work():
+        with timed("embedding"):
+            sum(i for i in range(100_000))
+        return {"n": await run_in_threadpool(split)}
+
+    with TestClient(app) as c:
+        assert "X-Profile-Id" not in c.get("/work").headers  # not requested
+        assert "X-Profile-Id" not in c.get("/work", headers={"X-Profile": "1"}).headers  # bad token
+        auth = {"X-Profile-Token": "s3cret"}
+        resp = c.get("/work", headers={"X-Profile": "cprofile", **auth})
+        cprofile_id = resp.headers["X-Profile-Id"]
+        assert c.post("/debug/profile", data={"path": "/work", "mode": "sampling"}, headers=auth).status_code == 200
+        sampling_id = c.get("/work").headers["X-Profile-Id"]
+        assert "X-Profile-Id" not in c.get("/work").headers  # armed for one request only
+
+        summary = c.get(f"/debug/profiles/{cprofile_id}", headers=auth).json()
+        stages = {s["stage"]: s for s in summary["stages"]}
+        assert summary["status"] == 200 and {"split", "embedding"} <= set(stages)
+        assert stages["split"]["peak_bytes"] > 4 * 1024 * 1024 and summary["peak_bytes"] >= stages["split"]["peak_bytes"]
+        blob = c.get(f"/debug/profiles/{cprofile_id}?format=pstats", headers=auth)
+        (tmp_path / "p.pstats").write_bytes(blob.content)
+        functions = {fn for _, _, fn in pstats.Stats(str(tmp_path / "p.pstats")).stats}
+        assert {"work", "crunch"} <= functions  # event-loop thread and the worker thread's stage are both profiled
+
+        collapsed = c.get(f"/debug/profiles/{sampling_id}?format=collapsed", headers=auth).text
+        assert collapsed and all(line.rsplit(" ", 1)[1].isdigit() for line in collapsed.splitlines())
+        assert "[split];" in collapsed
+        assert [p["id"] for p in c.get("/debug/profiles", headers=auth).json()["profiles"]] == [sampling_id, cprofile_id]
+        assert c.get("/debug/profiles").status_code == 403
+        assert c.get(f"/debug/profiles/{sampling_id}?format=pstats", headers=auth).status_code == 404
+
+    # no token configured: profiling is not installed at all
+    monkeypatch.setenv("PROFILING_ENABLED", "1")
+    monkeypatch.delenv("PROFILING_TOKEN", raising=False)
+    profiling.get_profiler.cache_clear()
+    try:
+        assert profiling.get_profiler() is None
+    finally:
+        profiling.get_profiler.cache_clear()
+    assert not Profiler(tmp_path / "open").authorized(None)
+
+
+def test_recorded_traffic_replays_with_session_mapping(workspace, tmp_path, monkeypatch):
+    import asyncio
+    import httpx
+    from fastapi import FastAPI
+    from benchmarks.replay import Payloads, replay
+    from utils.traffic_recorder import TrafficRecorder, read_records
+
+    recorder = TrafficRecorder(tmp_path / "traffic" / "requests.jsonl", store_payloads=True)
+    recording = FastAPI()
+    recording.include_router(api_main.app.router)
+    api_main.install_recording(recording, recorder)
+    with TestClient(recording) as rec:
+        pdf = make_fixture(tmp_path / "fixtures", ".pdf", 3)
+        resp = rec.post("/chat/index", files=[("files", (pdf.name, pdf.read_bytes(), "application/pdf"))])
+        session_id = resp.json()["session_id"]
+        for q in ("What about revenue?", "What about risks?"):
+            assert rec.post("/chat/query", data={"question": q, "session_id": session_id}).status_code == 200
+        assert rec.get("/health").status_code == 200  # excluded
+
+    records = read_records(recorder.path)
+    assert [r["route"] for r in records] == ["/chat/index", "/chat/query", "/chat/query"]
+    assert records[0]["response"] == {"session_id": session_id} and records[0]["files"][0]["size"] == pdf.stat().st_size
+    assert records[1]["form"] == {"question": "What about revenue?", "session_id": session_id}
+
+    monkeypatch.setattr(api_main, "FAISS_BASE", str(tmp_path / "fresh_faiss"))  # recorded session unknown here
+    result = asyncio.run(replay(records, "http://replay", Payloads(recorder.blobs.root, tmp_path / "synth"),
+                                speedup=0, concurrency=4, transport=httpx.ASGITransport(app=api_main.app)))
+    assert result["requests"] == 3 and result["payloads"] == {"recorded": 1, "synthesized": 0}
+    assert result["overall"]["error_rate"] == 0, result
+    query = result["endpoints"]["POST /chat/query"]
+    assert query["n"] == 2 and query["statuses"] == {"200": 2} and query["p99_ms"] >= query["p50_ms"] > 0
+
+    # without payloads the upload is synthesized from its recorded type and size
+    monkeypatch.setattr(api_main, "FAISS_BASE", str(tmp_path / "fresh_faiss_2"))
+    result = asyncio.run(replay(records, "http://replay", Payloads(None, tmp_path / "synth"), speedup=0,
+                                transport=httpx.ASGITransport(app=api_main.app)))
+    assert result["payloads"]["synthesized"] == 1 and result["overall"]["error_rate"] == 0, result
@@ -1,5 +1,7 @@
 # tests/test_unit_cases.py
 
+import gc
+
 import pytest
 from fastapi.testclient import TestClient
 from api.main import app   # or your FastAPI entrypoint
@@ -9,4 +11,643 @@ client = TestClient(app)
 def test_home():
     response = client.get("/")
     assert response.status_code == 200
-    assert "Document Portal" in response.text
\ No newline at end of file
+    assert "Document Portal" in response.text
+
+
+def test_storage_janitor_ttl_budget_and_pins(tmp_path):
+    import os
+    import time
+    from utils.storage_manager import StorageArea, StorageJanitor, pinned, share_while_alive, touch_access
+
+    class Loaded:  # stands in for a vectorstore that another worker process has loaded
+        pass
+
+    base = tmp_path / "faiss_index"
+    now = time.time()
+    for name, age_h in (("old", 48), ("mid", 5), ("new", 1), ("busy", 72), ("loaded", 72)):
+        d = base / name
+        d.mkdir(parents=True)
+        (d / "index.faiss").write_bytes(b"x" * 1000)
+        touch_access(d)
+        ts = now - age_h * 3600
+        os.utime(d / ".last_access", (ts, ts))
+
+    janitor = StorageJanitor(
+        [StorageArea("faiss_index", base, ttl_seconds=24 * 3600, include_files=False)],
+        disk_budget_bytes=3500,
+        grace_seconds=0,
+    )
+    loaded = Loaded()
+    share_while_alive(loaded, base / "loaded")  # a readers flock only: no pin in this process
+    with pinned(base / "busy"):
+        ts = now - 72 * 3600  # pinning records an access; age it again to prove the pin alone protects it
+        os.utime(base / "busy" / ".last_access", (ts, ts))
+        report = janitor.sweep(now=now)
+
+    # "old" expired by TTL, "mid" evicted as LRU to meet the budget, "busy" and "loaded" are in use
+    assert sorted(p.name for p in base.iterdir()) == ["busy", "loaded", "new"]
+    assert report.deleted == {"faiss_index": 2}
+    assert report.reclaimed_bytes["faiss_index"] >= 2000
+    assert report.skipped_in_use == 2 and report.skipped_recent == 0
+
+    del loaded
+    gc.collect()  # unloaded: the readers flock is released
+    expire_all = [StorageArea("faiss_index", base, ttl_seconds=0, include_files=False)]
+    report = StorageJanitor(expire_all, grace_seconds=2 * 3600).sweep(now=time.time())
+    assert report.deleted == {"faiss_index": 1}
+    assert report.skipped_recent == 2 and report.skipped_in_use == 0  # "busy" (just released) and "new"
+    assert sorted(p.name for p in base.iterdir()) == ["busy", "new"]
+
+
+def test_log_listener_stop_is_bounded_when_the_queue_is_not_drained():
+    import queue
+    import time
+    from logger.custom_logger import DrainingQueueListener
+
+    q = queue.Queue(maxsize=2)
+    q.put_nowait("record-1")
+    q.put_nowait("record-2")
+    listener = DrainingQueueListener(q)  # as inherited by a forked worker: no listener thread
+    listener.sentinel_timeout = 0.05
+    t0 = time.perf_counter()
+    listener.enqueue_sentinel()
+    assert time.perf_counter() - t0 < 1
+    assert [q.get_nowait(), q.get_nowait()] == ["record-2", listener._sentinel]
+
+
+def test_offline_benchmark_smoke():
+    from benchmarks.run_benchmarks import run
+
+    report = run(pages=[1, 2], repeats=2, shard_chunks=2000)
+    results = report["results"]
+    assert {r["format"] for r in results["load_documents"]} == {".pdf", ".docx", ".txt"}
+    assert results["faiss"]["vectors"] > 0
+    assert results["endpoints"]["chat_query"]["n"] == 2
+
+
+def test_local_providers_selected_without_api_keys(monkeypatch):
+    import numpy as np
+    from utils.model_loader import ModelLoader
+    from utils.local_models import HashingEmbeddings, TemplateChatModel
+
+    for key in ("GOOGLE_API_KEY", "GROQ_API_KEY"):
+        monkeypatch.delenv(key, raising=False)
+    monkeypatch.setattr("utils.model_loader.load_dotenv", lambda: None)
+    monkeypatch.setenv("EMBEDDING_PROVIDER", "local")
+    monkeypatch.setenv("LLM_PROVIDER", "local")
+
+    loader = ModelLoader()
+    emb, llm = loader.load_embeddings(), loader.load_llm()
+    assert isinstance(emb.base, HashingEmbeddings) and isinstance(llm, TemplateChatModel)
+
+    vecs = np.array(emb.embed_documents(["revenue grew this quarter", "revenue grew this quarter", "warranty terms"]))
+    assert np.allclose(np.linalg.norm(vecs, axis=1), 1.0, atol=1e-5)
+    assert vecs[0] @ vecs[1] > 0.999 and vecs[0] @ vecs[2] < 0.5
+
+    streamed = "".join(c.content for c in llm.stream("hello local model"))
+    assert streamed == llm.invoke("hello local model").content == "hello local model"
+
+
+def test_batched_embeddings_preserve_order_and_back_off_on_rate_limits():
+    import numpy as np
+    from utils.embedding_executor import BatchedEmbeddings
+    from utils.local_models import HashingEmbeddings, SimulatedRateLimitEmbeddings
+
+    local = HashingEmbeddings(dimensions=64)
+    texts = [f"chunk {i} about topic {i % 7} " * (1 + i % 5) for i in range(300)]
+    throttled = SimulatedRateLimitEmbeddings(local, requests_per_second=10, max_batch_size=16)
+    executor = BatchedEmbeddings(throttled, concurrency=4, max_batch_tokens=400, min_batch_tokens=50,
+                                 max_batch_size=16, max_retries=50, backoff_base_s=0.05, backoff_max_s=0.5)
+
+    vecs = executor.embed_documents(texts)
+    assert np.allclose(vecs, local.embed_documents(texts))
+    assert throttled.rejected > 0
+    assert executor.stats["retries"] == executor.stats["rate_limited"] == throttled.rejected
+    assert executor.stats["batches"] == throttled.requests
+    assert executor.min_batch_tokens <= executor.batch_tokens <= executor.max_batch_tokens
+
+
+def test_llm_router_hedges_slow_provider_and_fails_over():
+    import asyncio
+    import time
+    from utils.llm_router import LLMRouter
+    from utils.local_models import TemplateChatModel
+
+    class Broken(TemplateChatModel):
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            raise RuntimeError("503 upstream unavailable")
+
+    slow = TemplateChatModel(latency_ms=400, template="slow: $input")
+    fast = TemplateChatModel(latency_ms=10, template="fast: $input")
+    router = LLMRouter(providers=[("t-slow", slow), ("t-fast", fast)], hedge_initial_delay_s=0.05)
+
+    t0 = time.perf_counter()
+    assert router.invoke("hi").content == "fast: hi"  # slow primary is hedged after 50ms
+    assert time.perf_counter() - t0 < 0.3
+    time.sleep(0.5)  # the abandoned slow call still reports its latency
+    assert [name for name, _ in router.ranked()] == ["t-fast", "t-slow"]
+    assert asyncio.run(router.ainvoke("hi")).content == "fast: hi"
+
+    failover = LLMRouter(providers=[("t-broken", Broken()), ("t-backup", fast)], hedge=False, failure_threshold=2)
+    for _ in range(2):
+        assert failover.invoke("hi").content == "fast: hi"
+    assert failover.snapshot()["t-broken"]["healthy"] is False
+    assert failover.ranked()[0][0] == "t-backup"
+    assert "".join(c.content for c in failover.stream("hi")) == "fast: hi"
+
+
+def test_structured_chunker_respects_tokens_pages_and_sources():
+    from langchain_core.documents import Document
+    from utils.chunker import StructuredChunker
+
+    para = "The contract renews yearly unless either party objects in writing. " * 2
+    docs = [
+        Document(page_content=f"1. Introduction\n\n{para}\n\n{para}", metadata={"source": "a.pdf", "page": 0}),
+        Document(page_content=f"{para}\n\nWARRANTY TERMS\n\n{para}", metadata={"source": "a.pdf", "page": 1}),
+        Document(page_content="x " * 5000, metadata={"source": "b.pdf", "page": 0}),  # no structure at all
+    ]
+    chunker = StructuredChunker(target_tokens=200, max_tokens=300, min_tokens=40, overlap_tokens=30)
+    chunks = chunker.split_documents(docs)
+
+    assert all(c.metadata["tokens"] <= 300 for c in chunks)
+    assert all(c.metadata["source"] in ("a.pdf", "b.pdf") for c in chunks)
+    assert not any("WARRANTY" in c.page_content and "x x" in c.page_content for c in chunks)
+    warranty = next(c for c in chunks if "WARRANTY TERMS" in c.page_content)
+    assert warranty.page_content.startswith("WARRANTY TERMS") and warranty.metadata["page"] == 1
+    assert any(c.metadata["page"] == 0 and c.metadata["page_end"] == 1 for c in chunks)  # short pages are packed
+    assert "".join(c.page_content for c in chunks if c.metadata["source"] == "b.pdf").count("x") == 5000
+
+
+def test_text_cache_tracks_size_and_scans_only_when_over_budget(tmp_path):
+    import os
+    from utils.text_cache import ExtractedPdf, PageText, TextCache
+
+    cache = TextCache(tmp_path, max_bytes=7000, compress_level=0)
+    scans = []
+    evict = cache.evict
+    cache.evict = lambda: scans.append(1) or evict()
+    doc = ExtractedPdf([PageText(1, os.urandom(1000).hex())], {"page_count": 1})  # ~2 KB per entry
+    for i in range(3):
+        cache.put(f"{i:02d}" * 32, "v1", doc)
+        os.utime(cache._path(f"{i:02d}" * 32, "v1"), (i, i))  # read order: 0 oldest
+    assert len(scans) == 1 and cache._size == sum(p.stat().st_size for p in tmp_path.glob("*/*.bin"))
+
+    cache.put("03" * 32, "v1", doc)  # over budget: one scan evicts the least recently read entry
+    assert len(scans) == 2 and cache.get("00" * 32, "v1") is None and cache.get("03" * 32, "v1") is not None
+    assert cache._size <= cache.max_bytes
+
+    entry = cache._path("03" * 32, "v1")
+    blob = entry.read_bytes()
+    entry.write_bytes(b"\0" * 4 + blob[4:])  # corrupt entry: dropped from disk and from the estimate
+    size = cache._size
+    assert cache.get("03" * 32, "v1") is None and cache._size == size - len(blob)
+    assert cache._size == sum(p.stat().st_size for p in tmp_path.glob("*/*.bin")) and len(scans) == 2
+
+
+def test_faiss_writes_publish_atomic_snapshots(tmp_path):
+    import threading
+    from langchain_core.documents import Document
+    from benchmarks.stand_ins import offline_models
+    from src.document_ingestion.data_ingestion import FaissManager
+    from src.document_chat.retrieval import ConversationalRAG
+    from utils.index_snapshots import SnapshotStore
+
+    def docs(tag, n):
+        return [Document(page_content=f"{tag} clause {i} covers renewal", metadata={"source": f"{tag}.pdf"})
+                for i in range(n)]
+
+    with offline_models():
+        seed = docs("seed", 5)
+        fm = FaissManager(tmp_path)
+        fm.load_or_create([d.page_content for d in seed], [d.metadata for d in seed])
+        assert fm.add_documents(seed) == 0  # seeded fingerprints: no second embedding pass
+
+        rag = ConversationalRAG(session_id="s")
+        rag.load_retriever_from_faiss(str(tmp_path), k=3)
+        first_snapshot = rag.snapshot
+
+        added = []
+
+        def write(tag):
+            writer = FaissManager(tmp_path)
+            writer.load_or_create()  # all three load the same snapshot, then race to publish
+            added.append(writer.add_documents(docs(tag, 4)))
+
+        writers = [threading.Thread(target=write, args=(t,)) for t in ("alpha", "beta", "gamma")]
+        for w in writers:
+            w.start()
+        for w in writers:
+            w.join()
+
+        latest = FaissManager(tmp_path)
+        latest.load_or_create()
+        assert added == [4, 4, 4] and latest.vs.index.ntotal == 5 + 3 * 4  # no write was lost
+        assert not SnapshotStore._thread_locks  # per-directory writer locks are dropped once unused
+        assert rag.snapshot == first_snapshot and rag.snapshot.exists()  # reader kept (and pinned) its snapshot
+        assert rag.refresh() and rag.snapshot == latest.snapshot
+
+        store = SnapshotStore(tmp_path, keep=1, grace_seconds=0)
+        del rag
+        gc.collect()
+        store.gc()
+        remaining = sorted(p.name for p in (tmp_path / "snapshots").iterdir())
+        assert remaining == [store.current_version()]
+
+
+def test_federated_retriever_matches_single_combined_index():
+    import numpy as np
+    from langchain_community.vectorstores import FAISS
+    from src.document_chat.federated import FederatedRetriever
+    from utils.local_models import HashingEmbeddings
+
+    emb = HashingEmbeddings(dimensions=128)
+    texts = [f"topic {t} note {i}" for t in ("revenue", "warranty", "privacy") for i in range(6)]
+    shards = [FAISS.from_texts(texts[i::3], emb) for i in range(3)]
+    combined = FAISS.from_texts(texts, emb)
+
+    retriever = FederatedRetriever(stores=[(f"s{i}", s) for i, s in enumerate(shards)], embeddings=emb, k=5)
+    docs = retriever.invoke("warranty note 3")
+    expected = combined.similarity_search_with_score("warranty note 3", k=5)
+    assert docs[0].page_content == expected[0][0].page_content == "topic warranty note 3"
+    # same global top-k (up to ties) as one index holding everything, merged in score order
+    assert np.allclose([d.metadata["score"] for d in docs], [score for _, score in expected], atol=1e-5)
+    assert set(retriever.timings) == {"s0", "s1", "s2"}
+
+
+def test_hierarchical_retrieval_searches_top_documents_and_keeps_recall(tmp_path, monkeypatch):
+    import numpy as np
+    from langchain_core.documents import Document
+    from src.document_chat.hierarchical import HierarchicalRetriever
+    from src.document_ingestion.data_ingestion import FaissManager
+    from utils.coarse_index import CoarseIndex
+
+    topics = ["revenue", "warranty", "privacy", "shipping", "payroll", "audit"]
+    docs = [Document(page_content=f"{t} clause {i} about {t} terms", metadata={"source": f"{t}.pdf"})
+            for t in topics for i in range(8)]
+    monkeypatch.setenv("EMBEDDING_PROVIDER", "local")
+    monkeypatch.setenv("LLM_PROVIDER", "local")
+    fm = FaissManager(tmp_path / "idx")
+    fm.load_or_create([d.page_content for d in docs[:24]], [d.metadata for d in docs[:24]])
+    fm.add_documents(docs[24:])  # incremental update of the coarse index
+
+    coarse = CoarseIndex.load(fm.snapshot)
+    rebuilt = CoarseIndex.build(fm.vs)
+    assert coarse.n_docs == 6 and coarse.n_chunks == fm.vs.index.ntotal == 48
+    assert np.allclose(coarse.centroids(), rebuilt.centroids(), atol=1e-5)
+
+    retriever = HierarchicalRetriever(store=fm.vs, coarse=coarse, k=4, top_docs=2)
+    hits = retriever.invoke("payroll clause 3 about payroll terms")
+    flat = fm.vs.similarity_search("payroll clause 3 about payroll terms", k=4)
+    assert hits[0].page_content == "payroll clause 3 about payroll terms"
+    assert [d.page_content for d in hits] == [d.page_content for d in flat]
+    top = {coarse.sources[i] for i in coarse.top_documents(
+        np.asarray(fm.vs.embedding_function.embed_query("payroll clause 3")), 2)}
+    assert {d.metadata["source"] for d in hits} <= top
+
+
+def test_page_furniture_and_near_duplicate_chunks_are_removed_with_provenance():
+    from langchain_core.documents import Document
+    from utils.dedup import NearDuplicateFilter, strip_page_furniture
+
+    disclaimer = ("This report is provided for information purposes only and does not constitute "
+                  "an offer or solicitation to buy or sell any security or financial instrument.")
+    topics = ["revenue", "warranty", "privacy", "shipping", "payroll", "audit", "leases", "pensions"]
+    pages = [
+        Document(page_content=f"ACME Corp - Confidential\nThe {topic} section of {src} explains {topic} "
+                              f"obligations.\nPage {p + 1} of 4",
+                 metadata={"source": f"{src}.pdf", "page": p})
+        for (src, p), topic in zip([(s, p) for s in ("q1", "q2") for p in range(4)], topics)
+    ]
+    cleaned, removed = strip_page_furniture(pages)
+    assert removed == 16 and all(d.metadata["furniture_lines"] == 2 for d in cleaned)
+    assert cleaned[0].page_content == "The revenue section of q1 explains revenue obligations."
+
+    # short pages (slides): a content line repeated on every page is not furniture
+    slides = [Document(page_content=f"ACME Corp - Confidential\nAgenda: revenue, risks and outlook\n"
+                                    f"The {topic} slide covers {topic}.\nSlide {p + 1}",
+                       metadata={"source": "deck.pptx", "page": p})
+              for p, topic in enumerate(topics[:4])]
+    kept_slides, removed = strip_page_furniture(slides)
+    assert removed == 8
+    assert kept_slides[0].page_content == "Agenda: revenue, risks and outlook\nThe revenue slide covers revenue."
+
+    chunks = [Document(page_content=d.page_content, metadata=d.metadata) for d in cleaned]
+    chunks += [Document(page_content=disclaimer + suffix, metadata={"source": src, "page": 9})
+               for src, suffix in (("q1.pdf", ""), ("q2.pdf", " "), ("q3.pdf", " Rev 2"))]
+    kept, dropped = NearDuplicateFilter(threshold=0.8).filter(chunks)
+    assert dropped == 2 and len(kept) == 9
+    assert kept[-1].metadata["source"] == "q1.pdf"
+    assert kept[-1].metadata["near_duplicates"] == ["q2.pdf#9", "q3.pdf#9"]
+    assert kept[-1].metadata["near_duplicate_count"] == 2
+
+
+def test_batch_parsing_yields_as_completed_within_a_window():
+    import asyncio
+    import time
+    from utils.parse_pool import parse_as_completed
+
+    started = []
+
+    def parse(n):
+        started.append(n)
+        if n == 3:
+            raise ValueError("bad pdf")
+        time.sleep(0.2 if n == 0 else 0.0)
+        return n * 10
+
+    async def consume():
+        out = []
+        async for i, result in parse_as_completed(parse, range(6), workers=0, window=2):
+            assert len(started) <= len(out) + 2  # never more than the window ahead of the consumer
+            out.append((i, result))
+        return out
+
+    out = asyncio.run(consume())
+    assert out[0] == (1, 10)  # a slow file does not hold back the ones parsed after it
+    assert sorted(i for i, _ in out) == list(range(6))
+    assert isinstance(dict(out)[3], ValueError) and dict(out)[5] == 50
+
+
+def test_llm_scheduler_priority_limits_and_rejection():
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from utils.llm_scheduler import LLMBusy, LLMScheduler, Workload
+
+    sched = LLMScheduler({
+        "chat": Workload("chat", priority=0, max_concurrency=2, max_queue=4, max_wait_s=5, expected_tokens=0),
+        "batch": Workload("batch", priority=2, max_concurrency=2, max_queue=2, max_wait_s=5, expected_tokens=0),
+    }, max_concurrency=1, poll_interval_s=0.01)
+    order = []
+
+    def run(name):
+        with sched.slot(name.split("-")[0]):
+            order.append(name)
+
+    def wait_queued(workload, n):
+        while sched.snapshot()["workloads"][workload]["queued"] < n:
+            time.sleep(0.005)
+
+    with sched.slot("batch"):  # the single global slot is busy
+        threads = [threading.Thread(target=run, args=(n,)) for n in ("batch-1", "batch-2")]
+        for t in threads:
+            t.start()
+        wait_queued("batch", 2)
+        with pytest.raises(LLMBusy) as busy:  # batch queue is bounded (another thread: slots nest per context)
+            ThreadPoolExecutor(1).submit(run, "batch-3").result()
+        assert busy.value.reason == "queue full" and busy.value.retry_after >= 1
+        chat = threading.Thread(target=run, args=("chat-1",))
+        chat.start()
+        wait_queued("chat", 1)
+    for t in threads + [chat]:
+        t.join(5)
+    assert order == ["chat-1", "batch-1", "batch-2"]  # interactive work overtakes queued batch work
+
+    # token budget: the second call needs 20s of refill, more than it may wait
+    sched = LLMScheduler({"analyze": Workload("analyze", max_wait_s=0.1, expected_tokens=4000)},
+                         tokens_per_minute=6000, poll_interval_s=0.01)
+    with sched.slot("analyze"):
+        pass
+    with pytest.raises(LLMBusy) as busy:
+        with sched.slot("analyze"):
+            pass
+    assert busy.value.reason == "queue wait timeout" and 15 <= busy.value.retry_after <= 21
+    state = sched.snapshot()["workloads"]["analyze"]
+    assert state["active"] == 0 and state["queued"] == 0
+
+    # the API queues on the event loop: waiting requests hold no worker threads, and the
+    # component's own slot() inside the granted work does not take a second one
+    import asyncio
+    from starlette.concurrency import run_in_threadpool
+
+    sched = LLMScheduler({"chat": Workload("chat", max_concurrency=1, max_queue=64, expected_tokens=0)},
+                         poll_interval_s=0.01)
+    baseline = threading.active_count()
+
+    def work():
+        with sched.slot("chat"):
+            time.sleep(0.002)
+            return sched.snapshot()["active"], threading.active_count()
+
+    async def request():
+        async with sched.aslot("chat"):
+            return await run_in_threadpool(work)
+
+    async def burst():
+        return await asyncio.gather(*(request() for _ in range(60)))
+
+    results = asyncio.run(burst())
+    assert all(active == 1 for active, _ in results)
+    assert max(threads for _, threads in results) <= baseline + 2
+
+
+def test_structured_output_repairs_locally_and_reasks_only_as_last_resort():
+    from langchain_core.exceptions import OutputParserException
+    from langchain_core.language_models import FakeListChatModel
+    from prometheus_client import REGISTRY
+    from model.models import Metadata, SummaryResponse
+    from utils.structured_output import StructuredOutputParser, repair_json
+
+    assert repair_json('```json\n{"Title": "A", "Author": "B",}\n```\nHope this helps!') == \
+        ({"Title": "A", "Author": "B"}, True)
+    assert repair_json('<think>{draft}</think>{"Title": "A", "Summary": ["x", "cut off') == \
+        ({"Title": "A", "Summary": ["x", "cut off"]}, True)
+    assert repair_json('{"Title": "A", "PageCount": tr')[0] == {"Title": "A"}
+
+    def count(label, outcome):
+        return REGISTRY.get_sample_value("docportal_structured_output_total",
+                                         {"parser": label, "outcome": outcome}) or 0.0
+
+    full = ('{"Title": "Fixed", "Author": "A", "DateCreated": "2024", "LastModifiedDate": "2024", '
+            '"Publisher": "P", "Language": "en", "PageCount": 1, "SentimentTone": "neutral"}')
+    reasker = FakeListChatModel(responses=[full])
+    parser = StructuredOutputParser(pydantic_object=Metadata, label="t_analysis", reask_llm=reasker)
+    meta = parser.parse('Here you go: {"title": "Report", "author": "A", "DateCreated": "2024", '
+                        '"LastModifiedDate": "2024", "Publisher": "P", "Language": "en", '
+                        '"SentimentTone": "neutral", "PageCount": 3')
+    assert meta["Title"] == "Report" and meta["PageCount"] == 3 and meta["Summary"] == []  # default filled
+    assert count("t_analysis", "repaired") == 1 and reasker.i == 0  # no LLM round trip
+
+    assert parser.parse("I could not read the document.")["Title"] == "Fixed"
+    assert count("t_analysis", "reasked") == 1
+    # missing required fields are re-asked, not papered over with placeholders
+    assert parser.parse('{"Title": "Cut off", "Author": "A"')["Title"] == "Fixed"
+    assert count("t_analysis", "reasked") == 2 and count("t_analysis", "repaired") == 1
+
+    # re-asks used up: placeholders as a last resort, counted on their own
+    stubborn = StructuredOutputParser(pydantic_object=Metadata, label="t_analysis",
+                                      reask_llm=FakeListChatModel(responses=['{"Title": "Still partial"}']))
+    meta = stubborn.parse("{}")
+    assert meta["Title"] == "Still partial" and meta["Author"] == "Not Available"
+    assert count("t_analysis", "placeholder") == 1
+
+    rows = StructuredOutputParser(pydantic_object=SummaryResponse, label="t_compare").parse(
+        '{"changes": [{"page": "1", "changes": "NO CHANGE"}, {"Page": "2"')
+    assert rows == [{"Page": "1", "changes": "NO CHANGE"}, {"Page": "2", "changes": "Not Available"}]
+    assert count("t_compare", "placeholder") == 1 and count("t_compare", "repaired") == 0
+    with pytest.raises(OutputParserException):
+        StructuredOutputParser(pydantic_object=SummaryResponse, label="t_compare").parse("no json")
+    assert count("t_compare", "failed") == 1
+
+
+def test_index_snapshot_export_import_and_pull_from_peer(tmp_path):
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from langchain_core.documents import Document
+    from benchmarks.stand_ins import offline_models
+    from src.document_ingestion.data_ingestion import FaissManager
+    from utils.index_replication import Replicator, SnapshotError, SnapshotExport, import_snapshot
+    from utils.index_snapshots import SnapshotStore
+
+    with offline_models():
+        docs = [Document(page_content=f"clause {i} covers renewal", metadata={"source": "a.pdf"}) for i in range(6)]
+        fm = FaissManager(tmp_path / "a" / "s1")
+        fm.load_or_create([d.page_content for d in docs], [d.metadata for d in docs])
+        origin = fm.snapshot
+        blob = b"".join(SnapshotExport(tmp_path / "a" / "s1", chunk_bytes=4096).chunks())
+
+        # any chunking of the stream decodes to the same files
+        assert import_snapshot(tmp_path / "b" / "s1", (blob[i:i + 777] for i in range(0, len(blob), 777)))
+        copy = SnapshotStore(tmp_path / "b" / "s1").current()
+        files = [p for p in origin.iterdir() if not p.name.startswith(".")]
+        assert sorted(p.name for p in copy.iterdir() if not p.name.startswith(".")) == sorted(p.name for p in files)
+        assert all((copy / p.name).read_bytes() == p.read_bytes() for p in files)
+        replica = FaissManager(tmp_path / "b" / "s1")
+        replica.load_or_create()
+        assert replica.vs.index.ntotal == 6 and replica.add_documents(docs) == 0  # dedup metadata came along
+
+        corrupt = bytearray(blob)
+        corrupt[-10] ^= 0xFF
+        for bad in (bytes(corrupt), blob[:-5], blob + b"x"):
+            with pytest.raises(SnapshotError):
+                import_snapshot(tmp_path / "c" / "s1", [bad])
+            assert not (tmp_path / "c" / "s1").exists()  # nothing published, nothing left behind
+
+        class Peer(BaseHTTPRequestHandler):
+            def do_GET(self):
+                found = self.path == "/chat/snapshot/s1"
+                self.send_response(200 if found else 404)
+                self.end_headers()
+                if found:
+                    self.wfile.write(blob)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Peer)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            replicator = Replicator(peers=["http://127.0.0.1:1", f"http://127.0.0.1:{server.server_port}"],
+                                    timeout_s=2)
+            assert replicator.ensure_local("s1", tmp_path / "d" / "s1")  # first peer is down, second has it
+            assert SnapshotStore(tmp_path / "d" / "s1").current() is not None
+            assert not replicator.ensure_local("s2", tmp_path / "d" / "s2")
+            assert not (tmp_path / "d" / "s2").exists()
+            replicator.max_misses = 2
+            for sid in ("s3", "s4", "s5"):
+                replicator.ensure_local(sid, tmp_path / "d" / sid)
+            assert list(replicator._misses) == ["s4", "s5"] and not replicator._locks  # both stay bounded
+        finally:
+            server.shutdown()
+
+
+def test_sharded_search_matches_flat_and_rebalances_onto_new_shards(tmp_path):
+    import os
+    import signal
+    import numpy as np
+    from langchain_community.vectorstores import FAISS
+    from src.document_chat.sharded import ShardedSearch
+    from utils.index_snapshots import SnapshotStore
+    from utils.local_models import HashingEmbeddings
+
+    rng = np.random.default_rng(0)
+    store = SnapshotStore(tmp_path)
+
+    def publish(vs):
+        with store.write_lock():
+            staged = store.stage()
+            vs.save_local(str(staged))
+            store.publish(staged)
+
+    def rows(n, start=0):
+        return [(f"chunk {start + i}", v.tolist()) for i, v in enumerate(rng.normal(size=(n, 32)))]
+
+    vs = FAISS.from_embeddings(rows(500), HashingEmbeddings(dimensions=32),
+                               metadatas=[{"row": i} for i in range(500)])
+    publish(vs)
+    queries = rng.normal(size=(20, 32)).astype(np.float32)
+
+    def assert_exact(search):
+        got = search.search(queries, 7)
+        for q, hits in zip(queries, got):
+            expected = vs.similarity_search_with_score_by_vector(q.tolist(), k=7)
+            assert [h[3]["row"] for h in hits] == [d.metadata["row"] for d, _ in expected]
+            assert np.allclose([h[0] for h in hits], [s for _, s in expected], rtol=1e-5)
+
+    search = ShardedSearch(tmp_path, n_shards=3, timeout_s=60, check_interval_s=0).start()
+    try:
+        assert [s["count"] for s in search.layout["shards"]] == [167, 167, 166]
+        assert_exact(search)
+
+        layout = search.add_shards(1)  # surplus of the 3 shards moves to the new one, nothing else
+        assert [s["count"] for s in layout["shards"]] == [125, 125, 125, 125]
+        assert layout["moved"] == 125 and layout["rewritten"] == 4
+        assert_exact(search)
+
+        vs.add_embeddings(rows(40, start=500), metadatas=[{"row": 500 + i} for i in range(40)])
+        publish(vs)
+        assert search.refresh() and search.layout["total"] == 540
+        assert sorted(s["count"] for s in search.layout["shards"]) == [135, 135, 135, 135]
+        assert_exact(search)
+
+        # a query timing out on a stalled shard cancels its requests; the late reply is dropped
+        stalled = search._live[0][0].process.pid
+        search.timeout_s = 0.5
+        os.kill(stalled, signal.SIGSTOP)
+        try:
+            with pytest.raises(TimeoutError):
+                search.search(queries[:1], 7)
+            assert not any(shard._pending for shard in search._live[0])
+        finally:
+            os.kill(stalled, signal.SIGCONT)
+        search.timeout_s = 60
+        assert_exact(search)
+    finally:
+        search.close()
+
+
+def test_chunk_selection_modes_diversify_cut_off_and_stop_early():
+    import numpy as np
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.vectorstores.utils import maximal_marginal_relevance
+    from src.document_chat.selection import SelectiveRetriever, select
+    from utils.local_models import HashingEmbeddings
+
+    rng = np.random.default_rng(0)
+    a, b, c = np.eye(8)[:3]
+    noise = lambda: 0.01 * rng.normal(size=8)
+    cands = np.stack([a + noise(), a + noise(), a + noise(), 0.95 * b + 0.3 * a, c]).astype(np.float32)
+    query = a + 0.5 * b
+
+    order, _ = select(query, cands, 3)
+    assert sorted(order.tolist()) == [0, 1, 2]  # plain top-k: three copies of the same chunk
+    order, _ = select(query, cands, 3, mmr=True, lambda_mult=0.5)
+    assert order[0] in (0, 1, 2) and order[1] == 3  # mmr: the copies give way to the other relevant chunk
+    order, scores = select(query, cands, 5, score_threshold=0.2)
+    assert 4 not in order and (scores >= 0.2).all()
+    order, _ = select(query, cands, 5, mmr=True, adaptive_k=True, min_k=1)
+    assert order[0] in (0, 1, 2) and order[1] == 3 and len(order) == 2  # then only copies / off-topic remain
+
+    big = rng.normal(size=(60, 32)).astype(np.float32)
+    q = rng.normal(size=32).astype(np.float32)
+    for lam in (0.2, 0.5, 0.9):  # same picks as LangChain's reference implementation
+        assert select(q, big, 8, mmr=True, lambda_mult=lam)[0].tolist() == \
+            maximal_marginal_relevance(q, list(big), lambda_mult=lam, k=8)
+
+    emb = HashingEmbeddings(dimensions=64)
+    texts = ["renewal terms apply yearly"] * 4 + ["invoices are due in thirty days", "the office has a cafe"]
+    store = FAISS.from_texts(texts, emb)
+    retriever = SelectiveRetriever(store=store, embeddings=emb, k=3, fetch_k=6, search_type="mmr")
+    hits = retriever.invoke("renewal terms and invoices due")
+    assert [d.page_content for d in hits][:2] == ["renewal terms apply yearly", "invoices are due in thirty days"]
+    assert retriever.last_selected == 3 and all("score" in d.metadata for d in hits)
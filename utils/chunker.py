@@ -0,0 +1,206 @@
+"""
+Structure- and token-aware document chunking.
+
+StructuredChunker packs pages into chunks of about `target_tokens`, never more than
+`max_tokens`, and prefers to cut at headings, then page breaks, then paragraph ends.
+The steps are:
+
+1. Segment each page into units: headings, then paragraphs, then sentences. A
+   sentence that is still larger than `max_tokens` is cut into whitespace-aligned
+   windows.
+2. Greedily pack units into chunks, carrying up to `overlap_tokens` of trailing
+   units into the next chunk of the same source.
+
+Each character is scanned a constant number of times, so multi-MB texts split in
+linear time. Chunk metadata keeps the source document's metadata plus the first
+page (`page`, as the PDF loaders report it), `page_end` and the token estimate.
+"""
+from __future__ import annotations
+import re
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from langchain_core.documents import Document
+
+from logger import GLOBAL_LOGGER as log
+
+_PARAGRAPH_RE = re.compile(r"\n[ \t]*\n+")
+_SENTENCE_RE = re.compile(r"[^.!?\n]+(?:[.!?]+[\"')\]]*|\n|$)\s*")
+_WORD_RE = re.compile(r"\S+\s*")
+_HEADING_RE = re.compile(
+    r"^(?:#{1,6}\s+\S.*"                          # markdown
+    r"|(?:\d+(?:\.\d+)*\.?|[IVXLC]+\.)\s+[A-Z]\S.*"   # 1.2 Numbered / IV. Roman
+    r"|[A-Z][A-Z0-9 ,:&/()\-]{2,79})$"          # ALL CAPS line
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """~4 characters per token, the same estimate the embedding executor budgets with."""
+    return max(1, len(text) // 4)
+
+
+def token_counter(name: str = "estimate") -> Callable[[str], int]:
+    """'estimate' (default) or 'tiktoken[:<encoding>]' when tiktoken is installed."""
+    if name.startswith("tiktoken"):
+        try:
+            import tiktoken
+        except ImportError:
+            log.warning("tiktoken not installed, falling back to estimated token counts")
+            return estimate_tokens
+        enc = tiktoken.get_encoding(name.partition(":")[2] or "cl100k_base")
+        return lambda text: len(enc.encode_ordinary(text))
+    return estimate_tokens
+
+
+@dataclass
+class _Unit:
+    text: str
+    tokens: int
+    doc: int          # index into the input documents (page)
+    heading: bool = False
+    page_start: bool = False
+    sep: str = "\n\n"  # joins this unit to the previous one in a chunk
+
+
+class StructuredChunker:
+    """Drop-in for a LangChain text splitter: split_documents(docs) -> chunk Documents."""
+
+    def __init__(
+        self,
+        target_tokens: int = 350,
+        max_tokens: int = 512,
+        min_tokens: int = 64,
+        overlap_tokens: int = 40,
+        count_tokens: Callable[[str], int] = estimate_tokens,
+    ):
+        if not 0 < min_tokens <= target_tokens <= max_tokens:
+            raise ValueError("chunker requires 0 < min_tokens <= target_tokens <= max_tokens")
+        self.target_tokens = target_tokens
+        self.max_tokens = max_tokens
+        self.min_tokens = min_tokens
+        self.overlap_tokens = min(overlap_tokens, target_tokens // 2)
+        self.count_tokens = count_tokens
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> "StructuredChunker":
+        keys = ("target_tokens", "max_tokens", "min_tokens", "overlap_tokens")
+        return cls(**{k: cfg[k] for k in keys if cfg.get(k) is not None},
+                   count_tokens=token_counter(cfg.get("tokenizer", "estimate")))
+
+    # ---------- segmentation ----------
+    def _pieces(self, text: str, pattern: re.Pattern) -> Iterator[str]:
+        for m in pattern.finditer(text):
+            piece = m.group().strip()
+            if piece:
+                yield piece
+
+    def _units(self, text: str, doc: int) -> Iterator[_Unit]:
+        first = True
+        for para in _PARAGRAPH_RE.split(text):
+            para = para.strip()
+            if not para:
+                continue
+            head, _, rest = para.partition("\n")
+            if len(head) <= 120 and _HEADING_RE.match(head.strip()):
+                yield _Unit(head.strip(), self.count_tokens(head), doc, True, first)
+                first = False
+                para = rest.strip()
+                if not para:
+                    continue
+            tokens = self.count_tokens(para)
+            if tokens <= self.target_tokens:
+                yield _Unit(para, tokens, doc, False, first)
+                first = False
+                continue
+            sep = "\n\n"
+            for sentence in self._pieces(para, _SENTENCE_RE):
+                for piece in self._fit(sentence):
+                    yield _Unit(piece, self.count_tokens(piece), doc, False, first, sep)
+                    first, sep = False, " "
+
+    def _fit(self, sentence: str) -> Iterator[str]:
+        """The sentence itself, or whitespace-aligned windows of at most max_tokens."""
+        if self.count_tokens(sentence) <= self.max_tokens:
+            yield sentence
+            return
+        width = self.max_tokens * 4  # characters per window under the ~4 chars/token estimate
+        start, n = 0, len(sentence)
+        while start < n:
+            end = min(n, start + width)
+            if end < n:
+                cut = sentence.rfind(" ", start + 1, end)
+                end = cut if cut > start else end
+            piece = sentence[start:end].strip()
+            if piece:
+                if self.count_tokens(piece) > self.max_tokens:
+                    yield from self._word_windows(piece)  # real tokenizer disagrees with the estimate
+                else:
+                    yield piece
+            start = end
+
+    def _word_windows(self, text: str) -> Iterator[str]:
+        window: List[str] = []
+        size = 0
+        for word in self._pieces(text, _WORD_RE):
+            w = self.count_tokens(word)
+            if window and size + w > self.max_tokens:
+                yield " ".join(window)
+                window, size = [], 0
+            window.append(word)
+            size += w
+        if window:
+            yield " ".join(window)
+
+    # ---------- packing ----------
+    def _emit(self, units: List[_Unit], docs: List[Document]) -> Document:
+        first, last = docs[units[0].doc], docs[units[-1].doc]
+        meta = dict(first.metadata)
+        if "page" in last.metadata:
+            meta["page_end"] = last.metadata["page"]
+        meta["tokens"] = sum(u.tokens for u in units)
+        text = units[0].text + "".join(u.sep + u.text for u in units[1:])
+        return Document(page_content=text, metadata=meta)
+
+    def split_documents(self, docs: List[Document]) -> List[Document]:
+        chunks: List[Document] = []
+        current: List[_Unit] = []
+        size = 0
+        source: Optional[str] = None
+
+        def flush(carry: bool) -> None:
+            nonlocal current, size
+            if not current:
+                return
+            chunks.append(self._emit(current, docs))
+            tail: List[_Unit] = []
+            if carry and self.overlap_tokens:
+                kept = 0
+                for u in reversed(current):
+                    if kept + u.tokens > self.overlap_tokens:
+                        break
+                    tail.append(u)
+                    kept += u.tokens
+                tail.reverse()
+            current, size = tail, sum(u.tokens for u in tail)
+
+        for i, doc in enumerate(docs):
+            doc_source = doc.metadata.get("source")
+            if doc_source != source:
+                flush(carry=False)  # never mix (or overlap) different files
+                current, size, source = [], 0, doc_source
+            for unit in self._units(doc.page_content, i):
+                if current and (
+                    size + unit.tokens > self.max_tokens
+                    or size >= self.target_tokens
+                    # a new section starts a new chunk once the current one is big enough
+                    or (unit.heading and size >= self.min_tokens)
+                    # rather than straddle a page break, end the chunk at it when nearly full
+                    or (unit.page_start and size >= self.min_tokens and size + unit.tokens > self.target_tokens)
+                ):
+                    flush(carry=not unit.heading)
+                    while current and size + unit.tokens > self.max_tokens:
+                        size -= current.pop(0).tokens  # overlap must not push a chunk past max_tokens
+                current.append(unit)
+                size += unit.tokens
+        flush(carry=False)
+        return chunks
@@ -0,0 +1,132 @@
+"""
+Document-level ("coarse") index over a chunk-level FAISS store.
+
+Each source document is represented by the centroid of its chunk embeddings. The
+coarse index keeps per-document vector sums and chunk counts, plus the owning
+document of every FAISS id. It is updated incrementally from the vectors a write
+adds, and saved next to the FAISS files in each snapshot (coarse.npz, no pickle).
+
+Hierarchical retrieval (src/document_chat/hierarchical.py) ranks documents by
+centroid similarity first and then searches only those documents' chunks.
+"""
+from __future__ import annotations
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from logger import GLOBAL_LOGGER as log
+
+COARSE_FILE = "coarse.npz"
+
+
+def _doc_key(metadata: Dict[str, Any]) -> str:
+    return str(metadata.get("source") or metadata.get("file_path") or "unknown")
+
+
+class CoarseIndex:
+    """Per-document centroid sums and the chunk -> document map of one FAISS store."""
+
+    def __init__(self, sources: Optional[List[str]] = None, sums: Optional[np.ndarray] = None,
+                 counts: Optional[np.ndarray] = None, doc_of: Optional[np.ndarray] = None):
+        self.sources: List[str] = list(sources or [])
+        self.sums = sums                                  # (n_docs, dim) float64
+        self.counts = counts if counts is not None else np.zeros(0, dtype=np.int64)
+        self.doc_of = doc_of if doc_of is not None else np.zeros(0, dtype=np.int32)  # faiss id -> doc
+        self._slot = {s: i for i, s in enumerate(self.sources)}
+        self._centroids: Optional[np.ndarray] = None
+        self._order: Optional[np.ndarray] = None
+        self._offsets: Optional[np.ndarray] = None
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.sources)
+
+    @property
+    def n_chunks(self) -> int:
+        return int(self.doc_of.shape[0])
+
+    # ---------- build ----------
+    def update(self, vs: Any, start: Optional[int] = None) -> int:
+        """Fold FAISS ids [start, ntotal) of `vs` into the index; returns how many were added."""
+        start = self.n_chunks if start is None else start
+        if start != self.n_chunks:
+            raise ValueError(f"coarse index covers {self.n_chunks} ids, cannot continue from {start}")
+        end = int(vs.index.ntotal)
+        if end <= start:
+            return 0
+        vectors = vs.index.reconstruct_n(start, end - start).astype(np.float64)
+        if self.sums is None:
+            self.sums = np.zeros((0, vectors.shape[1]), dtype=np.float64)
+
+        owners = np.empty(end - start, dtype=np.int32)
+        for j, faiss_id in enumerate(range(start, end)):
+            doc = vs.docstore.search(vs.index_to_docstore_id[faiss_id])
+            key = _doc_key(getattr(doc, "metadata", None) or {})
+            slot = self._slot.get(key)
+            if slot is None:
+                slot = self._slot[key] = len(self.sources)
+                self.sources.append(key)
+            owners[j] = slot
+
+        n_docs = len(self.sources)
+        if self.sums.shape[0] < n_docs:
+            grow = n_docs - self.sums.shape[0]
+            self.sums = np.vstack([self.sums, np.zeros((grow, self.sums.shape[1]))])
+            self.counts = np.concatenate([self.counts, np.zeros(grow, dtype=np.int64)])
+        np.add.at(self.sums, owners, vectors)
+        self.counts += np.bincount(owners, minlength=n_docs)
+        self.doc_of = np.concatenate([self.doc_of, owners])
+        self._centroids = self._order = self._offsets = None
+        return end - start
+
+    @classmethod
+    def build(cls, vs: Any) -> "CoarseIndex":
+        coarse = cls()
+        coarse.update(vs, 0)
+        return coarse
+
+    # ---------- persistence ----------
+    def save(self, directory) -> None:
+        sums = self.sums if self.sums is not None else np.zeros((0, 0))
+        with open(Path(directory) / COARSE_FILE, "wb") as fh:
+            np.savez(fh, sources=np.array(self.sources, dtype=str), sums=sums,
+                     counts=self.counts, doc_of=self.doc_of)
+
+    @classmethod
+    def load(cls, directory) -> Optional["CoarseIndex"]:
+        path = Path(directory) / COARSE_FILE
+        if not path.exists():
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                return cls([str(s) for s in data["sources"]], data["sums"], data["counts"], data["doc_of"])
+        except Exception as e:
+            log.warning("Ignoring unreadable coarse index", path=str(path), error=str(e))
+            return None
+
+    # ---------- search ----------
+    def centroids(self) -> np.ndarray:
+        if self._centroids is None:
+            c = self.sums / np.maximum(self.counts, 1)[:, None]
+            norms = np.linalg.norm(c, axis=1, keepdims=True)
+            self._centroids = (c / np.where(norms > 0, norms, 1.0)).astype(np.float32)
+        return self._centroids
+
+    def top_documents(self, query: np.ndarray, n: int) -> np.ndarray:
+        """Indices of the `n` documents whose centroid is most cosine-similar to `query`."""
+        q = np.asarray(query, dtype=np.float32).ravel()
+        q = q / (np.linalg.norm(q) or 1.0)
+        scores = self.centroids() @ q
+        if n >= scores.shape[0]:
+            return np.argsort(-scores)
+        top = np.argpartition(-scores, n)[:n]
+        return top[np.argsort(-scores[top])]
+
+    def chunk_ids(self, docs: np.ndarray) -> np.ndarray:
+        """FAISS ids of every chunk belonging to `docs`."""
+        if self._order is None:
+            self._order = np.argsort(self.doc_of, kind="stable").astype(np.int64)
+            self._offsets = np.searchsorted(self.doc_of[self._order], np.arange(self.n_docs + 1))
+        return np.concatenate([self._order[self._offsets[d]:self._offsets[d + 1]] for d in docs]) \
+            if len(docs) else np.zeros(0, dtype=np.int64)
@@ -1,6 +1,9 @@
 import yaml
+from functools import lru_cache
 
+@lru_cache(maxsize=8)
 def load_config(config_path: str = "config/config.yaml") -> dict:
+    """Parse the YAML once per process; the returned dict is shared and must be treated as read-only."""
     with open(config_path, "r") as file:
         config = yaml.safe_load(file)
     return config
@@ -0,0 +1,211 @@
+"""
+Near-duplicate removal before embedding.
+
+Two passes run on a chat ingestion batch:
+
+1. `strip_page_furniture` runs on pages, before chunking. It finds lines repeated at
+   the top or bottom of many pages, across all files of the batch: running headers,
+   footers, "Page 3 of 40", confidentiality notices. Those lines are removed. Digits
+   are masked when comparing lines, so page numbers and dates do not hide the repeat.
+2. `NearDuplicateFilter` runs on chunks. It computes MinHash signatures of word
+   shingles with NumPy, all permutations at once, and buckets them with LSH bands.
+   A chunk whose estimated Jaccard similarity to an earlier kept chunk reaches
+   `threshold` is dropped.
+
+Provenance is kept. A kept chunk lists the locations ("source#page") of the
+duplicates folded into it under `near_duplicates`. A page records how many
+furniture lines were removed under `furniture_lines`.
+"""
+from __future__ import annotations
+import re
+import zlib
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from logger import GLOBAL_LOGGER as log
+
+_WORD_RE = re.compile(r"\w+")
+_DIGITS_RE = re.compile(r"\d+")
+_SPACE_RE = re.compile(r"\s+")
+_MAX_LOCATIONS = 20  # provenance entries kept per chunk
+
+
+def _normalize_line(line: str) -> str:
+    return _SPACE_RE.sub(" ", _DIGITS_RE.sub("#", line.strip().lower()))
+
+
+def _location(metadata: Dict[str, Any]) -> str:
+    source = str(metadata.get("source") or metadata.get("file_path") or "unknown")
+    page = metadata.get("page")
+    return source if page is None else f"{source}#{page}"
+
+
+# ---------- page furniture ----------
+def strip_page_furniture(docs: List[Document], edge_lines: int = 3, min_pages: int = 3,
+                         min_page_fraction: float = 0.5) -> Tuple[List[Document], int]:
+    """
+    Remove lines that repeat within the first/last `edge_lines` lines of pages. On short
+    pages (slides, forms) each edge covers at most a third of the non-blank lines, so
+    the middle of a page is never treated as furniture.
+
+    A line counts as furniture when it appears on at least `min_pages` pages in total,
+    and on at least `min_page_fraction` of the pages of the file being cleaned. Only
+    paginated documents (metadata "page") are considered. Returns the cleaned pages
+    (new Documents) and the number of lines removed.
+    """
+    pages_per_source: Counter = Counter()
+    seen_total: Counter = Counter()
+    seen_in_source: Counter = Counter()
+    edges: List[Dict[int, str]] = []
+    for doc in docs:
+        if "page" not in doc.metadata:
+            edges.append({})
+            continue
+        lines = doc.page_content.splitlines()
+        nonblank = [i for i, line in enumerate(lines) if line.strip()]
+        n = min(edge_lines, len(nonblank) // 3)
+        picked = nonblank[:n] + nonblank[len(nonblank) - n:] if n else []
+        edge = {i: _normalize_line(lines[i]) for i in picked}
+        edges.append(edge)
+        source = doc.metadata.get("source")
+        pages_per_source[source] += 1
+        for key in set(edge.values()):
+            seen_total[key] += 1
+            seen_in_source[(source, key)] += 1
+
+    cleaned, removed = [], 0
+    for doc, edge in zip(docs, edges):
+        source = doc.metadata.get("source")
+        drop = {
+            i for i, key in edge.items()
+            if seen_total[key] >= min_pages
+            and seen_in_source[(source, key)] >= min_page_fraction * pages_per_source[source]
+        }
+        if not drop:
+            cleaned.append(doc)
+            continue
+        lines = doc.page_content.splitlines()
+        text = "\n".join(line for i, line in enumerate(lines) if i not in drop)
+        cleaned.append(Document(page_content=text, metadata={**doc.metadata, "furniture_lines": len(drop)}))
+        removed += len(drop)
+    return cleaned, removed
+
+
+# ---------- MinHash / LSH ----------
+def _lsh_shape(num_perm: int, threshold: float, recall: float = 0.99) -> Tuple[int, int]:
+    """
+    (bands, rows) for LSH banding of `num_perm`-long signatures.
+
+    Picks the most selective split (largest `rows`) that still makes a pair at exactly
+    `threshold` a candidate with probability >= `recall`. Extra candidates are cheap,
+    because each one is checked against the full signature.
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        if 1.0 - (1.0 - threshold ** rows) ** bands < recall:
+            break
+        best = (bands, rows)
+    return best
+
+
+class NearDuplicateFilter:
+    """MinHash/LSH near-duplicate filter over chunk Documents (first occurrence wins)."""
+
+    def __init__(self, threshold: float = 0.85, num_perm: int = 128, shingle_words: int = 5,
+                 block_shingles: int = 1 << 14, seed: int = 1):
+        if not 0.0 < threshold <= 1.0:
+            raise ValueError("dedup threshold must be in (0, 1]")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_words = max(1, shingle_words)
+        self.block_shingles = block_shingles
+        self.bands, self.rows = _lsh_shape(num_perm, threshold)
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 1 << 63, num_perm, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64)
+        self._band_mix = rng.integers(1, 1 << 63, self.rows, dtype=np.uint64) | np.uint64(1)
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> "NearDuplicateFilter":
+        keys = ("threshold", "num_perm", "shingle_words")
+        return cls(**{k: cfg[k] for k in keys if cfg.get(k) is not None})
+
+    def _shingles(self, text: str) -> np.ndarray:
+        words = _WORD_RE.findall(text.lower())
+        if not words:
+            return np.zeros(1, dtype=np.uint64)
+        hashes = np.fromiter((zlib.crc32(w.encode("utf-8")) for w in words), dtype=np.uint64, count=len(words))
+        n = min(self.shingle_words, len(hashes))
+        # polynomial roll over n consecutive word hashes (uint64 arithmetic wraps)
+        out = np.zeros(len(hashes) - n + 1, dtype=np.uint64)
+        for j in range(n):
+            out = out * np.uint64(1_000_003) + hashes[j:len(hashes) - n + 1 + j]
+        return np.unique(out)
+
+    def signatures(self, texts: List[str]) -> np.ndarray:
+        """(len(texts), num_perm) uint32 MinHash signatures."""
+        sigs = np.empty((len(texts), self.num_perm), dtype=np.uint32)
+        shingles = [self._shingles(t) for t in texts]
+        start = 0
+        while start < len(texts):
+            # batch texts until the (num_perm x shingles) matrix reaches block_shingles columns
+            end, width = start, 0
+            while end < len(texts) and (end == start or width + len(shingles[end]) <= self.block_shingles):
+                width += len(shingles[end])
+                end += 1
+            block = np.concatenate(shingles[start:end])
+            offsets = np.cumsum([0] + [len(s) for s in shingles[start:end - 1]])
+            # multiply-shift hashing: the high 32 bits of a*x + b (mod 2^64) per permutation
+            hashed = (self._a[:, None] * block[None, :] + self._b[:, None]) >> np.uint64(32)
+            sigs[start:end] = np.minimum.reduceat(hashed, offsets, axis=1).T.astype(np.uint32)
+            start = end
+        return sigs
+
+    def _band_keys(self, sigs: np.ndarray) -> np.ndarray:
+        """(n, bands) uint64 bucket keys, one per LSH band."""
+        banded = sigs[:, :self.bands * self.rows].astype(np.uint64).reshape(len(sigs), self.bands, self.rows)
+        return (banded * self._band_mix).sum(axis=2)
+
+    def filter(self, chunks: List[Document]) -> Tuple[List[Document], int]:
+        """Kept chunks (in input order, provenance added) and the number dropped."""
+        if len(chunks) < 2:
+            return list(chunks), 0
+        sigs = self.signatures([c.page_content for c in chunks])
+        keys = self._band_keys(sigs)
+        buckets: List[Dict[int, List[int]]] = [defaultdict(list) for _ in range(self.bands)]
+        folded: Dict[int, List[int]] = {}
+        kept: List[int] = []
+        for i in range(len(chunks)):
+            candidates = {j for band, key in enumerate(keys[i]) for j in buckets[band].get(int(key), ())}
+            match: Optional[int] = None
+            if candidates:
+                cand = np.fromiter(sorted(candidates), dtype=np.int64)
+                similarity = (sigs[cand] == sigs[i]).mean(axis=1)
+                best = int(np.argmax(similarity))
+                if similarity[best] >= self.threshold:
+                    match = int(cand[best])
+            if match is not None:
+                folded.setdefault(match, []).append(i)
+                continue
+            kept.append(i)
+            for band, key in enumerate(keys[i]):
+                buckets[band][int(key)].append(i)
+
+        out = []
+        for i in kept:
+            chunk = chunks[i]
+            if i in folded:
+                locations = [_location(chunks[j].metadata) for j in folded[i]]
+                chunk = Document(page_content=chunk.page_content,
+                                 metadata={**chunk.metadata, "near_duplicates": locations[:_MAX_LOCATIONS],
+                                           "near_duplicate_count": len(locations)})
+            out.append(chunk)
+        dropped = len(chunks) - len(out)
+        if dropped:
+            log.info("Near-duplicate chunks dropped", dropped=dropped, kept=len(out),
+                     threshold=self.threshold, bands=self.bands, rows=self.rows)
+        return out, dropped
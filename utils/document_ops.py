@@ -9,26 +9,28 @@ from pathlib import Path
 from datetime import datetime, timezone
 from typing import Iterable, List, Optional, Dict, Any
 
-import fitz  # PyMuPDF
-from langchain.schema import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader
-from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
 
-from utils.model_loader import ModelLoader
 from logger import GLOBAL_LOGGER as log
 from exception.custom_exception import DocumentPortalException
+from utils.metrics import timed_stage, count_chunks
+from utils.text_cache import extract_pdf
 
 SUPPORTED_EXTENSIONS = {".pdf", ".docx", ".txt"}
 
+@timed_stage("load_documents")
 def load_documents(paths: Iterable[Path]) -> List[Document]:
     """Load docs using appropriate loader based on extension."""
+    # loaders pull in langchain_community; import on first use, not at app start
+    from langchain_community.document_loaders import Docx2txtLoader, TextLoader
+
     docs: List[Document] = []
     try:
         for p in paths:
             ext = p.suffix.lower()
             if ext == ".pdf":
-                loader = PyPDFLoader(str(p))
+                docs.extend(pdf_documents(p))
+                continue
             elif ext == ".docx":
                 loader = Docx2txtLoader(str(p))
             elif ext == ".txt":
@@ -37,12 +39,29 @@ def load_documents(paths: Iterable[Path]) -> List[Document]:
                 log.warning("Unsupported extension skipped", path=str(p))
                 continue
             docs.extend(loader.load())
+        count_chunks("loaded", len(docs))
         log.info("Documents loaded", count=len(docs))
         return docs
     except Exception as e:
         log.error("Failed loading documents", error=str(e))
         raise DocumentPortalException("Error loading documents", e) from e
 
+def pdf_documents(path: Path) -> List[Document]:
+    """One Document per page from the shared extracted-text cache (same extractor as /analyze and /compare)."""
+    extracted = extract_pdf(path)
+    total = len(extracted.pages)
+    return [
+        Document(page_content=page.text,
+                 metadata={"source": str(path), "page": page.number - 1, "page_label": str(page.number),
+                           "total_pages": total, **page.meta})
+        for page in extracted.pages
+    ]
+
+def pdf_text(path) -> str:
+    """Page-delimited text of a PDF as sent to the analysis prompt (module-level so process pools can run it)."""
+    pages = extract_pdf(path).pages
+    return "\n".join(f"\n--- Page {p.number} ---\n{p.text}" for p in pages)
+
 def concat_for_analysis(docs: List[Document]) -> str:
     parts = []
     for d in docs:
@@ -0,0 +1,224 @@
+"""
+Embedding executor: token-sized batches, bounded concurrency, rate limiting, retries.
+
+BatchedEmbeddings wraps any LangChain Embeddings provider. A call to embed_documents()
+is cut into batches by estimated token count, executed by a small thread pool under
+request/token buckets, retried with full-jitter exponential backoff, and reassembled
+in input order. The batch budget adapts (AIMD): it grows while batches come back
+under the target latency and shrinks on slow batches or errors such as HTTP 429.
+"""
+from __future__ import annotations
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from langchain_core.embeddings import Embeddings
+
+from logger import GLOBAL_LOGGER as log
+from exception.custom_exception import DocumentPortalException
+
+
+def estimate_tokens(text: str) -> int:
+    """Provider-agnostic estimate (~4 characters per token for English text)."""
+    return max(1, len(text) // 4)
+
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until `amount` tokens are available."""
+
+    def __init__(self, rate_per_s: float, capacity: Optional[float] = None):
+        self.rate = float(rate_per_s)
+        self.capacity = float(capacity if capacity is not None else rate_per_s)
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def wait_time(self, amount: float = 1.0) -> float:
+        """Seconds until `amount` tokens are available (0 if they are now); takes nothing."""
+        amount = min(float(amount), self.capacity)
+        with self._lock:
+            self._refill()
+            return max(0.0, (amount - self._tokens) / self.rate)
+
+    def take(self, amount: float = 1.0) -> None:
+        """Take `amount` tokens without waiting (check wait_time() first)."""
+        amount = min(float(amount), self.capacity)
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+
+    def acquire(self, amount: float = 1.0) -> float:
+        """Take `amount` tokens, sleeping as needed; returns the time spent waiting."""
+        amount = min(float(amount), self.capacity)  # oversize requests wait for a full bucket
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return waited
+                delay = (amount - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def is_rate_limit_error(exc: BaseException) -> bool:
+    text = f"{type(exc).__name__} {exc}".lower()
+    return any(s in text for s in ("429", "rate limit", "ratelimit", "resourceexhausted", "resource exhausted", "quota"))
+
+
+class BatchedEmbeddings(Embeddings):
+    """Order-preserving concurrent embedding with adaptive batch sizing; delegates to `base`."""
+
+    def __init__(
+        self,
+        base: Embeddings,
+        *,
+        concurrency: int = 4,
+        max_batch_tokens: int = 8000,
+        min_batch_tokens: int = 256,
+        max_batch_size: int = 100,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_retries: int = 5,
+        backoff_base_s: float = 0.5,
+        backoff_max_s: float = 20.0,
+        target_batch_latency_s: float = 2.0,
+        count_tokens: Callable[[str], int] = estimate_tokens,
+    ):
+        self.base = base
+        self.concurrency = max(1, int(concurrency))
+        self.max_batch_tokens = int(max_batch_tokens)
+        self.min_batch_tokens = int(min(min_batch_tokens, max_batch_tokens))
+        self.max_batch_size = int(max_batch_size)
+        self.max_retries = int(max_retries)
+        self.backoff_base_s = float(backoff_base_s)
+        self.backoff_max_s = float(backoff_max_s)
+        self.target_batch_latency_s = float(target_batch_latency_s)
+        self.count_tokens = count_tokens
+
+        self._request_bucket = TokenBucket(requests_per_minute / 60.0) if requests_per_minute else None
+        self._token_bucket = TokenBucket(tokens_per_minute / 60.0) if tokens_per_minute else None
+        self._budget_lock = threading.Lock()
+        self.batch_tokens = self.max_batch_tokens  # adaptive; starts optimistic
+        self.stats = {"batches": 0, "retries": 0, "rate_limited": 0, "throttle_wait_s": 0.0}
+
+    @classmethod
+    def from_config(cls, base: Embeddings, cfg: dict) -> "BatchedEmbeddings":
+        keys = ("concurrency", "max_batch_tokens", "min_batch_tokens", "max_batch_size", "requests_per_minute",
+                "tokens_per_minute", "max_retries", "backoff_base_s", "backoff_max_s", "target_batch_latency_s")
+        return cls(base, **{k: cfg[k] for k in keys if cfg.get(k) is not None})
+
+    # ---------- adaptive batch budget ----------
+    def _on_success(self, latency_s: float) -> None:
+        with self._budget_lock:
+            if latency_s > self.target_batch_latency_s:
+                self.batch_tokens = max(self.min_batch_tokens, int(self.batch_tokens * 0.75))
+            else:
+                step = max(1, self.max_batch_tokens // 10)
+                self.batch_tokens = min(self.max_batch_tokens, self.batch_tokens + step)
+
+    def _on_error(self) -> None:
+        with self._budget_lock:
+            self.batch_tokens = max(self.min_batch_tokens, self.batch_tokens // 2)
+
+    # ---------- execution ----------
+    def _throttle(self, tokens: int) -> None:
+        waited = 0.0
+        if self._request_bucket:
+            waited += self._request_bucket.acquire(1)
+        if self._token_bucket:
+            waited += self._token_bucket.acquire(tokens)
+        if waited:
+            self._count("throttle_wait_s", waited)
+
+    def _count(self, key: str, amount: float = 1) -> None:
+        with self._budget_lock:
+            self.stats[key] += amount
+
+    def _call_with_retries(self, fn: Callable[[], List[List[float]]], tokens: int) -> List[List[float]]:
+        attempt = 0
+        while True:
+            self._throttle(tokens)
+            t0 = time.perf_counter()
+            try:
+                out = fn()
+                self._on_success(time.perf_counter() - t0)
+                return out
+            except Exception as e:
+                self._on_error()
+                limited = is_rate_limit_error(e)
+                self._count("rate_limited", int(limited))
+                if attempt >= self.max_retries:
+                    log.error("Embedding batch failed after retries", attempts=attempt + 1, error=str(e))
+                    raise
+                # full jitter: sleep U(0, min(cap, base * 2^attempt))
+                delay = random.uniform(0, min(self.backoff_max_s, self.backoff_base_s * (2 ** attempt)))
+                self._count("retries")
+                log.warning("Embedding batch failed, retrying", attempt=attempt + 1, delay_s=round(delay, 3),
+                            rate_limited=limited, batch_tokens=self.batch_tokens, error=str(e))
+                time.sleep(delay)
+                attempt += 1
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        n = len(texts)
+        if n == 0:
+            return []
+        token_counts = [self.count_tokens(t) for t in texts]
+        results: List[Optional[List[float]]] = [None] * n
+        cursor = [0]
+        cursor_lock = threading.Lock()
+        failed = threading.Event()
+
+        def next_batch() -> Optional[Tuple[int, int, int]]:
+            # batches are cut on demand, so budget changes apply to the remaining work
+            with cursor_lock:
+                start = cursor[0]
+                if start >= n or failed.is_set():
+                    return None
+                budget, end, tokens = self.batch_tokens, start, 0
+                while end < n and end - start < self.max_batch_size:
+                    if end > start and tokens + token_counts[end] > budget:
+                        break
+                    tokens += token_counts[end]
+                    end += 1
+                cursor[0] = end
+                return start, end, tokens
+
+        def worker() -> None:
+            while True:
+                batch = next_batch()
+                if batch is None:
+                    return
+                start, end, tokens = batch
+                chunk = texts[start:end]
+                try:
+                    vectors = self._call_with_retries(lambda: self.base.embed_documents(chunk), tokens)
+                    if len(vectors) != end - start:
+                        raise DocumentPortalException(
+                            f"Embedding provider returned {len(vectors)} vectors for {end - start} texts", None)
+                except Exception:
+                    failed.set()  # stop handing out batches; the caller gets this error
+                    raise
+                results[start:end] = vectors
+                self._count("batches")
+
+        workers = min(self.concurrency, n)
+        if workers == 1:
+            worker()
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embed") as pool:
+                futures = [pool.submit(worker) for _ in range(workers)]
+                for f in futures:
+                    f.result()  # re-raises the first worker failure
+        return results  # type: ignore[return-value]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._call_with_retries(lambda: [self.base.embed_query(text)], self.count_tokens(text))[0]
@@ -9,9 +9,9 @@ from pathlib import Path
 from datetime import datetime, timezone
 from typing import Iterable, List, Optional, Dict, Any
 from utils.model_loader import ModelLoader
-from logger.custom_logger import CustomLogger
+from logger import GLOBAL_LOGGER as log
 from exception.custom_exception import DocumentPortalException
-log = CustomLogger().get_logger(__name__)
+from utils.metrics import timed_stage
 SUPPORTED_EXTENSIONS = {".pdf", ".docx", ".txt"}
 
 # ----------------------------- #
@@ -20,6 +20,7 @@ SUPPORTED_EXTENSIONS = {".pdf", ".docx", ".txt"}
 def generate_session_id(prefix: str = "session") -> str:
     return f"{prefix}_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
 
+@timed_stage("save_uploaded_files")
 def save_uploaded_files(uploaded_files: Iterable, target_dir: Path) -> List[Path]:
     """Save uploaded files (Streamlit-like) and return local paths."""
     try:
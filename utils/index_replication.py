@@ -0,0 +1,470 @@
+"""
+Index snapshot export/import, so chat sessions can be read on any replica.
+
+Each replica keeps its own faiss_index/. A session indexed on one node is made
+readable on another by shipping its live snapshot (index.faiss, index.pkl,
+ingested_meta.json, coarse.npz), with no re-embedding. The stream format is:
+
+    b"DPSNAP1\\n" | manifest length (8 bytes, big-endian) | manifest (JSON) | file bodies
+
+The manifest lists every file with its raw size and SHA-256. Each body is a
+separate zlib stream, in manifest order. The importer checks every file as it
+arrives and writes it into a staging directory. Only a complete, verified
+snapshot is published as a new local version (utils/index_snapshots.py); a
+damaged or truncated stream never becomes visible.
+
+Replicator adds pull-on-miss. A session that is missing locally is fetched from
+`replication.shared_dir` (<session_id>.dpsnap files, e.g. on a shared mount) and
+then from each of `replication.peers` (GET /chat/snapshot/<session_id>), then
+cached locally. Pulls only happen on a miss: later writes to the session on
+another node are not picked up here, so keep writes to a session on one node.
+
+The /chat/snapshot routes are only served when REPLICATION_TOKEN is set, and then
+only to callers sending it. An imported index.pkl is unpickled on load, so an open
+PUT would let anyone run code on the node. Without a token, replicas can still
+share sessions through `shared_dir`, but not serve them to peers.
+"""
+from __future__ import annotations
+import os
+import re
+import hmac
+import json
+import time
+import zlib
+import struct
+import hashlib
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from logger import GLOBAL_LOGGER as log
+from exception.custom_exception import DocumentPortalException
+from utils.config_loader import load_config
+from utils.index_snapshots import CURRENT_FILE, SnapshotStore
+from utils.metrics import count_snapshot_transfer
+from utils.storage_manager import release, retain
+
+MAGIC = b"DPSNAP1\n"
+FORMAT_VERSION = 1
+MEDIA_TYPE = "application/x-docportal-snapshot"
+SHARED_SUFFIX = ".dpsnap"
+TOKEN_HEADER = "X-Replication-Token"
+_LEN = struct.Struct(">Q")
+_MAX_MANIFEST_BYTES = 1 << 20
+_NAME_RE = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]*$")
+_SHA_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class SnapshotError(DocumentPortalException):
+    """A snapshot stream is malformed, truncated or fails its checksums."""
+
+    def __init__(self, message: str):
+        super().__init__(message)
+
+
+def _store(index_dir, index_name: str) -> SnapshotStore:
+    cfg = load_config().get("index_snapshots") or {}
+    return SnapshotStore(index_dir, index_name=index_name, keep=cfg.get("keep", 2),
+                         grace_seconds=cfg.get("grace_seconds", 60))
+
+
+def _sha256(path: Path, chunk_bytes: int) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        while block := fh.read(chunk_bytes):
+            h.update(block)
+    return h.hexdigest()
+
+
+# ---------- export ----------
+class SnapshotExport:
+    """Encoded stream of one index's live snapshot; the snapshot stays pinned until close()."""
+
+    def __init__(self, index_dir, index_name: str = "index", chunk_bytes: int = 1 << 20, level: int = 1):
+        store = SnapshotStore(index_dir, index_name=index_name)
+        snapshot = store.current()
+        if snapshot is None:
+            raise FileNotFoundError(f"FAISS index not found: {index_dir}")
+        self.snapshot = snapshot
+        self.chunk_bytes = int(chunk_bytes)
+        self.level = int(level)
+        self.sent = 0
+        self._done = False
+        self._closed = False
+        retain(snapshot)  # keep snapshot GC and the janitor away while streaming
+        try:
+            files = sorted(p for p in snapshot.iterdir()
+                           if p.is_file() and not p.name.startswith(".") and p.name != CURRENT_FILE)
+            self.manifest: Dict[str, Any] = {
+                "format": FORMAT_VERSION,
+                "index_name": index_name,
+                "version": store.current_version() or "legacy",
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "files": [{"name": p.name, "size": p.stat().st_size, "sha256": _sha256(p, self.chunk_bytes)}
+                          for p in files],
+            }
+        except Exception:
+            self.close()
+            raise
+        self._header = json.dumps(self.manifest, separators=(",", ":")).encode("utf-8")
+        self.digest = hashlib.sha256(self._header).hexdigest()
+
+    @property
+    def version(self) -> str:
+        return self.manifest["version"]
+
+    def chunks(self) -> Iterator[bytes]:
+        try:
+            yield self._emit(MAGIC + _LEN.pack(len(self._header)) + self._header)
+            for entry in self.manifest["files"]:
+                z = zlib.compressobj(self.level)
+                with open(self.snapshot / entry["name"], "rb") as fh:
+                    while block := fh.read(self.chunk_bytes):
+                        if out := z.compress(block):
+                            yield self._emit(out)
+                yield self._emit(z.flush())
+            self._done = True
+        finally:
+            self.close()
+
+    def _emit(self, data: bytes) -> bytes:
+        self.sent += len(data)
+        return data
+
+    def write_to(self, path) -> Path:
+        """Write the stream to `path` atomically (temp file + rename)."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp, "wb") as fh:
+                for chunk in self.chunks():
+                    fh.write(chunk)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp, path)
+        finally:
+            tmp.unlink(missing_ok=True)
+        return path
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        release(self.snapshot)
+        count_snapshot_transfer("export", "local", "ok" if self._done else "aborted", self.sent)
+
+
+# ---------- import ----------
+def _check_manifest(manifest: Any) -> List[Dict[str, Any]]:
+    if not isinstance(manifest, dict) or manifest.get("format") != FORMAT_VERSION:
+        raise SnapshotError("Unsupported snapshot format")
+    files = manifest.get("files")
+    if not isinstance(files, list) or not files:
+        raise SnapshotError("Snapshot manifest lists no files")
+    names = set()
+    for entry in files:
+        name = entry.get("name") if isinstance(entry, dict) else None
+        if (not isinstance(name, str) or not _NAME_RE.match(name) or name in names or name == CURRENT_FILE
+                or not isinstance(entry.get("size"), int) or entry["size"] < 0
+                or not isinstance(entry.get("sha256"), str) or not _SHA_RE.match(entry["sha256"])):
+            raise SnapshotError(f"Invalid snapshot manifest entry: {entry!r}")
+        names.add(name)
+    index_name = manifest.get("index_name", "index")
+    if not {f"{index_name}.faiss", f"{index_name}.pkl"} <= names:
+        raise SnapshotError(f"Snapshot is missing {index_name}.faiss / {index_name}.pkl")
+    return files
+
+
+class SnapshotImport:
+    """
+    Incremental decoder: feed() encoded chunks as they arrive, then commit() to
+    publish the verified files as the next version of `index_dir`. abort() (or
+    leaving the `with` block without committing) discards everything received.
+    """
+
+    def __init__(self, index_dir, index_name: str = "index", max_bytes: Optional[int] = None,
+                 source: str = "upload", chunk_bytes: int = 1 << 20):
+        self.store = _store(index_dir, index_name)
+        self.max_bytes = max_bytes
+        self.source = source
+        self.chunk_bytes = int(chunk_bytes)
+        self.received = 0
+        self.manifest: Optional[Dict[str, Any]] = None
+        self._buf = bytearray()
+        self._pending: List[Dict[str, Any]] = []
+        self._file: Optional[Dict[str, Any]] = None  # entry, fh, sha, size, zlib state of the file being written
+        self._staged: Optional[Path] = None  # created on the first chunk, so a failed fetch leaves no trace
+        self._closed = False
+
+    def __enter__(self) -> "SnapshotImport":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.abort()
+
+    def feed(self, data: bytes) -> None:
+        if self._closed:
+            raise SnapshotError("Snapshot import already finished")
+        if self._staged is None:
+            self._staged = self.store.stage()
+        self.received += len(data)
+        if self.max_bytes and self.received > self.max_bytes:
+            raise SnapshotError(f"Snapshot exceeds {self.max_bytes} bytes")
+        if self.manifest is None:
+            self._buf += data
+            if not self._read_header():
+                return
+            data, self._buf = bytes(self._buf), bytearray()
+        while data:
+            if self._file is None:
+                if not self._pending:
+                    raise SnapshotError("Unexpected data after the last snapshot file")
+                self._open(self._pending.pop(0))
+            data = self._write(data)
+
+    def _read_header(self) -> bool:
+        head = len(MAGIC) + _LEN.size
+        if not (self._buf.startswith(MAGIC) or MAGIC.startswith(bytes(self._buf))):
+            raise SnapshotError("Not an index snapshot stream")
+        if len(self._buf) < head:
+            return False
+        (n,) = _LEN.unpack_from(self._buf, len(MAGIC))
+        if n > _MAX_MANIFEST_BYTES:
+            raise SnapshotError("Snapshot manifest is too large")
+        if len(self._buf) < head + n:
+            return False
+        try:
+            manifest = json.loads(bytes(self._buf[head:head + n]))
+        except ValueError as e:
+            raise SnapshotError(f"Snapshot manifest is not valid JSON: {e}")
+        self._pending = list(_check_manifest(manifest))
+        self.manifest = manifest
+        del self._buf[:head + n]
+        return True
+
+    def _open(self, entry: Dict[str, Any]) -> None:
+        self._file = {"entry": entry, "fh": open(self._staged / entry["name"], "wb"),
+                      "sha": hashlib.sha256(), "size": 0, "z": zlib.decompressobj()}
+
+    def _write(self, data: bytes) -> bytes:
+        """Decode `data` into the current file; returns bytes belonging to the next file."""
+        f = self._file
+        entry, z = f["entry"], f["z"]
+        try:
+            while True:
+                out = z.decompress(data, self.chunk_bytes)  # bounded output: no zip bombs
+                data = z.unconsumed_tail
+                f["size"] += len(out)
+                if f["size"] > entry["size"]:
+                    raise SnapshotError(f"{entry['name']} is larger than its manifest entry")
+                f["sha"].update(out)
+                f["fh"].write(out)
+                if z.eof or (not data and len(out) < self.chunk_bytes):
+                    break
+        except zlib.error as e:
+            raise SnapshotError(f"{entry['name']} is corrupt: {e}")
+        if not z.eof:
+            return b""
+        f["fh"].close()
+        self._file = None
+        if f["size"] != entry["size"] or f["sha"].hexdigest() != entry["sha256"]:
+            raise SnapshotError(f"Checksum mismatch for {entry['name']}")
+        return z.unused_data
+
+    def commit(self, replace: bool = True) -> bool:
+        """Publish the received snapshot; False (and nothing published) if one exists and not `replace`."""
+        if self.manifest is None or self._file is not None or self._pending:
+            raise SnapshotError("Snapshot stream is truncated")
+        with self.store.write_lock():
+            if not replace and self.store.current() is not None:
+                self.abort("skipped")
+                return False
+            self.store.publish(self._staged)
+        self._staged, self._closed = None, True
+        count_snapshot_transfer("import", self.source, "ok", self.received)
+        log.info("Index snapshot imported", index_dir=str(self.store.root), source=self.source,
+                 version=self.manifest.get("version"), bytes=self.received)
+        return True
+
+    def abort(self, outcome: str = "rejected") -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._file is not None:
+            self._file["fh"].close()
+            self._file = None
+        if self._staged is not None:
+            self.store.discard(self._staged)
+            self._staged = None
+            if self.store.current() is None:
+                # leave no empty index directory behind: /chat/query would take it for an index
+                for d in (self.store.snapshots, self.store.root):
+                    try:
+                        d.rmdir()
+                    except OSError:
+                        pass
+        if self.received:
+            count_snapshot_transfer("import", self.source, outcome, self.received)
+
+
+def import_snapshot(index_dir, chunks: Iterable[bytes], index_name: str = "index", replace: bool = True,
+                    **kwargs: Any) -> bool:
+    """Decode and publish a whole snapshot stream; see SnapshotImport."""
+    with SnapshotImport(index_dir, index_name, **kwargs) as imp:
+        for chunk in chunks:
+            imp.feed(chunk)
+        return imp.commit(replace)
+
+
+# ---------- pull-on-miss ----------
+def _file_chunks(path: Path, chunk_bytes: int) -> Iterator[bytes]:
+    with open(path, "rb") as fh:
+        while block := fh.read(chunk_bytes):
+            yield block
+
+
+def _url_chunks(url: str, headers: Dict[str, str], timeout_s: float, chunk_bytes: int) -> Iterator[bytes]:
+    req = urllib.request.Request(url, headers=headers)
+    with urllib.request.urlopen(req, timeout=timeout_s) as resp:
+        while block := resp.read(chunk_bytes):
+            yield block
+
+
+@dataclass
+class Replicator:
+    shared_dir: Optional[Path] = None
+    peers: List[str] = field(default_factory=list)
+    token: Optional[str] = None
+    publish_to_shared: bool = True
+    timeout_s: float = 30.0
+    chunk_bytes: int = 1 << 20
+    compression_level: int = 1
+    max_snapshot_bytes: Optional[int] = None
+    miss_ttl_s: float = 10.0
+    max_misses: int = 10000
+    _locks: Dict[str, List[Any]] = field(default_factory=dict, repr=False)   # session -> [lock, users]
+    _misses: Dict[str, float] = field(default_factory=dict, repr=False)      # session -> retry after (in expiry order)
+    _guard: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> "Replicator":
+        """`replication` config; REPLICATION_PEERS (comma-separated), REPLICATION_SHARED_DIR and REPLICATION_TOKEN override it."""
+        peers = os.getenv("REPLICATION_PEERS")
+        shared = os.getenv("REPLICATION_SHARED_DIR") or cfg.get("shared_dir")
+        return cls(
+            shared_dir=Path(shared) if shared else None,
+            peers=[p.strip().rstrip("/") for p in (peers.split(",") if peers else cfg.get("peers") or []) if p.strip()],
+            token=os.getenv("REPLICATION_TOKEN") or None,
+            **{k: cfg[k] for k in ("publish_to_shared", "timeout_s", "chunk_bytes", "compression_level",
+                                   "max_snapshot_bytes", "miss_ttl_s", "max_misses") if cfg.get(k) is not None},
+        )
+
+    def authorized(self, token: Optional[str]) -> bool:
+        """Fails closed: with no token configured, no caller is authorized."""
+        return self.token is not None and hmac.compare_digest(token or "", self.token)
+
+    def export(self, index_dir, index_name: str = "index") -> SnapshotExport:
+        return SnapshotExport(index_dir, index_name, chunk_bytes=self.chunk_bytes, level=self.compression_level)
+
+    def open_import(self, index_dir, index_name: str = "index", source: str = "upload") -> SnapshotImport:
+        return SnapshotImport(index_dir, index_name, max_bytes=self.max_snapshot_bytes, source=source,
+                              chunk_bytes=self.chunk_bytes)
+
+    def _sources(self, session_id: str) -> Iterator[tuple]:
+        if self.shared_dir is not None:
+            path = self.shared_dir / f"{session_id}{SHARED_SUFFIX}"
+            if path.is_file():
+                yield "shared", str(path), lambda: _file_chunks(path, self.chunk_bytes)
+        headers = {TOKEN_HEADER: self.token} if self.token else {}
+        for peer in self.peers:
+            url = f"{peer}/chat/snapshot/{urllib.parse.quote(session_id, safe='')}"
+            yield "peer", url, lambda u=url: _url_chunks(u, headers, self.timeout_s, self.chunk_bytes)
+
+    def ensure_local(self, session_id: str, index_dir, index_name: str = "index") -> bool:
+        """True if `session_id` is readable from `index_dir`, pulling and caching it first on a miss."""
+        if SnapshotStore(index_dir, index_name=index_name).current() is not None:
+            return True
+        with self._guard:
+            entry = self._locks.setdefault(session_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:  # one pull per session at a time; the others wait for its result
+                return self._pull(session_id, index_dir, index_name)
+        finally:
+            with self._guard:  # drop the lock once nobody uses it, so the dict stays small
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[session_id]
+
+    def _pull(self, session_id: str, index_dir, index_name: str) -> bool:
+        if SnapshotStore(index_dir, index_name=index_name).current() is not None:
+            return True
+        if time.monotonic() < self._misses.get(session_id, 0.0):
+            return False
+        for kind, where, open_chunks in self._sources(session_id):
+            outcome = "error"
+            try:
+                t0 = time.perf_counter()
+                with self.open_import(index_dir, index_name, source=kind) as imp:
+                    for chunk in open_chunks():
+                        imp.feed(chunk)
+                    imp.commit(replace=False)
+                outcome = "hit"
+                log.info("Index snapshot pulled", session_id=session_id, source=where,
+                         bytes=imp.received, elapsed_ms=round((time.perf_counter() - t0) * 1000, 1))
+                return True
+            except urllib.error.HTTPError as e:
+                outcome = "miss" if e.code == 404 else "error"
+                if outcome == "error":
+                    log.warning("Index snapshot pull failed", session_id=session_id, source=where, status=e.code)
+            except Exception as e:
+                log.warning("Index snapshot pull failed", session_id=session_id, source=where, error=str(e))
+            finally:
+                count_snapshot_transfer("pull", kind, outcome)
+        self._remember_miss(session_id)
+        return False
+
+    def _remember_miss(self, session_id: str) -> None:
+        now = time.monotonic()
+        with self._guard:
+            self._misses.pop(session_id, None)
+            self._misses[session_id] = now + self.miss_ttl_s
+            # the TTL is fixed, so insertion order is expiry order: prune from the front
+            while self._misses:
+                oldest, until = next(iter(self._misses.items()))
+                if until > now and len(self._misses) <= self.max_misses:
+                    break
+                del self._misses[oldest]
+
+    def publish_shared(self, session_id: str, index_dir, index_name: str = "index") -> Optional[Path]:
+        """Write the session's live snapshot to shared_dir (if configured); failures are only logged."""
+        if self.shared_dir is None or not self.publish_to_shared:
+            return None
+        try:
+            path = self.export(index_dir, index_name).write_to(self.shared_dir / f"{session_id}{SHARED_SUFFIX}")
+        except Exception as e:
+            log.warning("Failed to publish index snapshot to shared dir", session_id=session_id, error=str(e))
+            return None
+        with self._guard:
+            self._misses.pop(session_id, None)
+        return path
+
+
+@lru_cache(maxsize=1)
+def get_replicator() -> Optional[Replicator]:
+    cfg = load_config().get("replication") or {}
+    if not (cfg.get("enabled", False) or os.getenv("REPLICATION_PEERS") or os.getenv("REPLICATION_SHARED_DIR")):
+        return None
+    replicator = Replicator.from_config(cfg)
+    log.info("Index replication enabled", peers=replicator.peers,
+             shared_dir=str(replicator.shared_dir) if replicator.shared_dir else None)
+    if replicator.token is None:
+        log.error("REPLICATION_TOKEN is not set: /chat/snapshot routes are disabled and peers cannot pull from here")
+    return replicator
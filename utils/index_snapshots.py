@@ -0,0 +1,213 @@
+"""
+Versioned, atomically published FAISS snapshots.
+
+Layout of an index directory (one per chat session):
+
+    <index_dir>/CURRENT              name of the live snapshot, e.g. "v000003"
+    <index_dir>/.write.lock          inter-process writer lock (flock)
+    <index_dir>/.readers.lock        shared flock of every process with the index loaded (for the janitor)
+    <index_dir>/snapshots/v000003/   index.faiss, index.pkl, ingested_meta.json
+
+A writer takes the lock, saves a complete snapshot into a staging directory,
+renames it to the next version and then swaps CURRENT with os.replace(). Readers
+never take the lock. They resolve CURRENT once and load that directory, so they
+always see a whole snapshot and keep using it until they choose to refresh.
+Superseded snapshots are garbage-collected once they are neither among the newest
+`keep`, nor younger than `grace_seconds`, nor pinned by a reader in this process.
+
+Index directories written before snapshots existed (index.faiss directly in
+<index_dir>) are still readable. The first write migrates them.
+"""
+from __future__ import annotations
+import os
+import re
+import time
+import shutil
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from logger import GLOBAL_LOGGER as log
+from utils.storage_manager import WRITE_LOCK, is_pinned
+
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = WRITE_LOCK
+SNAPSHOT_DIR = "snapshots"
+_VERSION_RE = re.compile(r"^v(\d{6,})$")
+
+try:
+    import fcntl
+
+    def _lock(fh) -> None:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+
+    def _unlock(fh) -> None:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+except ImportError:  # Windows
+    import msvcrt
+
+    def _lock(fh) -> None:
+        while True:
+            try:
+                msvcrt.locking(fh.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                continue  # LK_LOCK gives up after ~10s; keep waiting like flock
+
+    def _unlock(fh) -> None:
+        msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _fsync_dir(path: Path) -> None:
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return  # not supported (e.g. Windows)
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class SnapshotStore:
+    """CURRENT pointer, writer lock and snapshot directories of one index directory."""
+
+    # serialises writers inside one process (flock alone would not stop two threads sharing an fd)
+    _thread_locks: dict = {}   # resolved root -> [lock, users]; dropped once unused
+    _thread_locks_guard = threading.Lock()
+
+    def __init__(self, root, index_name: str = "index", keep: int = 2, grace_seconds: float = 60.0):
+        self.root = Path(root)
+        self.index_name = index_name
+        self.keep = max(1, int(keep))
+        self.grace_seconds = float(grace_seconds)
+        self.snapshots = self.root / SNAPSHOT_DIR
+
+    # ---------- readers ----------
+    def current_version(self) -> Optional[str]:
+        try:
+            name = (self.root / CURRENT_FILE).read_text(encoding="utf-8").strip()
+        except FileNotFoundError:
+            return None
+        return name or None
+
+    def current(self) -> Optional[Path]:
+        """Directory holding the live snapshot (the legacy flat layout counts as one), or None."""
+        version = self.current_version()
+        if version is not None:
+            return self.snapshots / version
+        if (self.root / f"{self.index_name}.faiss").exists() and (self.root / f"{self.index_name}.pkl").exists():
+            return self.root
+        return None
+
+    # ---------- writers ----------
+    @contextmanager
+    def write_lock(self) -> Iterator[None]:
+        self.root.mkdir(parents=True, exist_ok=True)
+        key = str(self.root.resolve())
+        with SnapshotStore._thread_locks_guard:
+            entry = SnapshotStore._thread_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0], open(self.root / LOCK_FILE, "a+b") as fh:
+                _lock(fh)
+                try:
+                    yield
+                finally:
+                    _unlock(fh)
+        finally:
+            with SnapshotStore._thread_locks_guard:  # one lock per index dir ever written would pile up
+                entry[1] -= 1
+                if not entry[1]:
+                    del SnapshotStore._thread_locks[key]
+
+    def _versions(self) -> List[int]:
+        if not self.snapshots.is_dir():
+            return []
+        out = []
+        for d in self.snapshots.iterdir():
+            m = _VERSION_RE.match(d.name)
+            if m and d.is_dir():
+                out.append(int(m.group(1)))
+        return sorted(out)
+
+    def stage(self) -> Path:
+        """Empty directory to write the next snapshot into (call under write_lock)."""
+        self.snapshots.mkdir(parents=True, exist_ok=True)
+        staged = self.snapshots / f".staging-{os.getpid()}-{threading.get_ident()}-{time.monotonic_ns()}"
+        staged.mkdir()
+        return staged
+
+    def publish(self, staged: Path) -> Path:
+        """Turn a staged directory into the next version and point CURRENT at it (call under write_lock)."""
+        versions = self._versions()
+        version = f"v{(versions[-1] + 1 if versions else 1):06d}"
+        target = self.snapshots / version
+        for f in staged.iterdir():
+            with open(f, "rb") as fh:
+                os.fsync(fh.fileno())
+        os.rename(staged, target)
+        _fsync_dir(self.snapshots)
+
+        tmp = self.root / f".{CURRENT_FILE}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            fh.write(version)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.root / CURRENT_FILE)
+        _fsync_dir(self.root)
+        log.info("Index snapshot published", index_dir=str(self.root), version=version)
+        self.gc()
+        return target
+
+    def discard(self, staged: Path) -> None:
+        shutil.rmtree(staged, ignore_errors=True)
+
+    def _older_than_grace(self, path: Path, now: float) -> bool:
+        try:
+            return now - path.stat().st_mtime >= self.grace_seconds
+        except FileNotFoundError:
+            return False
+
+    def gc(self, now: Optional[float] = None) -> int:
+        """Delete superseded snapshots (and stale staging dirs, legacy files); returns how many."""
+        now = time.time() if now is None else now
+        live = self.current_version()
+        versions = self._versions()
+        keep = {f"v{v:06d}" for v in versions[-self.keep:]}
+        removed = 0
+        for v in versions:
+            d = self.snapshots / f"v{v:06d}"
+            if d.name == live or d.name in keep or is_pinned(d):
+                continue
+            try:
+                # a snapshot's age counts from when the next version replaced it
+                successor = self.snapshots / f"v{v + 1:06d}"
+                superseded_at = successor.stat().st_mtime if successor.exists() else d.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if now - superseded_at < self.grace_seconds:
+                continue
+            shutil.rmtree(d, ignore_errors=True)
+            removed += 1
+        if self.snapshots.is_dir():
+            for d in self.snapshots.glob(".staging-*"):
+                try:
+                    if now - d.stat().st_mtime > max(self.grace_seconds, 3600):
+                        shutil.rmtree(d, ignore_errors=True)  # left behind by a crashed writer
+                except FileNotFoundError:
+                    pass
+        if live is not None and self._older_than_grace(self.root / CURRENT_FILE, now):
+            for name in (f"{self.index_name}.faiss", f"{self.index_name}.pkl", "ingested_meta.json"):
+                (self.root / name).unlink(missing_ok=True)  # migrated legacy layout
+        if removed:
+            log.info("Old index snapshots removed", index_dir=str(self.root), removed=removed)
+        return removed
+
+
+def resolve_index_dir(index_dir, index_name: str = "index") -> Optional[Path]:
+    """Snapshot directory a reader should load for `index_dir`, or None if nothing is published."""
+    return SnapshotStore(index_dir, index_name=index_name).current()
@@ -0,0 +1,314 @@
+"""
+LLM router: latency-aware routing, hedged requests and failover across providers.
+
+LLMRouter is a chat model wrapping the providers listed under `llm.router` in
+config/config.yaml (LLM_PROVIDER=router), so existing chains use it unchanged.
+
+- Routing: healthy providers are tried fastest first, ranked by an EWMA of their
+  recent latencies. Providers that fail `failure_threshold` times in a row sit out
+  for `cooldown_s`.
+- Hedging: when the first call is still running after the `hedge_percentile`
+  latency of that provider, the same request goes to the next provider. The first
+  success wins; the slower call finishes in the background and is only measured.
+- Failover: an error or a per-call timeout moves straight on to the next provider.
+
+Latency statistics are process-wide and keyed by provider name, because chains
+create a fresh model per request.
+"""
+from __future__ import annotations
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from logger import GLOBAL_LOGGER as log
+from exception.custom_exception import DocumentPortalException
+from utils.metrics import count_llm_route
+
+
+class ProviderStats:
+    """Latency EWMA, recent-latency window and circuit state for one provider."""
+
+    def __init__(self, name: str, window: int = 200):
+        self.name = name
+        self.ewma: Optional[float] = None
+        self.samples: deque = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    def record_success(self, latency_s: float, alpha: float) -> None:
+        with self._lock:
+            self.ewma = latency_s if self.ewma is None else alpha * latency_s + (1 - alpha) * self.ewma
+            self.samples.append(latency_s)
+            self.consecutive_failures = 0
+
+    def record_failure(self, threshold: int, cooldown_s: float) -> None:
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= threshold:
+                self.open_until = time.monotonic() + cooldown_s
+
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            data = sorted(self.samples)
+        if not data:
+            return None
+        return data[min(len(data) - 1, int(q * len(data)))]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"ewma_s": self.ewma, "samples": len(self.samples), "healthy": self.healthy(),
+                "consecutive_failures": self.consecutive_failures}
+
+
+_STATS: Dict[str, ProviderStats] = {}
+_STATS_LOCK = threading.Lock()
+_POOL: Optional[ThreadPoolExecutor] = None
+
+
+def provider_stats(name: str, window: int = 200) -> ProviderStats:
+    with _STATS_LOCK:
+        if name not in _STATS:
+            _STATS[name] = ProviderStats(name, window)
+        return _STATS[name]
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _POOL
+    with _STATS_LOCK:
+        if _POOL is None:
+            _POOL = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-router")
+        return _POOL
+
+
+def _as_result(message: BaseMessage) -> ChatResult:
+    return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+class LLMRouter(BaseChatModel):
+    """Chat model that hedges and fails over across `providers` (name, model) pairs."""
+
+    providers: List[Tuple[str, BaseChatModel]]
+    hedge: bool = True
+    hedge_percentile: float = 0.95
+    hedge_initial_delay_s: float = 2.0   # used until a provider has `min_samples` latencies
+    hedge_min_delay_s: float = 0.2
+    min_samples: int = 20
+    timeout_s: float = 60.0
+    ewma_alpha: float = 0.2
+    window: int = 200
+    failure_threshold: int = 3
+    cooldown_s: float = 30.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "router"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"providers": [name for name, _ in self.providers], "hedge": self.hedge}
+
+    # ---------- routing ----------
+    def _stats(self, name: str) -> ProviderStats:
+        return provider_stats(name, self.window)
+
+    def ranked(self) -> List[Tuple[str, BaseChatModel]]:
+        """Healthy providers by EWMA latency (unmeasured first), then those in cooldown."""
+        def key(item):
+            st = self._stats(item[0])
+            return (not st.healthy(), st.ewma if st.ewma is not None else 0.0)
+        return sorted(self.providers, key=key)
+
+    def hedge_delay(self, name: str) -> float:
+        st = self._stats(name)
+        if len(st.samples) < self.min_samples:
+            return self.hedge_initial_delay_s
+        return max(self.hedge_min_delay_s, st.percentile(self.hedge_percentile) or 0.0)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {name: self._stats(name).snapshot() for name, _ in self.providers}
+
+    def _succeeded(self, name: str, latency_s: float) -> None:
+        self._stats(name).record_success(latency_s, self.ewma_alpha)
+
+    def _failed(self, name: str, outcome: str, error: Any) -> None:
+        self._stats(name).record_failure(self.failure_threshold, self.cooldown_s)
+        count_llm_route(name, outcome)
+        log.warning("LLM provider call failed", provider=name, outcome=outcome, error=str(error))
+
+    def _call(self, name: str, model: BaseChatModel, messages: List[BaseMessage],
+              stop: Optional[List[str]], kwargs: Dict[str, Any]) -> BaseMessage:
+        t0 = time.perf_counter()
+        try:
+            message = model.invoke(messages, stop=stop, **kwargs)
+        except Exception as e:
+            self._failed(name, "error", e)
+            raise
+        self._succeeded(name, time.perf_counter() - t0)
+        return message
+
+    async def _acall(self, name: str, model: BaseChatModel, messages: List[BaseMessage],
+                     stop: Optional[List[str]], kwargs: Dict[str, Any]) -> BaseMessage:
+        t0 = time.perf_counter()
+        try:
+            message = await model.ainvoke(messages, stop=stop, **kwargs)
+        except Exception as e:
+            self._failed(name, "error", e)
+            raise
+        self._succeeded(name, time.perf_counter() - t0)
+        return message
+
+    def _exhausted(self, errors: Sequence[str]) -> DocumentPortalException:
+        log.error("All LLM providers failed", errors=list(errors))
+        return DocumentPortalException(f"All LLM providers failed: {'; '.join(errors)}", None)
+
+    # ---------- sync ----------
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        queue = self.ranked()
+        inflight: Dict[Future, Tuple[str, float]] = {}
+        errors: List[str] = []
+
+        def launch(outcome: str) -> None:
+            name, model = queue.pop(0)
+            count_llm_route(name, outcome)
+            inflight[_pool().submit(self._call, name, model, messages, stop, kwargs)] = (name, time.monotonic())
+
+        launch("primary")
+        while inflight:
+            now = time.monotonic()
+            deadline = min(start + self.timeout_s for _, start in inflight.values())
+            wait_s = deadline - now
+            if self.hedge and queue and len(inflight) == 1:
+                name, start = next(iter(inflight.values()))
+                wait_s = min(wait_s, start + self.hedge_delay(name) - now)
+            done, _ = wait(list(inflight), timeout=max(0.0, wait_s), return_when=FIRST_COMPLETED)
+            for fut in done:
+                name, _ = inflight.pop(fut)
+                if fut.exception() is None:
+                    count_llm_route(name, "win")
+                    return _as_result(fut.result())
+                errors.append(f"{name}: {fut.exception()}")
+            if done:
+                if queue and not inflight:
+                    launch("failover")
+                continue
+            now = time.monotonic()
+            for fut, (name, start) in list(inflight.items()):
+                if now >= start + self.timeout_s:
+                    # the call keeps running in the pool, but its answer is abandoned
+                    del inflight[fut]
+                    self._failed(name, "timeout", f"no response after {self.timeout_s}s")
+                    errors.append(f"{name}: timeout")
+            if queue and (not inflight or (self.hedge and len(inflight) == 1)):
+                launch("failover" if not inflight else "hedge")
+        raise self._exhausted(errors)
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        # Streams are not hedged: once a token has been emitted the provider is fixed.
+        # Failover is still possible until the first chunk arrives.
+        errors: List[str] = []
+        for name, model in self.ranked():
+            count_llm_route(name, "primary" if not errors else "failover")
+            t0 = time.perf_counter()
+            started = False
+            try:
+                for chunk in model.stream(messages, stop=stop, **kwargs):
+                    started = True
+                    gen = ChatGenerationChunk(message=chunk)
+                    if run_manager:
+                        run_manager.on_llm_new_token(str(chunk.content), chunk=gen)
+                    yield gen
+            except Exception as e:
+                self._failed(name, "error", e)
+                if started:
+                    raise
+                errors.append(f"{name}: {e}")
+                continue
+            self._succeeded(name, time.perf_counter() - t0)
+            count_llm_route(name, "win")
+            return
+        raise self._exhausted(errors)
+
+    # ---------- async ----------
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager=None, **kwargs: Any) -> ChatResult:
+        queue = self.ranked()
+        inflight: Dict[asyncio.Task, Tuple[str, float]] = {}
+        errors: List[str] = []
+
+        def launch(outcome: str) -> None:
+            name, model = queue.pop(0)
+            count_llm_route(name, outcome)
+            task = asyncio.ensure_future(self._acall(name, model, messages, stop, kwargs))
+            inflight[task] = (name, time.monotonic())
+
+        launch("primary")
+        try:
+            while inflight:
+                now = time.monotonic()
+                wait_s = min(start + self.timeout_s for _, start in inflight.values()) - now
+                if self.hedge and queue and len(inflight) == 1:
+                    name, start = next(iter(inflight.values()))
+                    wait_s = min(wait_s, start + self.hedge_delay(name) - now)
+                done, _ = await asyncio.wait(list(inflight), timeout=max(0.0, wait_s),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name, _ = inflight.pop(task)
+                    if task.exception() is None:
+                        count_llm_route(name, "win")
+                        return _as_result(task.result())
+                    errors.append(f"{name}: {task.exception()}")
+                if done:
+                    if queue and not inflight:
+                        launch("failover")
+                    continue
+                now = time.monotonic()
+                for task, (name, start) in list(inflight.items()):
+                    if now >= start + self.timeout_s:
+                        del inflight[task]
+                        task.cancel()
+                        self._failed(name, "timeout", f"no response after {self.timeout_s}s")
+                        errors.append(f"{name}: timeout")
+                if queue and (not inflight or (self.hedge and len(inflight) == 1)):
+                    launch("failover" if not inflight else "hedge")
+        finally:
+            # losing hedges are cancelled rather than left running on the event loop
+            for task in inflight:
+                task.cancel()
+        raise self._exhausted(errors)
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        errors: List[str] = []
+        for name, model in self.ranked():
+            count_llm_route(name, "primary" if not errors else "failover")
+            t0 = time.perf_counter()
+            started = False
+            try:
+                async for chunk in model.astream(messages, stop=stop, **kwargs):
+                    started = True
+                    gen = ChatGenerationChunk(message=chunk)
+                    if run_manager:
+                        await run_manager.on_llm_new_token(str(chunk.content), chunk=gen)
+                    yield gen
+            except Exception as e:
+                self._failed(name, "error", e)
+                if started:
+                    raise
+                errors.append(f"{name}: {e}")
+                continue
+            self._succeeded(name, time.perf_counter() - t0)
+            count_llm_route(name, "win")
+            return
+        raise self._exhausted(errors)
@@ -0,0 +1,289 @@
+"""
+Admission control and priority scheduling for LLM-bound work.
+
+Every component that calls the LLM takes a slot first: DocumentAnalyzer ("analyze",
+and "analyze_batch" for /analyze/batch items), DocumentComparatorLLM ("compare") and
+ConversationalRAG ("chat"). A slot covers one unit of work, which may be several LLM
+calls (e.g. question rewrite + answer). The slot is granted only when all of these
+limits allow it:
+
+- global concurrency and tokens-per-minute (`llm_scheduler.max_concurrency`,
+  `llm_scheduler.tokens_per_minute`);
+- the workload's own concurrency and tokens-per-minute.
+
+Waiting work is served in priority order (lower `priority` first, so interactive
+chat goes before batch analysis), FIFO within a priority. A waiter blocked only by
+its own workload's limits does not hold up other workloads. Each workload bounds its
+queue (`max_queue`) and its wait (`max_wait_s`). Beyond either, LLMBusy is raised
+with a Retry-After estimate, and the API turns it into HTTP 429.
+
+The API takes the slot on the event loop (allm_slot) before handing the work to a
+worker thread, so queued requests hold no threads. The component's own llm_slot()
+inside that work sees the slot already held in its context and does not take another.
+
+Token use is estimated up front (prompt characters / 4 + the workload's
+`expected_tokens`). Limits apply per API worker process, so divide provider quotas
+by the number of workers.
+"""
+from __future__ import annotations
+import math
+import time
+import asyncio
+import bisect
+import itertools
+import threading
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from logger import GLOBAL_LOGGER as log
+from exception.custom_exception import DocumentPortalException
+from utils.config_loader import load_config
+from utils.embedding_executor import TokenBucket, estimate_tokens
+from utils.metrics import LLM_ACTIVE, LLM_QUEUE_DEPTH, LLM_QUEUE_WAIT, LLM_REJECTED
+
+# workload of the slot held by the current context (copied into run_in_threadpool workers)
+_HELD: ContextVar[Optional[str]] = ContextVar("docportal_llm_slot", default=None)
+
+
+class LLMBusy(DocumentPortalException):
+    """LLM capacity is saturated; retry after `retry_after` seconds."""
+
+    def __init__(self, workload: str, reason: str, retry_after: float):
+        self.workload = workload
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f"LLM capacity saturated for '{workload}' ({reason}); retry after {self.retry_after}s")
+
+
+@dataclass
+class Workload:
+    name: str
+    priority: int = 1
+    max_concurrency: int = 4
+    tokens_per_minute: float = 0          # 0 = no workload token limit
+    max_queue: int = 16
+    max_wait_s: float = 30.0
+    expected_tokens: int = 1024           # added to the prompt estimate (context + output)
+    active: int = 0
+    queued: int = 0
+    service_s: float = 1.0                # EWMA of slot hold time, for Retry-After
+    bucket: Optional[TokenBucket] = field(default=None, repr=False)
+
+    def __post_init__(self) -> None:
+        if self.tokens_per_minute:
+            self.bucket = TokenBucket(self.tokens_per_minute / 60.0, capacity=self.tokens_per_minute)
+
+
+class _Waiter:
+    __slots__ = ("workload", "tokens", "key", "granted", "event", "loop", "future")
+
+    def __init__(self, workload: Workload, tokens: int, seq: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.workload = workload
+        self.tokens = tokens
+        self.key = (workload.priority, seq)
+        self.granted = False
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.future = loop.create_future() if loop else None
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return self.key < other.key
+
+    def grant(self) -> None:
+        self.granted = True
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(lambda f=self.future: f.done() or f.set_result(None))
+
+
+class LLMScheduler:
+    """Process-wide admission controller; use slot() / aslot() around LLM-bound work."""
+
+    def __init__(self, workloads: Dict[str, Workload], max_concurrency: int = 16, tokens_per_minute: float = 0,
+                 poll_interval_s: float = 0.1):
+        self.workloads = workloads
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.bucket = TokenBucket(tokens_per_minute / 60.0, capacity=tokens_per_minute) if tokens_per_minute else None
+        self.poll_interval_s = poll_interval_s
+        self.active = 0
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> "LLMScheduler":
+        keys = ("priority", "max_concurrency", "tokens_per_minute", "max_queue", "max_wait_s", "expected_tokens")
+        workloads = {
+            name: Workload(name, **{k: wcfg[k] for k in keys if wcfg.get(k) is not None})
+            for name, wcfg in (cfg.get("workloads") or {}).items()
+        }
+        return cls(workloads, max_concurrency=cfg.get("max_concurrency", 16),
+                   tokens_per_minute=cfg.get("tokens_per_minute") or 0,
+                   poll_interval_s=cfg.get("poll_interval_s", 0.1))
+
+    def _workload(self, name: str) -> Workload:
+        if name not in self.workloads:
+            self.workloads[name] = Workload(name)  # unconfigured workloads get the defaults
+        return self.workloads[name]
+
+    # ---------- bookkeeping (all under self._lock) ----------
+    def _token_wait(self, w: Workload, tokens: int) -> float:
+        return max(self.bucket.wait_time(tokens) if self.bucket else 0.0,
+                   w.bucket.wait_time(tokens) if w.bucket else 0.0)
+
+    def _retry_after(self, w: Workload, tokens: int) -> float:
+        backlog = (w.queued + w.active) / max(1, w.max_concurrency)
+        return max(backlog * w.service_s, self._token_wait(w, tokens))
+
+    def _dispatch(self) -> None:
+        """Grant queued waiters in priority order while capacity lasts."""
+        for waiter in list(self._waiters):
+            if self.active >= self.max_concurrency:
+                return
+            w = waiter.workload
+            if w.active >= w.max_concurrency or (w.bucket and w.bucket.wait_time(waiter.tokens) > 0):
+                continue  # blocked by its own workload limits: let others through
+            if self.bucket and self.bucket.wait_time(waiter.tokens) > 0:
+                return  # global tokens: nobody behind it may overtake
+            for bucket in (self.bucket, w.bucket):
+                if bucket:
+                    bucket.take(waiter.tokens)
+            self._waiters.remove(waiter)
+            w.queued -= 1
+            w.active += 1
+            self.active += 1
+            LLM_QUEUE_DEPTH.labels(w.name).dec()
+            LLM_ACTIVE.labels(w.name).inc()
+            waiter.grant()
+
+    def _enqueue(self, name: str, text: str, loop: Optional[asyncio.AbstractEventLoop] = None) -> _Waiter:
+        with self._lock:
+            w = self._workload(name)
+            waiter = _Waiter(w, estimate_tokens(text) + w.expected_tokens, next(self._seq), loop)
+            bisect.insort(self._waiters, waiter)
+            w.queued += 1
+            LLM_QUEUE_DEPTH.labels(w.name).inc()
+            self._dispatch()
+            if not waiter.granted and w.queued > w.max_queue:
+                self._waiters.remove(waiter)
+                w.queued -= 1
+                LLM_QUEUE_DEPTH.labels(w.name).dec()
+                LLM_REJECTED.labels(w.name, "queue_full").inc()
+                raise LLMBusy(w.name, "queue full", self._retry_after(w, waiter.tokens))
+            return waiter
+
+    def _abandon(self, waiter: _Waiter, reason: str = "timeout") -> bool:
+        """Drop a waiter that gave up; False if it was granted in the meantime."""
+        with self._lock:
+            if waiter.granted:
+                return False
+            self._waiters.remove(waiter)
+            w = waiter.workload
+            w.queued -= 1
+            LLM_QUEUE_DEPTH.labels(w.name).dec()
+            LLM_REJECTED.labels(w.name, reason).inc()
+            self._dispatch()
+            return True
+
+    def _poll(self, waiter: _Waiter) -> None:
+        with self._lock:
+            if not waiter.granted:
+                self._dispatch()  # token buckets refill over time, not on release
+
+    def _release(self, w: Workload, held_s: float) -> None:
+        with self._lock:
+            w.active -= 1
+            self.active -= 1
+            w.service_s = 0.8 * w.service_s + 0.2 * held_s
+            LLM_ACTIVE.labels(w.name).dec()
+            self._dispatch()
+
+    # ---------- public API ----------
+    def _granted(self, w: Workload, t0: float) -> float:
+        granted_at = time.monotonic()
+        LLM_QUEUE_WAIT.labels(w.name).observe(granted_at - t0)
+        return granted_at
+
+    @contextmanager
+    def slot(self, workload: str, text: str = "") -> Iterator[None]:
+        if _HELD.get() is not None:  # taken already by the caller, e.g. on the event loop
+            yield
+            return
+        t0 = time.monotonic()
+        waiter = self._enqueue(workload, text)
+        w = waiter.workload
+        deadline = t0 + w.max_wait_s
+        while not waiter.granted:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 and self._abandon(waiter):
+                raise LLMBusy(w.name, "queue wait timeout", self._retry_after(w, waiter.tokens))
+            waiter.event.wait(max(0.0, min(remaining, self.poll_interval_s)))
+            self._poll(waiter)
+        granted_at = self._granted(w, t0)
+        held = _HELD.set(w.name)
+        try:
+            yield
+        finally:
+            _HELD.reset(held)
+            self._release(w, time.monotonic() - granted_at)
+
+    @asynccontextmanager
+    async def aslot(self, workload: str, text: str = "") -> AsyncIterator[None]:
+        if _HELD.get() is not None:
+            yield
+            return
+        t0 = time.monotonic()
+        waiter = self._enqueue(workload, text, asyncio.get_running_loop())
+        w = waiter.workload
+        deadline = t0 + w.max_wait_s
+        try:
+            while not waiter.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 and self._abandon(waiter):
+                    raise LLMBusy(w.name, "queue wait timeout", self._retry_after(w, waiter.tokens))
+                await asyncio.wait({waiter.future}, timeout=max(0.0, min(remaining, self.poll_interval_s)))
+                self._poll(waiter)
+        except asyncio.CancelledError:
+            if not self._abandon(waiter, "cancelled"):
+                self._release(w, 0.0)  # granted just before the cancellation landed
+            raise
+        granted_at = self._granted(w, t0)
+        held = _HELD.set(w.name)
+        try:
+            yield
+        finally:
+            _HELD.reset(held)
+            self._release(w, time.monotonic() - granted_at)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"active": self.active, "workloads": {
+                n: {"active": w.active, "queued": w.queued, "service_s": round(w.service_s, 3)}
+                for n, w in self.workloads.items()}}
+
+
+@lru_cache(maxsize=1)
+def get_scheduler() -> Optional[LLMScheduler]:
+    cfg = load_config().get("llm_scheduler") or {}
+    if not cfg.get("enabled", False):
+        return None
+    scheduler = LLMScheduler.from_config(cfg)
+    log.info("LLM scheduler enabled", max_concurrency=scheduler.max_concurrency,
+             workloads=sorted(scheduler.workloads))
+    return scheduler
+
+
+def llm_slot(workload: str, text: str = ""):
+    """Context manager admitting one unit of `workload` work (no-op when the scheduler is disabled)."""
+    scheduler = get_scheduler()
+    return scheduler.slot(workload, text) if scheduler else nullcontext()
+
+
+def allm_slot(workload: str, text: str = ""):
+    """Async form of llm_slot()."""
+    scheduler = get_scheduler()
+    return scheduler.aslot(workload, text) if scheduler else nullcontext()
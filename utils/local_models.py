@@ -0,0 +1,270 @@
+"""
+Local, network-free model providers.
+
+HashingEmbeddings  - vectorized NumPy feature-hashing embeddings (word uni/bi-grams).
+TemplateChatModel  - deterministic chat model with configurable latency and streaming.
+SimulatedRateLimitEmbeddings - quota/latency wrapper that answers like a throttled vendor API.
+
+Both are selectable from config/config.yaml (provider: "local") and exist so the
+FAISS and API layers can be load-tested / run air-gapped independently of vendor APIs.
+"""
+from __future__ import annotations
+import re
+import json
+import time
+import zlib
+import asyncio
+import threading
+from collections import deque
+from string import Template
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_MIX = np.uint64(0x9E3779B97F4A7C15)   # 64-bit golden-ratio multiplier (hash finalizer)
+_PAIR = np.uint64(0x100000001B3)       # FNV prime, combines adjacent token hashes into bigrams
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Signed feature hashing over lower-cased word n-grams, L2-normalised.
+
+    Token hashes are memoised (crc32, stable across processes); n-gram hashes, bucket
+    assignment and accumulation for a whole batch are single NumPy operations.
+    """
+
+    def __init__(self, dimensions: int = 768, ngram_range: Sequence[int] = (1, 2), cache_size: int = 200_000):
+        self.dimensions = int(dimensions)
+        self.ngram_min, self.ngram_max = int(ngram_range[0]), int(ngram_range[1])
+        self._cache: Dict[str, int] = {}
+        self._cache_size = cache_size
+
+    def _token_hashes(self, text: str) -> np.ndarray:
+        cache = self._cache
+        out = []
+        for tok in _TOKEN_RE.findall(text.lower()):
+            h = cache.get(tok)
+            if h is None:
+                h = zlib.crc32(tok.encode("utf-8")) + 1
+                if len(cache) < self._cache_size:
+                    cache[tok] = h
+            out.append(h)
+        return np.fromiter(out, dtype=np.uint64, count=len(out))
+
+    def _features(self, text: str) -> np.ndarray:
+        uni = self._token_hashes(text)
+        grams = []
+        if self.ngram_min <= 1:
+            grams.append(uni)
+        cur = uni
+        for n in range(2, self.ngram_max + 1):
+            if cur.size < 2:
+                break
+            cur = cur[:-1] * _PAIR ^ uni[n - 1:]
+            if n >= self.ngram_min:
+                grams.append(cur)
+        return np.concatenate(grams) if grams else uni[:0]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        n, dim = len(texts), self.dimensions
+        if n == 0:
+            return []
+        feats = [self._features(t) for t in texts]
+        lengths = np.fromiter((f.size for f in feats), dtype=np.int64, count=n)
+        hashes = np.concatenate(feats) * _MIX
+        rows = np.repeat(np.arange(n, dtype=np.int64), lengths)
+        buckets = (hashes >> np.uint64(32)) % np.uint64(dim)
+        signs = np.where(hashes & np.uint64(1), 1.0, -1.0)
+        mat = np.bincount(rows * dim + buckets.astype(np.int64), weights=signs, minlength=n * dim)
+        mat = mat.reshape(n, dim).astype(np.float32)
+        norms = np.linalg.norm(mat, axis=1, keepdims=True)
+        np.divide(mat, norms, out=mat, where=norms > 0)
+        return mat.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+class RateLimitError(RuntimeError):
+    """Local equivalent of a provider's HTTP 429."""
+
+
+class SimulatedRateLimitEmbeddings(Embeddings):
+    """
+    Wraps a local model with a provider-like quota (requests per second over a sliding
+    window, maximum batch size) and per-request latency, so the embedding executor's
+    throttling, retries and batch adaptation can be exercised without a vendor API.
+    """
+
+    def __init__(self, base: Embeddings, requests_per_second: float = 10, max_batch_size: int = 100,
+                 latency_ms: float = 0.0, latency_per_item_ms: float = 0.0):
+        self.base = base
+        self.requests_per_second = requests_per_second
+        self.max_batch_size = max_batch_size
+        self.latency_ms = latency_ms
+        self.latency_per_item_ms = latency_per_item_ms
+        self.requests = 0
+        self.rejected = 0
+        self._window: deque = deque()
+        self._lock = threading.Lock()
+
+    def _admit(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            while self._window and now - self._window[0] >= 1.0:
+                self._window.popleft()
+            if len(self._window) >= self.requests_per_second:
+                self.rejected += 1
+                raise RateLimitError("429 Too Many Requests: rate limit exceeded")
+            self._window.append(now)
+            self.requests += 1
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if len(texts) > self.max_batch_size:
+            raise ValueError(f"400 Bad Request: batch of {len(texts)} exceeds {self.max_batch_size}")
+        self._admit()
+        delay = self.latency_ms + self.latency_per_item_ms * len(texts)
+        if delay:
+            time.sleep(delay / 1000.0)
+        return self.base.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+# ----------------------------- #
+# Template LLM                  #
+# ----------------------------- #
+def _words(text: str, n: int) -> str:
+    return " ".join(text.split()[:n])
+
+
+def _analysis_response(prompt: str, last: str) -> str:
+    pages = re.findall(r"--- Page (\d+) ---", prompt)
+    return json.dumps({
+        "Summary": [_words(last.split("Analyze this document:")[-1], 40)],
+        "Title": "Not Available",
+        "Author": "Not Available",
+        "DateCreated": "Not Available",
+        "LastModifiedDate": "Not Available",
+        "Publisher": "Not Available",
+        "Language": "English",
+        "PageCount": len(pages) or "Not Available",
+        "SentimentTone": "Neutral",
+    })
+
+
+def _comparison_response(prompt: str, last: str) -> str:
+    pages = sorted({int(p) for p in re.findall(r"--- Page (\d+) ---", prompt)}) or [1]
+    return json.dumps([{"Page": str(p), "changes": "NO CHANGE"} for p in pages])
+
+
+def _qa_response(prompt: str, last: str) -> str:
+    context = prompt.split("three sentences.", 1)[-1]
+    return f"Based on the provided context: {_words(context, 30)}"
+
+
+# (marker found in the rendered prompt, responder) - first match wins
+_BUILTIN_RESPONDERS = (
+    ("SentimentTone", _analysis_response),
+    ("NO CHANGE", _comparison_response),
+    ("rewrite the query as a standalone question", lambda prompt, last: last),
+    ("answer questions using the provided context", _qa_response),
+)
+
+
+class TemplateChatModel(BaseChatModel):
+    """
+    Deterministic chat model for load tests and air-gapped nodes.
+
+    Known prompts from PROMPT_REGISTRY get schema-valid canned answers; anything else is
+    rendered from `template` ($input = last message). `latency_ms` is paid once per call
+    and `token_latency_ms` per streamed token, so provider latency can be modelled.
+    """
+
+    model_name: str = "template-v1"
+    latency_ms: float = 0.0
+    token_latency_ms: float = 0.0
+    max_tokens: int = 2048
+    template: str = "$input"
+
+    @property
+    def _llm_type(self) -> str:
+        return "local-template"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model_name": self.model_name, "latency_ms": self.latency_ms}
+
+    # ---------- rendering ----------
+    def _render(self, messages: List[BaseMessage]) -> str:
+        prompt = "\n".join(str(m.content) for m in messages)
+        last = str(messages[-1].content) if messages else ""
+        for marker, responder in _BUILTIN_RESPONDERS:
+            if marker in prompt:
+                text = responder(prompt, last)
+                break
+        else:
+            text = Template(self.template).safe_substitute(input=last)
+        tokens = text.split(" ")
+        return " ".join(tokens[: self.max_tokens])
+
+    def _result(self, messages: List[BaseMessage], text: str) -> ChatResult:
+        usage = {
+            "input_tokens": sum(len(str(m.content).split()) for m in messages),
+            "output_tokens": len(text.split()),
+        }
+        usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+        msg = AIMessage(content=text, usage_metadata=usage)
+        return ChatResult(generations=[ChatGeneration(message=msg)], llm_output={"token_usage": usage})
+
+    def _pieces(self, text: str) -> List[str]:
+        parts = text.split(" ")
+        return [p if i == len(parts) - 1 else p + " " for i, p in enumerate(parts)]
+
+    # ---------- sync ----------
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        text = self._render(messages)
+        delay = self.latency_ms + self.token_latency_ms * len(text.split())
+        if delay:
+            time.sleep(delay / 1000.0)
+        return self._result(messages, text)
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+        for piece in self._pieces(self._render(messages)):
+            if self.token_latency_ms:
+                time.sleep(self.token_latency_ms / 1000.0)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager:
+                run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+
+    # ---------- async (never blocks the event loop) ----------
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager=None, **kwargs: Any) -> ChatResult:
+        text = self._render(messages)
+        delay = self.latency_ms + self.token_latency_ms * len(text.split())
+        if delay:
+            await asyncio.sleep(delay / 1000.0)
+        return self._result(messages, text)
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000.0)
+        for piece in self._pieces(self._render(messages)):
+            if self.token_latency_ms:
+                await asyncio.sleep(self.token_latency_ms / 1000.0)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece))
+            if run_manager:
+                await run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
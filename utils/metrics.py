@@ -0,0 +1,243 @@
+"""
+Prometheus metrics for the document pipeline.
+
+Stage latencies (upload save, load, split, embed, FAISS, retrieval, LLM steps),
+per-endpoint request latency, LLM admission queue wait/depth, and counters for
+chunks, LLM tokens, LLM routing, structured-output repairs, cache lookups and
+index snapshot transfers between replicas.
+Exposed by the `/metrics` route in api/main.py.
+
+Recording is a dict lookup + a lock-protected add per observation; label children
+are resolved once and cached so hot paths never rebuild them.
+"""
+from __future__ import annotations
+import os
+import time
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
+_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+STAGE_LATENCY = Histogram(
+    "docportal_stage_duration_seconds", "Latency of one pipeline stage", ["stage"], buckets=_BUCKETS
+)
+REQUEST_LATENCY = Histogram(
+    "docportal_request_duration_seconds", "HTTP request latency", ["method", "endpoint", "status"], buckets=_BUCKETS
+)
+CHUNKS = Counter("docportal_chunks_total", "Chunks processed per stage", ["stage"])
+TOKENS = Counter("docportal_llm_tokens_total", "LLM tokens by direction", ["kind"])
+CACHE_LOOKUPS = Counter("docportal_cache_lookups_total", "Cache lookups", ["cache", "result"])
+LLM_ROUTES = Counter("docportal_llm_route_total", "LLM router attempts by provider and outcome", ["provider", "outcome"])
+LLM_QUEUE_WAIT = Histogram(
+    "docportal_llm_queue_wait_seconds", "Time LLM-bound work waited for admission", ["workload"], buckets=_BUCKETS
+)
+LLM_QUEUE_DEPTH = Gauge("docportal_llm_queue_depth", "LLM-bound work waiting for admission", ["workload"],
+                        multiprocess_mode="livesum")
+LLM_ACTIVE = Gauge("docportal_llm_active", "Admitted LLM-bound work in flight", ["workload"],
+                   multiprocess_mode="livesum")
+LLM_REJECTED = Counter("docportal_llm_rejected_total", "LLM-bound work rejected by admission control",
+                       ["workload", "reason"])
+STRUCTURED_OUTPUT = Counter("docportal_structured_output_total", "Structured LLM output parses by outcome",
+                            ["parser", "outcome"])
+SNAPSHOT_TRANSFERS = Counter("docportal_snapshot_transfers_total", "Index snapshot exports, imports and pulls",
+                             ["op", "source", "outcome"])
+SNAPSHOT_BYTES = Counter("docportal_snapshot_transfer_bytes_total", "Encoded index snapshot bytes moved", ["op"])
+STORAGE_DELETED = Counter("docportal_storage_deleted_total", "Entries deleted by the storage janitor", ["area"])
+STORAGE_RECLAIMED = Counter("docportal_storage_reclaimed_bytes_total", "Bytes reclaimed by the storage janitor", ["area"])
+
+
+@lru_cache(maxsize=None)
+def _stage(stage: str):
+    return STAGE_LATENCY.labels(stage)
+
+
+@lru_cache(maxsize=None)
+def _chunks(stage: str):
+    return CHUNKS.labels(stage)
+
+
+# Set by utils.profiling only when request profiling is enabled; None keeps timed() hook-free.
+_profiler = None
+
+
+def set_stage_profiler(profiler) -> None:
+    global _profiler
+    _profiler = profiler
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    _stage(stage).observe(seconds)
+    if _profiler is not None:
+        _profiler.observe(stage, seconds)
+
+
+def count_chunks(stage: str, n: int) -> None:
+    if n:
+        _chunks(stage).inc(n)
+
+
+def count_cache(cache: str, hits: int = 0, misses: int = 0) -> None:
+    if hits:
+        CACHE_LOOKUPS.labels(cache, "hit").inc(hits)
+    if misses:
+        CACHE_LOOKUPS.labels(cache, "miss").inc(misses)
+
+
+def count_llm_route(provider: str, outcome: str) -> None:
+    LLM_ROUTES.labels(provider, outcome).inc()
+
+
+def count_structured_output(parser: str, outcome: str) -> None:
+    STRUCTURED_OUTPUT.labels(parser, outcome).inc()
+
+
+def count_snapshot_transfer(op: str, source: str, outcome: str, nbytes: int = 0) -> None:
+    SNAPSHOT_TRANSFERS.labels(op, source, outcome).inc()
+    if nbytes:
+        SNAPSHOT_BYTES.labels(op).inc(nbytes)
+
+
+@contextmanager
+def timed(stage: str):
+    """Record the wall time of the enclosed block under `stage`."""
+    profiler = _profiler
+    token = profiler.enter(stage) if profiler is not None else None
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        _stage(stage).observe(elapsed)
+        if token is not None:
+            profiler.exit(token, elapsed)
+
+
+def timed_stage(stage: str):
+    """Decorator form of timed()."""
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+def render_latest() -> Tuple[bytes, str]:
+    """Text exposition; aggregates worker processes when PROMETHEUS_MULTIPROC_DIR is set."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+# ----------------------------- #
+# Embeddings wrapper            #
+# ----------------------------- #
+class InstrumentedEmbeddings(Embeddings):
+    """Times every embedding call and counts embedded chunks; delegates to `base`."""
+
+    def __init__(self, base: Embeddings):
+        self.base = base
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with timed("embedding"):
+            out = self.base.embed_documents(texts)
+        count_chunks("embedded", len(texts))
+        return out
+
+    def embed_query(self, text: str) -> List[float]:
+        with timed("embed_query"):
+            return self.base.embed_query(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        with timed("embedding"):
+            out = await self.base.aembed_documents(texts)
+        count_chunks("embedded", len(texts))
+        return out
+
+    async def aembed_query(self, text: str) -> List[float]:
+        with timed("embed_query"):
+            return await self.base.aembed_query(text)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.base, name)
+
+
+# ----------------------------- #
+# LangChain callback            #
+# ----------------------------- #
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Token counters from LLM results, plus latency for named chain steps
+    (runnables built with .with_config(run_name=<stage>)) and retrievers.
+    """
+
+    TRACKED_CHAINS = frozenset({"question_rewrite", "answer_generation"})
+
+    def __init__(self):
+        self._starts: Dict[UUID, Tuple[str, float]] = {}
+
+    # tokens
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs: Any) -> None:
+        inp = out = 0
+        for gens in response.generations:
+            for g in gens:
+                usage = getattr(getattr(g, "message", None), "usage_metadata", None) or {}
+                inp += usage.get("input_tokens", 0)
+                out += usage.get("output_tokens", 0)
+        if not (inp or out):
+            usage = (response.llm_output or {}).get("token_usage") or {}
+            inp = usage.get("prompt_tokens", usage.get("input_tokens", 0)) or 0
+            out = usage.get("completion_tokens", usage.get("output_tokens", 0)) or 0
+        if inp:
+            TOKENS.labels("input").inc(inp)
+        if out:
+            TOKENS.labels("output").inc(out)
+
+    # named chain stages
+    def on_chain_start(self, serialized, inputs, *, run_id: UUID, name: Optional[str] = None, **kwargs: Any) -> None:
+        name = name or kwargs.get("run_name")
+        if name in self.TRACKED_CHAINS:
+            self._starts[run_id] = (name, time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id: UUID, **kwargs: Any) -> None:
+        started = self._starts.pop(run_id, None)
+        if started:
+            observe_stage(started[0], time.perf_counter() - started[1])
+
+    def on_chain_error(self, error, *, run_id: UUID, **kwargs: Any) -> None:
+        self._starts.pop(run_id, None)
+
+    # retrieval
+    def on_retriever_start(self, serialized, query, *, run_id: UUID, **kwargs: Any) -> None:
+        self._starts[run_id] = ("retrieval", time.perf_counter())
+
+    def on_retriever_end(self, documents, *, run_id: UUID, **kwargs: Any) -> None:
+        started = self._starts.pop(run_id, None)
+        if started:
+            observe_stage(started[0], time.perf_counter() - started[1])
+            count_chunks("retrieved", len(documents))
+
+    def on_retriever_error(self, error, *, run_id: UUID, **kwargs: Any) -> None:
+        self._starts.pop(run_id, None)
+
+
+METRICS_CALLBACK = MetricsCallbackHandler()
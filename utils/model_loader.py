@@ -1,33 +1,47 @@
 import os
 from dotenv import load_dotenv
 from utils.config_loader import load_config
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_groq import ChatGroq
+from utils.metrics import InstrumentedEmbeddings, METRICS_CALLBACK
 
-from logger.custom_logger import CustomLogger
+from logger import GLOBAL_LOGGER as log
 from exception.custom_exception import DocumentPortalException
-from logging import Logger
 import sys
-log: Logger = CustomLogger().get_logger(__name__)
 
 class ModelLoader:
     """
     A utility class to load embedding models and LLMs models
     """
 
+    # API key needed by each remote provider; "local" needs none
+    PROVIDER_KEYS = {"google": "GOOGLE_API_KEY", "groq": "GROQ_API_KEY"}
+
     def __init__(self):
         load_dotenv()
-        self._validate_env()
         self.config = load_config()
+        self._validate_env()
         log.info("Configuration loaded succesfully", config_keys=list(self.config.keys()))
 
+    def _embedding_provider(self) -> str:
+        return os.getenv("EMBEDDING_PROVIDER", self.config["embedding_model"].get("provider", "google"))
+
+    def _llm_provider_key(self) -> str:
+        return os.getenv("LLM_PROVIDER", "groq")
+
+    @staticmethod
+    def llm_providers(config: dict, provider_key: str) -> set:
+        """Provider names behind an `llm:` entry (a router expands to its members)."""
+        llm_cfg = config["llm"].get(provider_key, {})
+        if llm_cfg.get("provider") == "router":
+            return {config["llm"].get(k, {}).get("provider") for k in llm_cfg.get("providers", [])}
+        return {llm_cfg.get("provider")}
+
     def _validate_env(self):
         """
         Validate necessary environment variables
-        ensures that API keys exist
+        ensures that API keys exist for the providers actually selected
         """
-        required_vars = ["GOOGLE_API_KEY", "GROQ_API_KEY"]
+        providers = {self._embedding_provider(), *self.llm_providers(self.config, self._llm_provider_key())}
+        required_vars = sorted({self.PROVIDER_KEYS[p] for p in providers if p in self.PROVIDER_KEYS})
         self.api_keys = {key:os.getenv(key) for key in required_vars}
         missing = [k for k, v in self.api_keys.items() if not v]
         if missing:
@@ -41,54 +55,117 @@ class ModelLoader:
         """
         try:
             log.info("Loading embedding model...")
-            model_name = self.config["embedding_model"]["model_name"]
-            return GoogleGenerativeAIEmbeddings(model=model_name)
+            emb_block = self.config["embedding_model"]
+            provider = self._embedding_provider()
+            if provider == "local":
+                from utils.local_models import HashingEmbeddings, SimulatedRateLimitEmbeddings
+
+                local_cfg = emb_block.get("local", {})
+                base = HashingEmbeddings(
+                    dimensions=local_cfg.get("dimensions", 768),
+                    ngram_range=local_cfg.get("ngram_range", (1, 2)),
+                )
+                if not local_cfg.get("simulate_rate_limit"):
+                    return InstrumentedEmbeddings(base)  # in-process: no quota to batch or throttle for
+                base = SimulatedRateLimitEmbeddings(base, **local_cfg["simulate_rate_limit"])
+                return self._wrap_embeddings(base)
+            if provider != "google":
+                raise ValueError(f"Unsupported embedding provider: '{provider}'")
+            from langchain_google_genai import GoogleGenerativeAIEmbeddings  # provider SDKs load on first use
+
+            model_name = emb_block["model_name"]
+            return self._wrap_embeddings(GoogleGenerativeAIEmbeddings(model=model_name))
         except Exception as e:
             log.error("Failed to load embedding model", error=str(e))
             raise DocumentPortalException("Failed to load embedding model", sys)
 
-    def load_llm(self):
+    def _wrap_embeddings(self, base):
+        """Batching/rate-limiting executor (if enabled) in front of the provider, metrics outermost."""
+        executor_cfg = self.config.get("embedding_executor") or {}
+        if executor_cfg.get("enabled", False):
+            from utils.embedding_executor import BatchedEmbeddings
+
+            base = BatchedEmbeddings.from_config(base, executor_cfg)
+        return InstrumentedEmbeddings(base)
+
+    def load_llm(self, json_mode: bool = False):
         """
         Load and return the LLM.
+        json_mode: ask providers that support it (llm.<provider>.json_mode) for JSON-only output.
         """
-        llm_block = self.config["llm"]
         log.info("Loading LLM...")
         # Default provider ya ENV var se choose karo
-        provider_key = os.getenv("LLM_PROVIDER", "groq")
+        return self._build_llm(self._llm_provider_key(), callbacks=[METRICS_CALLBACK], json_mode=json_mode)
+
+    def _llm_config(self, provider_key: str) -> dict:
+        llm_block = self.config["llm"]
         if provider_key not in llm_block:
             log.error("LLM provider not found in config", provider_key=provider_key)
             raise DocumentPortalException(f"Provider '{provider_key}' not found in config")
-        
-        llm_config = llm_block[provider_key]
+        return llm_block[provider_key]
+
+    def _build_llm(self, provider_key: str, callbacks=None, json_mode: bool = False):
+        llm_config = self._llm_config(provider_key)
         provider = llm_config.get("provider")
         model_name = llm_config.get("model_name")
         temperature = llm_config.get("temperature", 0.2)
         max_tokens = llm_config.get("max_output_tokens", 2048)
+        provider_json = json_mode and bool(llm_config.get("json_mode", False))
 
         log.info("Loading LLM", provider=provider, model_name=model_name, temperature=temperature, max_tokens=max_tokens)
         
         if provider == "google":
+            from langchain_google_genai import ChatGoogleGenerativeAI
+
             llm = ChatGoogleGenerativeAI(
                 model=model_name,
                 temperature=temperature,
-                max_tokens=max_tokens
+                max_tokens=max_tokens,
+                callbacks=callbacks,
+                **({"response_mime_type": "application/json"} if provider_json else {}),
                 )
             return llm
 
         elif provider == "groq":
+            from langchain_groq import ChatGroq
+
             llm = ChatGroq(
                 model_name=model_name,
                 temperature=temperature,
-                max_tokens=max_tokens
+                max_tokens=max_tokens,
+                callbacks=callbacks,
+                # JSON object mode: list schemas come back wrapped in an object (the parser unwraps them)
+                **({"model_kwargs": {"response_format": {"type": "json_object"}}} if provider_json else {}),
                 )
             return llm
 
+        elif provider == "local":
+            from utils.local_models import TemplateChatModel
+
+            llm = TemplateChatModel(
+                model_name=model_name or "template-v1",
+                latency_ms=llm_config.get("latency_ms", 0),
+                token_latency_ms=llm_config.get("token_latency_ms", 0),
+                max_tokens=max_tokens,
+                callbacks=callbacks,
+                )
+            return llm
+
+        elif provider == "router":
+            from utils.llm_router import LLMRouter
+
+            # members are built without callbacks: the router reports tokens for the winning call
+            members = [(key, self._build_llm(key, json_mode=json_mode)) for key in llm_config.get("providers", [])]
+            if not members:
+                raise DocumentPortalException(f"LLM router '{provider_key}' has no providers configured")
+            options = {k: v for k, v in llm_config.items() if k not in ("provider", "providers")}
+            return LLMRouter(providers=members, callbacks=callbacks, **options)
+
         else:
             log.error("Invalid LLM provider", provider=provider)
             raise DocumentPortalException(f"Unsupported LLM provider: '{provider}'")
 
 
-
 if __name__ == "__main__":
     loader = ModelLoader()
 
@@ -0,0 +1,77 @@
+"""
+Process pool for CPU-bound document parsing (PDF text extraction).
+
+One pool per API worker process, created on first use and shut down with the app.
+Jobs must be module-level functions (e.g. utils.document_ops.pdf_text) so they can
+be pickled. The default "spawn" start method is safe under threaded servers. A pool
+whose worker died (BrokenProcessPool) is dropped and rebuilt; only the files in flight
+on it fail.
+"""
+from __future__ import annotations
+import asyncio
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Sequence, Tuple
+
+from logger import GLOBAL_LOGGER as log
+
+_POOL: Optional[ProcessPoolExecutor] = None
+_POOL_KEY: Optional[tuple] = None
+_LOCK = threading.Lock()
+
+
+def parse_pool(workers: int, context: str = "spawn") -> ProcessPoolExecutor:
+    global _POOL, _POOL_KEY
+    with _LOCK:
+        if _POOL is None or _POOL_KEY != (workers, context):
+            if _POOL is not None:
+                _POOL.shutdown(wait=False, cancel_futures=True)
+            _POOL = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(context))
+            _POOL_KEY = (workers, context)
+            log.info("Parse pool started", workers=workers, context=context)
+        return _POOL
+
+
+def shutdown_parse_pool() -> None:
+    global _POOL, _POOL_KEY
+    with _LOCK:
+        pool, _POOL, _POOL_KEY = _POOL, None, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def parse_as_completed(fn: Callable[[Any], Any], items: Sequence[Any], workers: int,
+                             context: str = "spawn", window: Optional[int] = None
+                             ) -> AsyncIterator[Tuple[int, Any]]:
+    """
+    fn(item) off the event loop, yielding (position, result) as each one finishes; a failed
+    item yields its exception, not a raise. At most `window` items (default 2 x workers) are
+    submitted and not yet consumed, so a consumer that falls behind holds back new parses
+    instead of piling up their results.
+    """
+    loop = asyncio.get_running_loop()
+    executor = parse_pool(workers, context) if workers > 0 else None  # 0: default thread pool
+    window = max(1, window or 2 * max(workers, 1))
+    todo = iter(enumerate(items))
+    running: Dict[asyncio.Future, Tuple[int, Any]] = {}  # future -> (position, executor it ran on)
+    try:
+        while True:
+            for i, item in itertools.islice(todo, window - len(running)):
+                running[loop.run_in_executor(executor, fn, item)] = (i, executor)
+            if not running:
+                return
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                i, ran_on = running.pop(fut)
+                error = fut.exception()
+                if isinstance(error, BrokenProcessPool) and ran_on is executor:
+                    log.warning("Parse pool broken, restarting")
+                    shutdown_parse_pool()
+                    executor = parse_pool(workers, context)
+                yield i, error if error is not None else fut.result()
+    finally:
+        for fut in running:  # the consumer stopped early (e.g. the client went away)
+            fut.cancel()
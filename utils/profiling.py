@@ -0,0 +1,390 @@
+"""
+On-demand profiling of single API requests.
+
+Off unless `profiling.enabled` (or PROFILING_ENABLED=1). When off, the API installs
+neither the middleware nor the /debug/profile* routes, and the stage hook in
+utils/metrics.py stays unset, so requests pay nothing.
+
+A request is profiled when it carries `X-Profile: sampling|cprofile` ("1" picks the
+default mode), or when it matches a path armed with POST /debug/profile. Only one
+request is profiled at a time; others pass through untouched. Each profile records:
+
+- sampling: the request's threads are sampled every `sample_interval_ms`. These are
+  the thread handling the request, plus any worker thread while it runs one of the
+  request's stages. Output is flamegraph-ready collapsed stacks (stacks.collapsed),
+  rooted at the pipeline stage.
+- cprofile: deterministic cProfile of the same threads, merged into profile.pstats.
+- both: wall time and tracemalloc peak per pipeline stage (bytes above the level at
+  stage entry), written to summary.json.
+
+Profiles are not isolated to their request. cProfile and the sampler attach to the
+request's thread, which for async routes is the event-loop thread shared by every
+in-flight request. So a profile also contains any other request that ran on the loop
+while it was open, plus stages those requests ran in worker threads. tracemalloc is
+process-wide, so memory peaks include allocations made by concurrent requests. The
+body of a streamed response is produced after the profile closes.
+
+Artifacts contain stack frames and source paths, so profiling is only installed when
+PROFILING_TOKEN is set. Every trigger and /debug/profile* call must send it as
+X-Profile-Token.
+"""
+from __future__ import annotations
+import os
+import sys
+import json
+import time
+import uuid
+import hmac
+import shutil
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from logger import GLOBAL_LOGGER as log
+from utils.config_loader import load_config
+from utils.metrics import set_stage_profiler
+
+MODES = ("sampling", "cprofile")
+HEADER = "X-Profile"
+TOKEN_HEADER = "X-Profile-Token"
+ARTIFACTS = {"pstats": "profile.pstats", "collapsed": "stacks.collapsed", "summary": "summary.json"}
+_MAX_DEPTH = 128
+
+_CURRENT: ContextVar[Optional["RequestProfile"]] = ContextVar("docportal_request_profile", default=None)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class _Stage:
+    __slots__ = ("name", "thread", "t0", "start_mem", "peak_mem")
+
+    def __init__(self, name: str, thread: int, start_mem: int):
+        self.name = name
+        self.thread = thread
+        self.t0 = time.perf_counter()
+        self.start_mem = start_mem
+        self.peak_mem = start_mem
+
+
+class RequestProfile:
+    """Everything captured for one request; created and closed by Profiler.profile()."""
+
+    def __init__(self, method: str, path: str, mode: str, interval_s: float, trace_memory: bool):
+        self.id = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{uuid.uuid4().hex[:6]}"  # sorts by start time
+        self.method, self.path, self.mode = method, path, mode
+        self.interval_s = interval_s
+        self.trace_memory = trace_memory
+        self.thread = threading.get_ident()
+        self.stages: List[Dict[str, Any]] = []
+        self.samples: Counter = Counter()
+        self.status: Optional[int] = None
+        self._lock = threading.Lock()
+        self._open: List[_Stage] = []
+        self._thread_stages: Dict[int, List[str]] = {}
+        self._profiles: Dict[int, List[Any]] = {}   # thread -> [cProfile.Profile, depth]
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._own_tracing = False
+        self._t0 = 0.0
+        self._root: Optional[_Stage] = None
+        self.wall_s = 0.0
+        self.peak_bytes: Optional[int] = None
+
+    # ---------- memory (all under self._lock) ----------
+    def _fold_peak(self) -> int:
+        """Fold the peak since the last reset into every open stage, then reset; returns current usage."""
+        if not self.trace_memory:
+            return 0
+        current, peak = tracemalloc.get_traced_memory()
+        for s in self._open:
+            s.peak_mem = max(s.peak_mem, peak)
+        tracemalloc.reset_peak()
+        return current
+
+    def _enter(self, name: str) -> _Stage:
+        stage = _Stage(name, threading.get_ident(), self._fold_peak())
+        self._open.append(stage)
+        self._thread_stages.setdefault(stage.thread, []).append(name)
+        return stage
+
+    def _exit(self, stage: _Stage) -> Optional[int]:
+        self._fold_peak()
+        self._open.remove(stage)
+        names = self._thread_stages.get(stage.thread)
+        if names:
+            names.pop()
+        return stage.peak_mem - stage.start_mem if self.trace_memory else None
+
+    # ---------- lifecycle ----------
+    def start(self) -> None:
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._own_tracing = True
+        self._t0 = time.perf_counter()
+        with self._lock:
+            self._root = self._enter("request")
+        if self.mode == "cprofile":
+            self._profile_thread()
+        else:
+            self._sampler = threading.Thread(target=self._sample, name=f"profile-sampler:{self.id}", daemon=True)
+            self._sampler.start()
+
+    def stop(self) -> None:
+        if self.mode == "cprofile":
+            self._unprofile_thread()
+        else:
+            self._stop.set()
+            self._sampler.join()
+        self.wall_s = time.perf_counter() - self._t0
+        with self._lock:
+            self.peak_bytes = self._exit(self._root)
+        if self._own_tracing:
+            tracemalloc.stop()
+
+    # ---------- per-thread cProfile ----------
+    def _profile_thread(self) -> None:
+        tid = threading.get_ident()
+        entry = self._profiles.get(tid)
+        if entry is None:
+            import cProfile  # only needed in cprofile mode; keeps API import time down
+
+            entry = self._profiles[tid] = [cProfile.Profile(), 0]
+        if entry[1] == 0:
+            entry[0].enable()
+        entry[1] += 1
+
+    def _unprofile_thread(self) -> None:
+        entry = self._profiles.get(threading.get_ident())
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] == 0:
+            entry[0].disable()
+
+    # ---------- sampling ----------
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = {self.thread: "request"}
+                threads.update({tid: names[-1] for tid, names in self._thread_stages.items() if names})
+            for tid, stage in threads.items():
+                frame = frames.get(tid)
+                stack = []
+                while frame is not None and len(stack) < _MAX_DEPTH:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                if stack:
+                    self.samples[";".join([f"[{stage}]"] + stack[::-1])] += 1
+
+    # ---------- stage hooks (called through utils.metrics) ----------
+    def enter_stage(self, name: str) -> Tuple["RequestProfile", _Stage]:
+        with self._lock:
+            stage = self._enter(name)
+        if self.mode == "cprofile" and stage.thread != self.thread:
+            self._profile_thread()  # worker thread running this request's stage
+        return self, stage
+
+    def exit_stage(self, stage: _Stage, seconds: float) -> None:
+        if self.mode == "cprofile" and stage.thread != self.thread:
+            self._unprofile_thread()
+        with self._lock:
+            peak = self._exit(stage)
+            self.stages.append({"stage": stage.name, "ms": round(seconds * 1000, 3), "peak_bytes": peak,
+                                "thread": "request" if stage.thread == self.thread else "worker"})
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.stages.append({"stage": name, "ms": round(seconds * 1000, 3), "peak_bytes": None, "thread": None})
+
+    # ---------- artifacts ----------
+    def summary(self) -> Dict[str, Any]:
+        per_stage: Dict[str, Dict[str, Any]] = {}
+        for s in self.stages:
+            agg = per_stage.setdefault(s["stage"], {"stage": s["stage"], "calls": 0, "total_ms": 0.0,
+                                                    "max_ms": 0.0, "peak_bytes": None})
+            agg["calls"] += 1
+            agg["total_ms"] = round(agg["total_ms"] + s["ms"], 3)
+            agg["max_ms"] = max(agg["max_ms"], s["ms"])
+            if s["peak_bytes"] is not None:
+                agg["peak_bytes"] = max(agg["peak_bytes"] or 0, s["peak_bytes"])
+        return {
+            "id": self.id, "method": self.method, "path": self.path, "mode": self.mode, "status": self.status,
+            "wall_ms": round(self.wall_s * 1000, 3), "peak_bytes": self.peak_bytes,
+            "stages": sorted(per_stage.values(), key=lambda a: -a["total_ms"]),
+            "samples": sum(self.samples.values()) if self.mode == "sampling" else None,
+            "artifacts": [k for k in ("pstats", "collapsed") if (k == "pstats") == (self.mode == "cprofile")],
+        }
+
+    def save(self, root: Path) -> Path:
+        out = root / self.id
+        out.mkdir(parents=True, exist_ok=True)
+        summary = self.summary()
+        if self.mode == "cprofile":
+            import pstats
+
+            profiles = [p for p, _ in self._profiles.values()]
+            stats = pstats.Stats(*profiles)
+            stats.dump_stats(str(out / ARTIFACTS["pstats"]))
+            top = sorted(stats.stats.items(), key=lambda kv: -kv[1][3])[:25]
+            summary["top_cumulative"] = [{"function": f"{fn} ({os.path.basename(file)}:{line})", "calls": nc,
+                                          "tottime_ms": round(tt * 1000, 3), "cumtime_ms": round(ct * 1000, 3)}
+                                         for (file, line, fn), (_, nc, tt, ct, _) in top]
+        else:
+            with open(out / ARTIFACTS["collapsed"], "w", encoding="utf-8") as fh:
+                for stack, count in self.samples.most_common():
+                    fh.write(f"{stack} {count}\n")
+        (out / ARTIFACTS["summary"]).write_text(json.dumps(summary, indent=2), encoding="utf-8")
+        return out
+
+
+class Profiler:
+    """Decides which requests to profile, runs one profile at a time and keeps the newest artifacts."""
+
+    def __init__(self, out_dir, default_mode: str = "sampling", sample_interval_ms: float = 5.0,
+                 trace_memory: bool = True, keep: int = 50, token: Optional[str] = None):
+        self.out_dir = Path(out_dir)
+        self.default_mode = default_mode if default_mode in MODES else "sampling"
+        self.interval_s = max(0.001, float(sample_interval_ms) / 1000)
+        self.trace_memory = trace_memory
+        self.keep = max(1, int(keep))
+        self.token = token
+        self._armed: List[List[Any]] = []   # [path prefix, remaining, mode]
+        self._slot = threading.Lock()
+        self._active = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> "Profiler":
+        return cls(os.getenv("PROFILES_DIR") or cfg.get("dir", "profiles"), default_mode=cfg.get("mode", "sampling"),
+                   sample_interval_ms=cfg.get("sample_interval_ms", 5), trace_memory=cfg.get("tracemalloc", True),
+                   keep=cfg.get("keep", 50), token=os.getenv("PROFILING_TOKEN") or None)
+
+    def install(self) -> "Profiler":
+        set_stage_profiler(self)
+        return self
+
+    def authorized(self, token: Optional[str]) -> bool:
+        """Fails closed: with no token configured, no caller is authorized."""
+        return self.token is not None and hmac.compare_digest(token or "", self.token)
+
+    # ---------- stage hooks (utils.metrics) ----------
+    def enter(self, stage: str):
+        if not self._active:
+            return None
+        profile = _CURRENT.get()
+        return profile.enter_stage(stage) if profile is not None else None
+
+    def exit(self, token, seconds: float) -> None:
+        if token is not None:
+            token[0].exit_stage(token[1], seconds)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        if self._active:
+            profile = _CURRENT.get()
+            if profile is not None:
+                profile.observe(stage, seconds)
+
+    # ---------- triggering ----------
+    def arm(self, path_prefix: str, count: int = 1, mode: Optional[str] = None) -> Dict[str, Any]:
+        mode = mode if mode in MODES else self.default_mode
+        with self._lock:
+            self._armed.append([path_prefix, max(1, int(count)), mode])
+        return {"path": path_prefix, "count": max(1, int(count)), "mode": mode}
+
+    def requested(self, path: str, header: Optional[str], token: Optional[str]) -> Optional[str]:
+        """Mode to profile this request with, or None."""
+        if header:
+            value = header.strip().lower()
+            if value in ("0", "false", "no", "off") or not self.authorized(token):
+                return None
+            return value if value in MODES else self.default_mode
+        if not self._armed:
+            return None
+        with self._lock:
+            for armed in self._armed:
+                if path.startswith(armed[0]):
+                    armed[1] -= 1
+                    if armed[1] <= 0:
+                        self._armed.remove(armed)
+                    return armed[2]
+        return None
+
+    @contextmanager
+    def profile(self, method: str, path: str, mode: str) -> Iterator[Optional[RequestProfile]]:
+        """Profile the enclosed request; yields None (no profiling) while another profile is running."""
+        if not self._slot.acquire(blocking=False):
+            yield None
+            return
+        profile = RequestProfile(method, path, mode, self.interval_s, self.trace_memory)
+        token = _CURRENT.set(profile)
+        try:
+            profile.start()
+            self._active = True
+            try:
+                yield profile
+            finally:
+                self._active = False
+                profile.stop()
+            try:
+                out = profile.save(self.out_dir)
+                log.info("Request profiled", profile_id=profile.id, path=path, mode=mode,
+                         wall_ms=round(profile.wall_s * 1000, 1), artifacts=str(out))
+            except Exception as e:
+                log.warning("Failed to save request profile", profile_id=profile.id, error=str(e))
+            self._prune()
+        finally:
+            _CURRENT.reset(token)
+            self._slot.release()
+
+    # ---------- artifacts ----------
+    def _dirs(self) -> List[Path]:
+        if not self.out_dir.is_dir():
+            return []
+        return sorted((d for d in self.out_dir.iterdir() if (d / ARTIFACTS["summary"]).is_file()),
+                      key=lambda d: d.name, reverse=True)
+
+    def _prune(self) -> None:
+        for d in self._dirs()[self.keep:]:
+            shutil.rmtree(d, ignore_errors=True)
+
+    def list(self) -> List[Dict[str, Any]]:
+        out = []
+        for d in self._dirs():
+            try:
+                s = json.loads((d / ARTIFACTS["summary"]).read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                continue
+            out.append({k: s.get(k) for k in ("id", "method", "path", "mode", "status", "wall_ms", "peak_bytes")})
+        return out
+
+    def artifact(self, profile_id: str, kind: str = "summary") -> Optional[Path]:
+        name = ARTIFACTS.get(kind)
+        if name is None or os.path.basename(profile_id) != profile_id or profile_id in (".", ".."):
+            return None
+        path = self.out_dir / profile_id / name
+        return path if path.is_file() else None
+
+
+@lru_cache(maxsize=1)
+def get_profiler() -> Optional[Profiler]:
+    """The installed Profiler when profiling is enabled, else None (and no hooks are installed)."""
+    cfg = load_config().get("profiling") or {}
+    if not (cfg.get("enabled", False) or os.getenv("PROFILING_ENABLED", "").lower() in ("1", "true", "yes")):
+        return None
+    profiler = Profiler.from_config(cfg)
+    if profiler.token is None:
+        log.error("Request profiling is enabled but PROFILING_TOKEN is not set: profiling stays off")
+        return None
+    profiler.install()
+    log.info("Request profiling enabled", dir=str(profiler.out_dir), mode=profiler.default_mode)
+    return profiler
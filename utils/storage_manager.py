@@ -0,0 +1,377 @@
+from __future__ import annotations
+import os
+import time
+import shutil
+import threading
+import weakref
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from logger import GLOBAL_LOGGER as log
+from exception.custom_exception import DocumentPortalException
+from utils.metrics import STORAGE_DELETED, STORAGE_RECLAIMED
+
+try:
+    import fcntl
+except ImportError:  # Windows: only this process's pins are visible to the janitor
+    fcntl = None
+
+ACCESS_MARKER = ".last_access"
+READERS_LOCK = ".readers.lock"   # shared flock held by every process that has the index loaded
+WRITE_LOCK = ".write.lock"       # exclusive flock held by writers (see utils/index_snapshots.py)
+
+# ----------------------------- #
+# In-use registry + access log  #
+# ----------------------------- #
+_pins: Dict[str, int] = {}
+_pins_lock = threading.Lock()
+
+
+def _key(path) -> str:
+    return str(Path(path).resolve())
+
+
+def touch_access(path) -> None:
+    """Record 'now' as the last access time of a session dir (LRU key for the janitor)."""
+    p = Path(path)
+    if not p.is_dir():
+        return
+    marker = p / ACCESS_MARKER
+    try:
+        marker.touch(exist_ok=True)
+        os.utime(marker, None)
+    except OSError as e:
+        log.warning("Failed to record last access", path=str(p), error=str(e))
+
+
+def retain(path) -> None:
+    """Mark a path as in use (loaded or being written); the janitor never deletes it."""
+    k = _key(path)
+    with _pins_lock:
+        _pins[k] = _pins.get(k, 0) + 1
+    touch_access(path)
+
+
+def release(path) -> None:
+    k = _key(path)
+    with _pins_lock:
+        n = _pins.get(k, 0) - 1
+        if n > 0:
+            _pins[k] = n
+        else:
+            _pins.pop(k, None)
+    touch_access(path)
+
+
+@contextmanager
+def pinned(path):
+    """Context manager form of retain()/release() for writes."""
+    retain(path)
+    try:
+        yield
+    finally:
+        release(path)
+
+
+def pin_while_alive(owner: object, path) -> None:
+    """Keep `path` pinned until `owner` is garbage collected (e.g. a loaded vectorstore)."""
+    retain(path)
+    weakref.finalize(owner, release, path)
+
+
+def share_while_alive(owner: object, index_dir) -> None:
+    """
+    Hold a shared flock on `index_dir`'s readers lock until `owner` is garbage collected, so
+    janitors in other worker processes see the index as loaded (pins are per process).
+    """
+    if fcntl is None:
+        return
+    try:
+        fh = open(Path(index_dir) / READERS_LOCK, "a+b")
+    except OSError as e:
+        log.warning("Failed to open readers lock", path=str(index_dir), error=str(e))
+        return
+    fcntl.flock(fh.fileno(), fcntl.LOCK_SH)
+    weakref.finalize(owner, fh.close)
+
+
+@contextmanager
+def claimed(path) -> Iterator[bool]:
+    """
+    Yield False if another process has `path` loaded or is writing it (its readers or
+    writer flock is held), else True while holding both exclusively, so nobody starts
+    loading or writing it during the body.
+    """
+    held: List = []
+    try:
+        for name in (READERS_LOCK, WRITE_LOCK):
+            lock_path = Path(path) / name
+            if fcntl is None or not lock_path.exists():
+                continue
+            fh = open(lock_path, "a+b")
+            held.append(fh)
+            try:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+        yield True
+    finally:
+        for fh in held:
+            fh.close()  # closing the file releases its flock
+
+
+def is_pinned(path) -> bool:
+    """True if `path` itself or anything below it is currently in use."""
+    k = _key(path)
+    prefix = k.rstrip(os.sep) + os.sep
+    with _pins_lock:
+        return any(p == k or p.startswith(prefix) for p in _pins)
+
+
+# ----------------------------- #
+# Janitor                       #
+# ----------------------------- #
+@dataclass
+class StorageArea:
+    name: str
+    path: Path
+    ttl_seconds: Optional[float] = None
+    exclude: Tuple[str, ...] = ()
+    include_files: bool = True
+
+
+@dataclass
+class SweepReport:
+    deleted: Dict[str, int] = field(default_factory=dict)
+    reclaimed_bytes: Dict[str, int] = field(default_factory=dict)
+    skipped_in_use: int = 0      # pinned here, or loaded/being written by another process
+    skipped_recent: int = 0      # accessed within the grace period
+    bytes_before: int = 0
+    bytes_after: int = 0
+    duration_s: float = 0.0
+
+    def record(self, area: str, size: int) -> None:
+        self.deleted[area] = self.deleted.get(area, 0) + 1
+        self.reclaimed_bytes[area] = self.reclaimed_bytes.get(area, 0) + size
+
+    def as_dict(self) -> Dict[str, object]:
+        return {
+            "deleted": dict(self.deleted),
+            "reclaimed_bytes": dict(self.reclaimed_bytes),
+            "total_deleted": sum(self.deleted.values()),
+            "total_reclaimed_bytes": sum(self.reclaimed_bytes.values()),
+            "skipped_in_use": self.skipped_in_use,
+            "skipped_recent": self.skipped_recent,
+            "bytes_before": self.bytes_before,
+            "bytes_after": self.bytes_after,
+            "duration_s": round(self.duration_s, 4),
+        }
+
+
+@dataclass
+class _Entry:
+    area: StorageArea
+    path: Path
+    size: int
+    last_access: float
+    protected: Optional[bool] = None
+
+
+def _tree_size(path: Path) -> Tuple[int, float]:
+    """Return (total bytes, newest mtime) for a file or directory tree."""
+    if path.is_file():
+        st = path.stat()
+        return st.st_size, st.st_mtime
+    total, newest = 0, path.stat().st_mtime
+    stack = [str(path)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for e in it:
+                try:
+                    if e.is_dir(follow_symlinks=False):
+                        stack.append(e.path)
+                    else:
+                        st = e.stat(follow_symlinks=False)
+                        total += st.st_size
+                        newest = max(newest, st.st_mtime)
+                except FileNotFoundError:
+                    continue
+    return total, newest
+
+
+class StorageJanitor:
+    """
+    Background cleanup for uploads and FAISS session dirs.
+
+    Each area has its own TTL; on top of that a global disk budget is enforced by
+    evicting least-recently-used entries (last access recorded via touch_access()).
+    Entries that are pinned (loaded/being written) or were touched within the
+    grace period are never deleted. Pins are per process; directories loaded or
+    being written by other worker processes are recognised by their readers/writer
+    flocks (see share_while_alive() and claimed()).
+    """
+
+    def __init__(
+        self,
+        areas: List[StorageArea],
+        disk_budget_bytes: Optional[int] = None,
+        interval_seconds: float = 600,
+        grace_seconds: float = 120,
+    ):
+        self.areas = areas
+        self.disk_budget_bytes = disk_budget_bytes
+        self.interval_seconds = interval_seconds
+        self.grace_seconds = grace_seconds
+        self.last_report: Optional[SweepReport] = None
+        self.totals = SweepReport()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._sweep_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict, upload_base: str, faiss_base: str) -> "StorageJanitor":
+        cfg = config.get("storage", {}) or {}
+        ttl = cfg.get("ttl_hours", {}) or {}
+
+        def _ttl(name: str) -> Optional[float]:
+            hours = ttl.get(name)
+            return None if hours is None else float(hours) * 3600
+
+        analysis_dir = Path(os.getenv("DATA_STORAGE_PATH", os.path.join(upload_base, "document_analysis")))
+        compare_dir = Path(upload_base) / "document_compare"
+        areas = [
+            StorageArea("uploads", Path(upload_base), _ttl("uploads"),
+                        exclude=(analysis_dir.name, compare_dir.name)),
+            StorageArea("document_analysis", analysis_dir, _ttl("document_analysis")),
+            StorageArea("document_compare", compare_dir, _ttl("document_compare")),
+            # top-level files and these directories under faiss_base belong to the shared (non-session) index
+            StorageArea("faiss_index", Path(faiss_base), _ttl("faiss_index"), include_files=False,
+                        exclude=("snapshots", "shards")),
+        ]
+        budget_mb = cfg.get("disk_budget_mb")
+        return cls(
+            areas,
+            disk_budget_bytes=None if budget_mb is None else int(float(budget_mb) * 1024 * 1024),
+            interval_seconds=float(cfg.get("sweep_interval_seconds", 600)),
+            grace_seconds=float(cfg.get("grace_seconds", 120)),
+        )
+
+    # ---------- scanning ----------
+    def _entries(self, area: StorageArea) -> List[_Entry]:
+        if not area.path.is_dir():
+            return []
+        out: List[_Entry] = []
+        with os.scandir(area.path) as it:
+            for e in it:
+                if e.name.startswith(".") or e.name in area.exclude:
+                    continue
+                p = Path(e.path)
+                if not e.is_dir(follow_symlinks=False) and not area.include_files:
+                    continue
+                try:
+                    size, newest = _tree_size(p)
+                    marker = p / ACCESS_MARKER
+                    last = marker.stat().st_mtime if marker.exists() else newest
+                except FileNotFoundError:
+                    continue
+                out.append(_Entry(area, p, size, last))
+        return out
+
+    def _delete(self, entry: _Entry, report: SweepReport) -> bool:
+        try:
+            if entry.path.is_dir():
+                with claimed(entry.path) as free:
+                    if not free:  # loaded or being written by another worker process
+                        entry.protected = True
+                        report.skipped_in_use += 1
+                        return False
+                    shutil.rmtree(entry.path)
+            else:
+                entry.path.unlink()
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            log.warning("Failed to delete storage entry", path=str(entry.path), error=str(e))
+            return False
+        report.record(entry.area.name, entry.size)
+        return True
+
+    # ---------- public ----------
+    def sweep(self, now: Optional[float] = None) -> SweepReport:
+        """Run one TTL + disk-budget pass and return what was reclaimed."""
+        with self._sweep_lock:
+            t0 = time.perf_counter()
+            now = time.time() if now is None else now
+            report = SweepReport()
+            try:
+                entries = [e for a in self.areas for e in self._entries(a)]
+                report.bytes_before = sum(e.size for e in entries)
+
+                def _protected(e: _Entry) -> bool:
+                    if e.protected is None:
+                        if is_pinned(e.path):
+                            e.protected = True
+                            report.skipped_in_use += 1
+                        else:
+                            e.protected = now - e.last_access < self.grace_seconds
+                            report.skipped_recent += int(e.protected)
+                    return e.protected
+
+                remaining: List[_Entry] = []
+                for e in entries:
+                    ttl = e.area.ttl_seconds
+                    if ttl is not None and now - e.last_access > ttl and not _protected(e):
+                        if self._delete(e, report):
+                            continue
+                    remaining.append(e)
+
+                total = sum(e.size for e in remaining)
+                if self.disk_budget_bytes is not None and total > self.disk_budget_bytes:
+                    for e in sorted(remaining, key=lambda x: x.last_access):
+                        if total <= self.disk_budget_bytes:
+                            break
+                        if _protected(e):
+                            continue
+                        if self._delete(e, report):
+                            total -= e.size
+                report.bytes_after = total
+            except Exception as e:
+                log.error("Storage sweep failed", error=str(e))
+                raise DocumentPortalException("Storage sweep failed", e) from e
+
+            report.duration_s = time.perf_counter() - t0
+            for area, n in report.deleted.items():
+                STORAGE_DELETED.labels(area).inc(n)
+                STORAGE_RECLAIMED.labels(area).inc(report.reclaimed_bytes[area])
+                self.totals.deleted[area] = self.totals.deleted.get(area, 0) + n
+                self.totals.reclaimed_bytes[area] = (
+                    self.totals.reclaimed_bytes.get(area, 0) + report.reclaimed_bytes[area]
+                )
+            self.last_report = report
+            log.info("Storage sweep completed", **report.as_dict())
+            return report
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_seconds):
+            try:
+                self.sweep()
+            except DocumentPortalException:
+                pass  # already logged; try again next interval
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="storage-janitor", daemon=True)
+        self._thread.start()
+        log.info("Storage janitor started", interval_s=self.interval_seconds,
+                 budget_bytes=self.disk_budget_bytes, areas=[a.name for a in self.areas])
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
@@ -0,0 +1,278 @@
+"""
+Structured LLM output: local JSON repair and schema validation, re-asking the LLM only as a last resort.
+
+Providers are asked for JSON output where they support it (ModelLoader.load_llm(json_mode=True)).
+Whatever comes back goes through these steps:
+
+1. Extraction. Drop <think> blocks and code fences, then keep the first JSON value and
+   discard any text around it.
+2. Balancing. Remove trailing commas. If the output was truncated, close the open
+   string, drop a dangling key or partial literal, and close every open bracket.
+3. Coercion against the pydantic model. Match keys case-insensitively, fill missing
+   fields that have a default, and unwrap {"key": [...]} for list models. Then validate.
+
+Only if all of that fails is the LLM re-asked, once by default, with the error. A
+missing required field fails validation too, so an empty or cut-off object is re-asked
+rather than passed off as a result. Once the re-asks are used up, missing required
+fields are filled with "Not Available" / [] as a last resort. Every parse is counted
+as clean / repaired / reasked / placeholder / failed in
+`docportal_structured_output_total`.
+"""
+from __future__ import annotations
+import re
+import json
+import typing
+from typing import Any, List, Optional, Tuple, Type
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.output_parsers import BaseOutputParser, JsonOutputParser
+from pydantic import BaseModel, RootModel, ValidationError
+
+from logger import GLOBAL_LOGGER as log
+from utils.metrics import count_structured_output
+
+_THINK_RE = re.compile(r"<think>.*?(?:</think>|$)", re.S | re.I)
+_FENCE_RE = re.compile(r"```[a-zA-Z]*[ \t]*\n?(.*?)(?:```|$)", re.S)
+_TRAILING_COMMA_RE = re.compile(r",\s*$")
+_DANGLING_KEY_RE = re.compile(r'([{,])\s*"(?:[^"\\]|\\.)*"\s*:?\s*$')
+_LAST_TOKEN_RE = re.compile(r"([\[{,:])\s*([^\"\s{}\[\],:]+)$")
+_NUMBER_RE = re.compile(r"-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?")
+MISSING = "Not Available"
+
+
+def _valid_literal(token: str) -> bool:
+    return token in ("true", "false", "null") or bool(_NUMBER_RE.fullmatch(token))
+
+
+def extract_json_text(text: str) -> Optional[str]:
+    """The first JSON object/array in `text` (think blocks and fences removed), or None."""
+    text = _THINK_RE.sub("", text)
+    fenced = _FENCE_RE.search(text)
+    if fenced and re.search(r"[\[{]", fenced.group(1)):
+        text = fenced.group(1)
+    match = re.search(r"[\[{]", text)
+    return text[match.start():] if match else None
+
+
+def _close_truncated(out: str, stack: List[str]) -> str:
+    """Drop a dangling comma / key / partial literal at the end of truncated JSON."""
+    while True:
+        before = out
+        out = _TRAILING_COMMA_RE.sub("", out.rstrip())
+        token = _LAST_TOKEN_RE.search(out)
+        if token and not _valid_literal(token.group(2)):
+            out = out[:token.start(2)].rstrip()
+        if stack and stack[-1] == "}":
+            if out.endswith(":"):
+                out = out[:-1].rstrip()
+            key = _DANGLING_KEY_RE.search(out)
+            if key:
+                out = out[:key.start(1) + 1]  # keep the "{" or ","
+        if out == before:
+            return out
+
+
+def balance_json(fragment: str) -> str:
+    """Cut `fragment` after its first complete value, dropping trailing commas; close it if truncated."""
+    out: List[str] = []
+    stack: List[str] = []
+    in_string = escaped = False
+    for ch in fragment:
+        if in_string:
+            out.append(ch)
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+            out.append(ch)
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            out.append(ch)
+        elif ch in "}]":
+            if not stack or stack[-1] != ch:
+                continue  # stray closer
+            text = _TRAILING_COMMA_RE.sub("", "".join(out).rstrip())
+            out = [text, ch]
+            stack.pop()
+            if not stack:
+                return "".join(out)  # complete value: anything after it is dropped
+        else:
+            out.append(ch)
+
+    text = "".join(out)
+    if in_string:
+        text = (text[:-1] if escaped else text) + '"'
+    text = _close_truncated(text, stack)
+    for closer in reversed(stack):
+        text = _TRAILING_COMMA_RE.sub("", text.rstrip()) + closer
+    return text
+
+
+def repair_json(text: str) -> Tuple[Any, bool]:
+    """(parsed value, whether any repair was needed); raises ValueError if nothing parseable is found."""
+    try:
+        return json.loads(text), False
+    except (TypeError, ValueError):
+        pass
+    fragment = extract_json_text(text or "")
+    if fragment is None:
+        raise ValueError("no JSON object or array in the output")
+    return json.loads(balance_json(fragment)), True
+
+
+# ---------- schema coercion ----------
+def _placeholder(annotation: Any) -> Any:
+    origin = typing.get_origin(annotation)
+    if annotation is list or origin in (list, List):
+        return []
+    if origin is typing.Union:
+        args = typing.get_args(annotation)
+        return MISSING if str in args else _placeholder(args[0])
+    return MISSING
+
+
+def _fill_object(model: Type[BaseModel], value: Any, fill_required: bool = False) -> Tuple[Any, bool]:
+    if isinstance(value, list) and len(value) == 1 and isinstance(value[0], dict):
+        value = value[0]
+    if not isinstance(value, dict):
+        return value, False
+    by_lower = {k.lower(): k for k in value}
+    out, changed = {}, False
+    for name, field in model.model_fields.items():
+        key = name if name in value else by_lower.get(name.lower())
+        if key is not None:
+            out[name] = value[key]
+            changed |= key != name
+        elif field.default_factory is not None:
+            out[name], changed = field.default_factory(), True
+        elif not field.is_required():
+            out[name], changed = field.default, True
+        elif fill_required:
+            out[name], changed = _placeholder(field.annotation), True
+        # otherwise left out: validation fails and the caller re-asks
+    return out, changed
+
+
+def coerce(model: Type[BaseModel], value: Any, fill_required: bool = False) -> Tuple[Any, bool]:
+    """
+    Shape `value` towards `model` (see module docstring); returns (value, changed).
+    `fill_required` also fills missing required fields with placeholders.
+    """
+    if issubclass(model, RootModel):
+        root = model.model_fields["root"].annotation
+        args = typing.get_args(root)
+        if typing.get_origin(root) is not list or not args:
+            return value, False
+        changed = False
+        if isinstance(value, dict):
+            lists = [v for v in value.values() if isinstance(v, list)]
+            value, changed = (lists[0] if len(lists) == 1 else [value]), True
+        item = args[0]
+        if isinstance(value, list) and isinstance(item, type) and issubclass(item, BaseModel):
+            items = [_fill_object(item, v, fill_required) for v in value]
+            value = [v for v, _ in items]
+            changed |= any(c for _, c in items)
+        return value, changed
+    return _fill_object(model, value, fill_required)
+
+
+class StructuredOutputParser(BaseOutputParser[Any]):
+    """JSON parser validated against `pydantic_object`; repairs locally and re-asks `reask_llm` last."""
+
+    pydantic_object: Type[BaseModel]
+    label: str = "default"                  # metrics label
+    reask_llm: Optional[Any] = None
+    max_reasks: int = 1
+
+    @property
+    def _type(self) -> str:
+        return "structured_output"
+
+    def get_format_instructions(self) -> str:
+        return JsonOutputParser(pydantic_object=self.pydantic_object).get_format_instructions()
+
+    def _parse_local(self, text: str, fill_required: bool = False) -> Tuple[Any, bool]:
+        try:
+            value, repaired = repair_json(text)
+            value, coerced = coerce(self.pydantic_object, value, fill_required)
+            validated = self.pydantic_object.model_validate(value)
+        except (ValueError, ValidationError) as e:  # JSONDecodeError is a ValueError
+            raise OutputParserException(f"Invalid {self.pydantic_object.__name__} output: {e}", llm_output=text)
+        return validated.model_dump(), repaired or coerced
+
+    def _reask_messages(self, text: str, error: Exception):
+        from prompt.prompt_library import PROMPT_REGISTRY
+        from model.models import PromptType
+
+        return PROMPT_REGISTRY[PromptType.JSON_REPAIR.value].format_messages(
+            instructions=self.get_format_instructions(), completion=text, error=str(error))
+
+    def _record(self, outcome: str) -> None:
+        count_structured_output(self.label, outcome)
+        messages = {"reasked": "Structured output needed a re-ask",
+                    "placeholder": "Structured output returned with placeholder fields",
+                    "failed": "Structured output failed"}
+        if outcome in messages:
+            log.warning(messages[outcome], parser=self.label)
+
+    def _fallback(self, texts: List[str], error: Exception) -> Any:
+        """Re-asks used up: fill missing required fields with placeholders, latest reply first."""
+        for text in reversed(texts):
+            try:
+                value, _ = self._parse_local(text, fill_required=True)
+            except OutputParserException:
+                continue
+            self._record("placeholder")
+            return value
+        self._record("failed")
+        raise error
+
+    def parse(self, text: str) -> Any:
+        error: Exception
+        texts = [text]
+        try:
+            value, repaired = self._parse_local(text)
+            self._record("repaired" if repaired else "clean")
+            return value
+        except OutputParserException as e:
+            error = e
+        for _ in range(self.max_reasks if self.reask_llm is not None else 0):
+            reply = self.reask_llm.invoke(self._reask_messages(text, error))
+            text = str(getattr(reply, "content", reply))
+            texts.append(text)
+            try:
+                value, _ = self._parse_local(text)
+                self._record("reasked")
+                return value
+            except OutputParserException as e:
+                error = e
+        return self._fallback(texts, error)
+
+    async def aparse_result(self, result: List[Any], *, partial: bool = False) -> Any:
+        return await self.aparse(result[0].text)  # the default would run parse() (and a sync re-ask) in a thread
+
+    async def aparse(self, text: str) -> Any:
+        error: Exception
+        texts = [text]
+        try:
+            value, repaired = self._parse_local(text)
+            self._record("repaired" if repaired else "clean")
+            return value
+        except OutputParserException as e:
+            error = e
+        for _ in range(self.max_reasks if self.reask_llm is not None else 0):
+            reply = await self.reask_llm.ainvoke(self._reask_messages(text, error))
+            text = str(getattr(reply, "content", reply))
+            texts.append(text)
+            try:
+                value, _ = self._parse_local(text)
+                self._record("reasked")
+                return value
+            except OutputParserException as e:
+                error = e
+        return self._fallback(texts, error)
@@ -0,0 +1,225 @@
+"""
+Persistent cache of extracted PDF text, shared by /analyze, /compare and /chat/index.
+
+Entries are keyed by the SHA-256 of the file content plus the extractor version, so
+the same bytes uploaded under any name or session are parsed once. Each entry is a
+single file:
+
+    MAGIC | u32 header length | JSON header | zlib page blob | zlib page blob | ...
+
+The header holds document metadata and the (offset, length, meta) of every page.
+Reads mmap the file and decompress page slices. Writes are atomic (tmp + rename).
+Total size is bounded by `max_mb`. Each process keeps a running estimate of the
+cache size, so a put does not scan the directory. A scan runs only once the estimate
+passes the budget, or once it is older than `rescan_seconds`, which picks up writes
+from other workers. The scan evicts least-recently-read entries (file mtime, refreshed
+on each hit) until the cache fits.
+"""
+from __future__ import annotations
+import os
+import json
+import mmap
+import zlib
+import time
+import struct
+import hashlib
+import threading
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from logger import GLOBAL_LOGGER as log
+from utils.config_loader import load_config
+from utils.metrics import count_cache, timed
+
+MAGIC = b"DPTXT001"
+_LEN = struct.Struct("<I")
+# bump when extraction output changes so stale entries stop matching
+EXTRACTOR_REVISION = 1
+_DOC_META_KEYS = ("title", "author", "subject", "creator", "producer", "creationDate", "modDate")
+
+
+@dataclass
+class PageText:
+    number: int                      # 1-based
+    text: str
+    meta: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class ExtractedPdf:
+    pages: List[PageText]
+    meta: Dict[str, Any]             # document-level metadata (title, author, page_count, ...)
+
+
+def file_digest(path, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=1)
+def extractor_version() -> str:
+    import fitz  # PyMuPDF
+
+    return f"pymupdf-{fitz.VersionBind}-r{EXTRACTOR_REVISION}"
+
+
+def _extract(path) -> ExtractedPdf:
+    import fitz  # PyMuPDF
+
+    with timed("read_pdf"), fitz.open(path) as doc:
+        if doc.is_encrypted:
+            raise ValueError(f"PDF is encrypted: {Path(path).name}")
+        pages = []
+        for i in range(doc.page_count):
+            page = doc.load_page(i)
+            pages.append(PageText(i + 1, page.get_text(),  # type: ignore
+                                  {"width": round(page.rect.width, 1), "height": round(page.rect.height, 1)}))
+        meta = {k: v for k, v in (doc.metadata or {}).items() if k in _DOC_META_KEYS and v}
+        meta["page_count"] = doc.page_count
+    return ExtractedPdf(pages, meta)
+
+
+class TextCache:
+    """Size-bounded directory of extracted documents, one compressed file per (digest, version)."""
+
+    def __init__(self, root, max_bytes: int, compress_level: int = 6, rescan_seconds: float = 300):
+        self.root = Path(root)
+        self.max_bytes = int(max_bytes)
+        self.compress_level = compress_level
+        self.rescan_seconds = rescan_seconds
+        self._lock = threading.Lock()
+        self._size: Optional[int] = None    # running estimate of the cache's bytes (None: not scanned yet)
+        self._scanned_at = 0.0
+
+    @classmethod
+    def from_config(cls, config: dict) -> "TextCache":
+        cfg = config.get("text_cache") or {}
+        root = os.getenv("TEXT_CACHE_DIR", cfg.get("dir", "cache/extracted_text"))
+        return cls(root, int(float(cfg.get("max_mb", 512)) * 1024 * 1024), cfg.get("compress_level", 6),
+                   cfg.get("rescan_seconds", 300))
+
+    def _path(self, digest: str, version: str) -> Path:
+        return self.root / digest[:2] / f"{digest}-{version}.bin"
+
+    def get(self, digest: str, version: str) -> Optional[ExtractedPdf]:
+        path = self._path(digest, version)
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[:len(MAGIC)] != MAGIC:
+                    raise ValueError("bad magic")
+                (header_len,) = _LEN.unpack_from(mm, len(MAGIC))
+                body = len(MAGIC) + _LEN.size
+                header = json.loads(mm[body:body + header_len])
+                base = body + header_len
+                pages = [
+                    PageText(p["number"], zlib.decompress(mm[base + p["offset"]:base + p["offset"] + p["length"]])
+                             .decode("utf-8"), p["meta"])
+                    for p in header["pages"]
+                ]
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # truncated/corrupt entry: drop it and re-extract
+            log.warning("Discarding unreadable text cache entry", path=str(path), error=str(e))
+            try:
+                size = path.stat().st_size
+                path.unlink()
+            except FileNotFoundError:
+                return None
+            with self._lock:
+                if self._size is not None:
+                    self._size -= size
+            return None
+        try:
+            os.utime(path, None)  # LRU key
+        except OSError:
+            pass
+        return ExtractedPdf(pages, header["meta"])
+
+    def put(self, digest: str, version: str, extracted: ExtractedPdf) -> None:
+        blobs, index, offset = [], [], 0
+        for p in extracted.pages:
+            blob = zlib.compress(p.text.encode("utf-8"), self.compress_level)
+            index.append({"number": p.number, "offset": offset, "length": len(blob), "meta": p.meta})
+            blobs.append(blob)
+            offset += len(blob)
+        header = json.dumps({"version": version, "meta": extracted.meta, "pages": index}).encode("utf-8")
+
+        path = self._path(digest, version)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(MAGIC + _LEN.pack(len(header)) + header)
+            for blob in blobs:
+                f.write(blob)
+        try:
+            replaced = path.stat().st_size
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp, path)
+        self._account(len(MAGIC) + _LEN.size + len(header) + offset - replaced)
+
+    def _account(self, delta: int) -> None:
+        """Add a write to the size estimate; scan and evict only when over budget or stale."""
+        with self._lock:
+            if self._size is not None:
+                self._size += delta
+            due = (self._size is None or self._size > self.max_bytes
+                   or time.monotonic() - self._scanned_at > self.rescan_seconds)
+        if due:
+            self.evict()
+
+    def evict(self) -> int:
+        """Delete least-recently-read entries until the cache fits the budget; returns bytes freed."""
+        with self._lock:
+            entries = []
+            for sub in self.root.glob("*/*.bin"):
+                try:
+                    st = sub.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, sub))
+            total = sum(size for _, size, _ in entries)
+            freed = 0
+            for _, size, path in sorted(entries):
+                if total - freed <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                freed += size
+            self._size, self._scanned_at = total - freed, time.monotonic()
+        if freed:
+            log.info("Text cache evicted entries", freed_bytes=freed, size_bytes=total - freed)
+        return freed
+
+    def extract(self, path) -> ExtractedPdf:
+        digest, version = file_digest(path), extractor_version()
+        cached = self.get(digest, version)
+        if cached is not None:
+            count_cache("extracted_text", hits=1)
+            return cached
+        count_cache("extracted_text", misses=1)
+        extracted = _extract(path)
+        try:
+            self.put(digest, version, extracted)
+        except OSError as e:
+            log.warning("Failed to write text cache entry", path=str(path), error=str(e))
+        return extracted
+
+
+@lru_cache(maxsize=4)
+def _cache_for(root: str, max_bytes: int, compress_level: int, rescan_seconds: float) -> TextCache:
+    return TextCache(root, max_bytes, compress_level, rescan_seconds)
+
+
+def extract_pdf(path) -> ExtractedPdf:
+    """Per-page text of a PDF, through the shared cache when `text_cache.enabled`."""
+    config = load_config()
+    if not (config.get("text_cache") or {}).get("enabled", False):
+        return _extract(path)
+    cache = TextCache.from_config(config)
+    return _cache_for(str(cache.root), cache.max_bytes, cache.compress_level, cache.rescan_seconds).extract(path)
@@ -0,0 +1,188 @@
+"""
+Traffic recording for workload replay (see benchmarks/replay.py).
+
+Off unless `traffic_recording.enabled` (TRAFFIC_RECORDING=1/0 overrides it). When it is off, the
+API installs no middleware. When on, every request outside `exclude_paths` (sampled
+at `sample_rate`) appends one JSON line to `path` with these fields:
+
+    ts, method, path, query, route, status, latency_ms, content_type, body_bytes,
+    form    - non-file fields as {name: value or [values]} (values cut at max_value_chars)
+    files   - [{field, filename, content_type, size, sha256}]
+    body    - {size, sha256} for non-form bodies
+    response- {"session_id": ...} taken from small JSON responses, so replay can map
+              the sessions it creates onto the ones the recording refers to
+
+With `store_payloads`, file and body contents are also kept in a content-addressed
+blob store (`blob_dir/<sha[:2]>/<sha>`), so identical uploads are stored once.
+Recording reads and parses the request body before the endpoint does. Bodies larger
+than `max_body_bytes` are recorded by size only, as `oversized`. Form values such as chat questions
+are stored verbatim: treat recordings like request logs.
+"""
+from __future__ import annotations
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile
+from starlette.requests import Request
+from starlette.responses import Response
+
+from logger import GLOBAL_LOGGER as log
+from utils.config_loader import load_config
+
+RESPONSE_FIELDS = ("session_id",)
+_MAX_RESPONSE_CAPTURE = 64 * 1024
+
+
+class BlobStore:
+    """Content-addressed files: blob_dir/<sha256[:2]>/<sha256>."""
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def path(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / sha256
+
+    def put(self, sha256: str, data: bytes) -> None:
+        path = self.path(sha256)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{sha256}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def get(self, sha256: str) -> Optional[bytes]:
+        path = self.path(sha256)
+        return path.read_bytes() if path.is_file() else None
+
+
+class TrafficRecorder:
+    def __init__(self, path, blob_dir=None, store_payloads: bool = False, sample_rate: float = 1.0,
+                 max_body_bytes: int = 64 * 1024 * 1024, max_value_chars: int = 4096,
+                 exclude_paths: Sequence[str] = ("/metrics", "/health", "/static", "/debug", "/chat/snapshot")):
+        self.path = Path(path)
+        self.blobs = BlobStore(blob_dir or self.path.parent / "blobs") if store_payloads else None
+        self.sample_rate = sample_rate
+        self.max_body_bytes = max_body_bytes
+        self.max_value_chars = max_value_chars
+        self.exclude_paths = tuple(exclude_paths)
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> "TrafficRecorder":
+        kwargs = {k: cfg[k] for k in ("sample_rate", "max_body_bytes", "max_value_chars", "exclude_paths") if k in cfg}
+        return cls(os.getenv("TRAFFIC_LOG") or cfg.get("path", "traffic/requests.jsonl"),
+                   blob_dir=cfg.get("blob_dir"), store_payloads=cfg.get("store_payloads", False), **kwargs)
+
+    def wants(self, path: str) -> bool:
+        if path.startswith(self.exclude_paths) or path == "/":
+            return False
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    # ---------- request side ----------
+    async def capture(self, request: Request) -> Dict[str, Any]:
+        """Shape of the request; reads (and caches) the body so the endpoint still sees it."""
+        content_type = request.headers.get("content-type", "")
+        length = int(request.headers.get("content-length") or 0)
+        record: Dict[str, Any] = {"ts": time.time(), "method": request.method, "path": request.url.path,
+                                  "query": request.url.query, "content_type": content_type.split(";")[0],
+                                  "body_bytes": length}
+        if length > self.max_body_bytes:
+            record["oversized"] = True  # shape only: replay skips it
+        if not length or length > self.max_body_bytes:
+            return record
+        body = await request.body()
+        record["body_bytes"] = len(body)
+        if content_type.startswith(("multipart/form-data", "application/x-www-form-urlencoded")):
+            form = await request.form()
+            try:
+                fields: Dict[str, Any] = {}
+                uploads = []
+                for name, value in form.multi_items():
+                    if isinstance(value, UploadFile):
+                        uploads.append((name, value))
+                    else:
+                        text = value[: self.max_value_chars]
+                        if name in fields:  # repeated field, e.g. session_ids
+                            prev = fields[name]
+                            fields[name] = (prev if isinstance(prev, list) else [prev]) + [text]
+                        else:
+                            fields[name] = text
+                record["form"] = fields
+                record["files"] = await run_in_threadpool(self._describe_uploads, uploads)
+            finally:
+                await form.close()
+        else:
+            record["body"] = await run_in_threadpool(self._describe, body)
+        return record
+
+    def _describe(self, data: bytes) -> Dict[str, Any]:
+        sha = hashlib.sha256(data).hexdigest()
+        if self.blobs is not None:
+            self.blobs.put(sha, data)
+        return {"size": len(data), "sha256": sha}
+
+    def _describe_uploads(self, uploads: List) -> List[Dict[str, Any]]:
+        out = []
+        for name, upload in uploads:
+            upload.file.seek(0)
+            out.append({"field": name, "filename": upload.filename, "content_type": upload.content_type,
+                        **self._describe(upload.file.read())})
+        return out
+
+    # ---------- response side ----------
+    async def capture_response(self, response: Response, record: Dict[str, Any]) -> Response:
+        """Keep RESPONSE_FIELDS of a small JSON response; returns a response that still has its body."""
+        length = int(response.headers.get("content-length") or 0)
+        if not response.headers.get("content-type", "").startswith("application/json") \
+                or not 0 < length <= _MAX_RESPONSE_CAPTURE:
+            return response
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        try:
+            payload = json.loads(body)
+            kept = {k: payload[k] for k in RESPONSE_FIELDS if isinstance(payload, dict) and payload.get(k)}
+            if kept:
+                record["response"] = kept
+        except ValueError:
+            pass
+        replay = Response(body, status_code=response.status_code, background=response.background)
+        replay.raw_headers = response.raw_headers
+        return replay
+
+    def write(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        with self._lock, open(self.path, "a", encoding="utf-8") as fh:
+            fh.write(line)
+
+
+def read_records(path) -> List[Dict[str, Any]]:
+    """Recorded requests in arrival order (unparseable lines are skipped)."""
+    records = []
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return sorted(records, key=lambda r: r.get("ts", 0))
+
+
+@lru_cache(maxsize=1)
+def get_recorder() -> Optional[TrafficRecorder]:
+    """The TrafficRecorder when recording is enabled, else None (and no middleware is installed)."""
+    cfg = load_config().get("traffic_recording") or {}
+    flag = os.getenv("TRAFFIC_RECORDING")  # overrides the config either way (replay servers set it to 0)
+    if not (flag.lower() in ("1", "true", "yes") if flag else cfg.get("enabled", False)):
+        return None
+    recorder = TrafficRecorder.from_config(cfg)
+    log.info("Traffic recording enabled", path=str(recorder.path), payloads=recorder.blobs is not None)
+    return recorder